@@ -1,62 +1,63 @@
 # This file is the langchain part of this project
+import asyncio
 import json
 import os
+import re
 import shutil
+from concurrent.futures import Future
+from typing import Optional
 
-from langchain_community.llms.ollama import Ollama
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnableLambda
-from langchain_community.embeddings import OllamaEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import WebBaseLoader
-
-import torch
-import whisper
-
-from colorama import Fore, Style
 
 from os.path import exists
 
-import tiktoken
-
-from googlesearch import search
+# all models are loaded lazily by the registry, importing this file does not load any of them
+from models import get_basic_llm, get_master_llm, get_screening_llm, screening_model_name, \
+    basic_model_name, basic_token_limit, master_model_name, master_token_limit
+from transcription import get_transcription_service, get_transcript_key
+from cache import assessment_cache, fingerprint, prompt_fingerprint
+from voting import cast_votes, VoteResult
+from llm_cache import cached_llm
+from transcript_index import transcript_index, transcript_text_hash
+from database import save_assessment, save_assessments, load_assessment, get_assessment_fingerprint, \
+    get_assessed_ids, record_votes, advance_candidates, get_candidates_in_state, candidate_states, \
+    get_node_fingerprints, reopen_candidates, hashid, UPLOADED, TRANSCRIBED, ASSESSED, FILTERED, REJECTED
+from tokens import TokenCounter, map_reduce, amap_reduce, fit_fields, reduce_prompt, count_prompt_tokens, \
+    token_safety_margin
+from factcheck import ClaimContext, claims_prompt
+from metrics import get_logger, metrics_registry, span
+from screening import ScreeningResult, screen, ascreen, is_model_screening_enabled, screening_fingerprint, \
+    record_screened_out, embed_tasks, screening_enabled
+import streams
+from streams import TOKEN, RESULT
+from scheduler import fair_scheduler, current_tenant, resolve_tenants, Tenant
 
 
 def separate_id(filename: str):
     # input: foo/bar/baz.faz
     return filename.split('/')[-1].split('.')[0]
 
-# factcheck_db - google search rag - PERSISTENT | available globally | !potential issue vector!
+# factcheck_db - search backend rag - PERSISTENT | available globally | see factcheck.py
 # candidate_XXXXXX_db - specific candidate trivia rag - RAM -> ARCHIVE | available only in the assessment scope
 
-# MODELS: zephyr:7b-beta-q5_K_M is really the minimum i will allow for the basic evaluation
-#         for master_, we have to find something much better to give more insight based on the responses.
-#         for embedding_, choice is between MiniLM-L6 and Glove, but probably MiniLM-L6 is the much better option.
-
-
-basic_model_name = "zephyr:7b-beta-q5_K_M"  # "llama2-uncensored:7b"
-basic_model_base_name = basic_model_name.split(':')[0]
-basic_token_limit = 4096  # depending on VRAM, try 2048, 3072 or 4096. 2048 works great on 4GB VRAM
-basic_llm = Ollama(model=basic_model_name)
-
-master_model_name = "zephyr:7b-beta-q5_K_M"  # "llama2-uncensored:7b"
-master_model_base_name = master_model_name.split(':')[0]
-master_token_limit = 4096
-master_llm = Ollama(model=master_model_name)
-
-embedding_model_name = "zephyr:7b-beta-q5_K_M"
-embedding_model_base_name = embedding_model_name.split(':')[0]
-embedding_token_limit = 4096
-embeddings = OllamaEmbeddings(model=embedding_model_name)
-
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-transcription_model = whisper.load_model("base.en")
-
-token_encoder = tiktoken.get_encoding("cl100k_base")
 output_parser = StrOutputParser()
 
+logger = get_logger('assessment')
+llm_requests_waiting = metrics_registry.gauge('speedvue_llm_requests_waiting',
+                                              "Llm requests waiting for a free slot of their model", ('model',))
+llm_requests_active = metrics_registry.gauge('speedvue_llm_requests_active', "Llm requests being answered",
+                                             ('model',))
+llm_call_seconds = metrics_registry.histogram('speedvue_llm_call_seconds',
+                                              "Time the model spent answering an uncached llm call, by stage",
+                                              ('model', 'stage'))
+assessments_total = metrics_registry.counter(
+    'speedvue_assessments_total', "Assessments by where they came from (cache, duplicate, reuse, llm, screening)",
+    ('source',))
+viability_verdicts = metrics_registry.counter('speedvue_viability_verdicts_total', "Votes on candidate viability",
+                                              ('viable',))
+
 
 class StandardTask:
     # task specification
@@ -70,20 +71,58 @@ class StandardTask:
 
 class StandardTaskResponse(StandardTask):
     # video response + transcription
+    # transcription is lazy, it happens in the transcription worker pool once the transcript is first requested
     video_path: str
     _transcript: str = None
+    _transcript_future: Future = None
+    _transcript_key: str = None
+    screening: ScreeningResult = None  # set once the response went through the screening, see screening.py
 
-    def generate_transcript(self):
+    def get_transcription_path(self) -> str:
         short_filename = self.video_path.split('.')[0].split('/')[-1]
-        transcription_path = f"data/text/{short_filename}.txt"
-        if exists(transcription_path):
+        return f"data/text/{short_filename}.txt"
+
+    def request_transcript(self) -> Future:
+        # start transcribing in the background without waiting for the result, safe to call many times
+        if self._transcript_future is not None:
+            failed = self._transcript_future.done() and self._transcript_future.exception() is not None
+            if not failed:
+                return self._transcript_future
+
+        # data/text is only an export of the transcript cache, it is keyed by name and might be stale,
+        # it's used only for legacy responses whose video is no longer available
+        transcription_path = self.get_transcription_path()
+        if self._transcript is None and not exists(self.video_path) and exists(transcription_path):
             with open(transcription_path, 'r') as file:
                 self._transcript = file.read().replace('\n', ' ')
+
+        if self._transcript is not None:
+            self._transcript_future = Future()
+            self._transcript_future.set_result(self._transcript)
         else:
-            self._transcript = transcription_model.transcribe(self.video_path)["text"]
-            with open(transcription_path, 'w') as file:
-                file.write(self._transcript)
-            print(f"{Fore.GREEN}{Style.BRIGHT}Transcription:{Fore.RESET}{Style.RESET_ALL}", self._transcript)
+            self._transcript_future = get_transcription_service().submit(self.video_path)
+            self._transcript_future.add_done_callback(self._store_transcript)
+        return self._transcript_future
+
+    def _store_transcript(self, future: Future):
+        if future.exception() is not None:
+            return
+        self._transcript = future.result()
+        with open(self.get_transcription_path(), 'w') as file:
+            file.write(self._transcript)
+        logger.debug("Transcription: %s", self._transcript)
+
+    def generate_transcript(self):
+        self._transcript = self.request_transcript().result()
+
+    def get_transcript_key(self) -> str:
+        # content key of the transcript: video bytes, transcription model and audio pre-processing
+        if self._transcript_key is None:
+            if exists(self.video_path):
+                self._transcript_key = get_transcript_key(self.video_path)
+            else:
+                self._transcript_key = fingerprint('transcript-text', self.get_transcript())
+        return self._transcript_key
 
     def get_transcript(self):
         if self._transcript is None:
@@ -94,294 +133,912 @@ class StandardTaskResponse(StandardTask):
     def __init__(self, file_name: str, task_text: str, transcript: str = None):
         super().__init__(task_text)
         self.video_path = file_name
-        self.generate_transcript()
-
-
-def generate_response_summarization(user_response: StandardTaskResponse, overwrite: bool = False):
-    cache_accuracy = cache_knowledge = cache_focus = cache_independence = cache_factuality = "No data."
+        self._transcript = transcript
+
+
+# criterion prompts are module level, so that they're shared between the sync and the async assessment paths
+knowledge_prompt = ChatPromptTemplate.from_messages([
+    # summarize richness of knowledge of the user
+    ("system", "You are a hiring assistant and your job is to judge knowledge of this candidate."
+               "Your job is to summarize and judge if this candidate is knowledgeable."
+               "You should evaluate whether he has a lot of knowledge about "
+               "the points that he talks about and the topics that he responds to."
+               "Note all the exceptional knowledge of the candidate."
+               "Note any important lacks of knowledge, the candidate cannot lack basic understanding!"
+               "Reply with description and reasoning, note and describe any moment where candidate"
+               "was knowledgeable or was lacking knowledge."),
+    ("user", "The candidate was tasked with: \"{task}\""
+             "Candidate responded with: ```{input}```")
+])
+
+focus_prompt = ChatPromptTemplate.from_messages([
+    # simple summarization w/ prompt
+    ("system", "You are a hiring assistant and your job is to judge focus of this candidate."
+               "Your job is to summarize and judge if this candidate is capable on focusing on given task."
+               "You should evaluate whether this candidate stays on point, and if he makes sense."
+               "If candidate starts talking about unrelated topic, you have to note that."
+               "Reply with description and reasoning, note and describe any moment where candidate"
+               "loses focus and changes topic."),
+    ("user", "The candidate was tasked with: \"{task}\""
+             "Candidate responded with: ```{input}```")
+])
+
+independence_prompt = ChatPromptTemplate.from_messages([
+    # simple summarization of how much the user works on themselves and their projects
+    ("system", "You are a hiring assistant and your job is to judge independence of this candidate."
+               "Your job is to summarize and judge if this candidate is involved in personal projects,"
+               "if he is engaged in self-improvement, if his ideas are original and interesting."
+               "You should also evaluate whether this candidate has any personal projects at all,"
+               "not having any projects is bad and should be noted. Reply with description and reasoning"),
+    ("user", "The candidate was tasked with: \"{task}\""
+             "Candidate responded with: ```{input}```")
+])
+
+# each fact stated by the user is looked up in the search backend, and confirmed with rag, see factcheck.py
+factuality_prompt = ChatPromptTemplate.from_messages([
+    ("system", "You are a hiring assistant and your job is to judge factuality of this candidate."
+               "Your job is to summarize and judge if this candidate is factual or lying."
+               "You are also being provided with context for his claims, this is what you should evaluate."
+               "Each important fact and lie should get noted, but overlook minor mistakes."
+               "Include your reasoning."),
+    ("user", "The candidate was tasked with: \"{task}\""
+             "Context for claims: ```{context}```"
+             "Candidate responded with: ```{input}```")
+])
+
+accuracy_prompt = ChatPromptTemplate.from_messages([
+    ("system", "You are a hiring assistant and your job is to judge accuracy of the statements of this candidate."
+               "You are provided with the claims made by the candidate, each with context from reference sources."
+               "For each claim decide if the context supports it, contradicts it, or doesn't cover it."
+               "Summarize how accurate the statements of this candidate are, note every contradicted claim."
+               "Include your reasoning."),
+    ("user", "The candidate was tasked with: \"{task}\""
+             "Claims with their context: ```{input}```")
+])
+
+criterion_prompts = {
+    'accuracy': accuracy_prompt,
+    'knowledge': knowledge_prompt,
+    'focus': focus_prompt,
+    'independence': independence_prompt,
+    'factuality': factuality_prompt,
+}
+
+# 'fanout' asks for each criterion in a call of its own, 'combined' asks for all of them in one call with a JSON answer,
+# the transcript is then processed once instead of once per criterion, see build_assessment_chain
+assessment_mode = os.environ.get('SPEEDVUE_ASSESSMENT_MODE', 'fanout')
+assessment_modes = ['fanout', 'combined']
+combined_response_tokens = 1536  # reserved for the answer, it holds the judgements of all criteria
+
+combined_prompt = ChatPromptTemplate.from_messages([
+    ("system", "You are a hiring assistant and your job is to assess this candidate on every criterion at once."
+               "Judge these criteria, each one separately, with a description and your reasoning:"
+               "accuracy - do the provided contexts support the claims of the candidate, note every contradicted claim;"
+               "knowledge - is the candidate knowledgeable about the topics he talks about, note exceptional knowledge "
+               "and any lack of basic understanding;"
+               "focus - does the candidate stay on point and make sense, note any change of topic;"
+               "independence - is the candidate involved in personal projects and self-improvement, "
+               "not having any projects is bad and should be noted;"
+               "factuality - is the candidate factual or lying, note each important fact and lie."
+               "Reply with ONLY a JSON object, with the keys \"accuracy\", \"knowledge\", \"focus\", "
+               "\"independence\" and \"factuality\", the value of each key is your judgement as a single string."),
+    ("user", "The candidate was tasked with: \"{task}\""
+             "Claims of the candidate with context from reference sources: ```{context}```"
+             "Candidate responded with: ```{input}```")
+])
+
+
+def parse_combined_response(response: str) -> dict:
+    # criterion -> judgement, only criteria whose value is a non-empty string are returned, the rest is asked again
+    match = re.search(r"\{.*\}", response, re.DOTALL)
+    try:
+        parsed = json.loads(match.group(0)) if match else None
+    except ValueError:
+        parsed = None
+    if not isinstance(parsed, dict):
+        return {}
+    parsed = {str(key).strip().lower(): value for key, value in parsed.items()}
+    return {criterion: parsed[criterion].strip() for criterion in criterion_prompts
+            if isinstance(parsed.get(criterion), str) and parsed[criterion].strip()}
+
+
+def assessment_mode_parts() -> list:
+    # parts of the assessment keys, empty for the default mode, so that its cached assessments stay valid
+    if assessment_mode == 'fanout':
+        return []
+    return [assessment_mode, prompt_fingerprint(combined_prompt)]
+
+
+# criterion responses passed to the summarization prompt
+summary_fields = ['user_accuracy', 'user_knowledge', 'user_focus', 'user_independence', 'user_factuality']
+
+summarization_prompt = ChatPromptTemplate.from_messages([
+    ("system", "You are a hiring manager."
+               "Your job is to summarize eligibility of employment of this particular candidate."
+               "You are presented with summarized performance of this candidate, "
+               "on why this candidate is eligible or not eligible for employment."
+               "Freely write an opinion on why this candidate is a good or a poor choice,"
+               "explain your reasoning."
+               "You are provided with a set of evaluations about this candidate."
+               "Remember that candidate telling lies, not having any real life knowledge, "
+               "not having any interesting projects or not being focused on the task equals disqualification"),
+    ("user", "The candidate was tasked with: \"{task}\""
+             "Summary on accuracy of statements: ```{user_accuracy}```"
+             "Summary on knowledge of candidate: ```{user_knowledge}```"
+             "Summary on focus on response to the task: ```{user_focus}```"
+             "Summary on independence and discipline of the candidate: ```{user_independence}```"
+             "Summary on factuality of the response: ```{user_factuality}```")
+])
+
+
+def limited_llm(llm, model_name: str, limiter=None, on_token=None, stage: str = None):
+    # async calls of the returned llm wait for a free slot of this model in the limiter, sync calls are unaffected,
+    # the time the model spends on each call is observed by stage, the time of the assessment stages is what
+    # the screening saves, see estimate_llm_seconds,
+    # on_token(text) gets the response as it's generated, the call streams then, see streams.py
+    def generate(prompt_value) -> str:
+        if on_token is None:
+            return llm.invoke(prompt_value)
+        chunks = []
+        for chunk in llm.stream(prompt_value):
+            on_token(chunk)
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    async def agenerate(prompt_value) -> str:
+        if on_token is None:
+            return await llm.ainvoke(prompt_value)
+        chunks = []
+        async for chunk in llm.astream(prompt_value):
+            on_token(chunk)
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def invoke(prompt_value):
+        with llm_call_seconds.time(model=model_name, stage=stage):
+            return generate(prompt_value)
+
+    async def ainvoke_limited(prompt_value):
+        if limiter is None:
+            with llm_call_seconds.time(model=model_name, stage=stage):
+                return await agenerate(prompt_value)
+        slot = limiter.slot(model_name)
+        with llm_requests_waiting.track(model=model_name):
+            await slot.acquire()
+        try:
+            with llm_requests_active.track(model=model_name), llm_call_seconds.time(model=model_name, stage=stage):
+                return await agenerate(prompt_value)
+        finally:
+            slot.release()
+
+    return RunnableLambda(invoke, afunc=ainvoke_limited)
+
+
+# criteria which need the claims of the candidate and their context: (params, context) -> params of the prompt,
+# a criterion without any claims to check keeps its 'No data.' response
+context_criteria = {
+    'accuracy': lambda params, context: {'task': params['task'], 'input': context},
+    'factuality': lambda params, context: {**params, 'context': context or "No claims could be checked."},
+}
+
+
+def build_assessment_chain(caches: dict, limiter=None, counter: TokenCounter = None, candidate_id: str = None,
+                           mode: str = None, reuse: dict = None, events=None):
+    # caches gets filled with the intermediate responses of each criterion as the chain runs,
+    # counter with the token counts of every stage, candidate_id only labels the logged stage durations
+    # identical prompts are answered from the llm cache, see llm_cache.py, mode: see assessment_mode
+    # reuse: criterion -> response still valid from the previous assessment, see get_reusable_results
+    # events(kind, stage, text) gets the tokens of every llm call as they're generated, and the result of every
+    # criterion and of the summary, see streams.AssessmentStream.publish
+    mode = mode or assessment_mode
+    reuse = reuse or {}
+    if mode not in assessment_modes:
+        raise ValueError(f"Unknown assessment mode: {mode}, expected one of {assessment_modes}")
+    counter = counter if counter is not None else TokenCounter()
+
+    def publish(kind: str, stage: str, text: str):
+        if events is not None:
+            events(kind, stage, text)
+
+    def llm_chain(llm, model_name: str, stage: str, identity=None):
+        # identity: the llm which identifies the model in the llm cache, if llm is bound to some options
+        on_token = (lambda text: events(TOKEN, stage, text)) if events is not None else None
+        return cached_llm(limited_llm(llm, model_name, limiter, on_token, stage), identity or llm) | output_parser
+
+    master_chain = llm_chain(get_master_llm(), master_model_name, 'summary')
 
     def get_task(params: dict) -> str:
         # return the original prompt given to user
         return params['task']
 
-    def get_user_accuracy(params: dict) -> str:
-        # INCOMPLETE
-        # a loop of Google/rag and llm. for now a fixed amount of runs (5)
-        accuracy_response = "No data."
-        nonlocal cache_accuracy
-        cache_accuracy = accuracy_response
-        return accuracy_response
-
-    def get_user_knowledge(params: dict) -> str:
-        # summarize richness of knowledge of the user
-        knowledge_prompt = ChatPromptTemplate.from_messages([
-            ("system", "You are a hiring assistant and your job is to judge knowledge of this candidate."
-                       "Your job is to summarize and judge if this candidate is knowledgeable."
-                       "You should evaluate whether he has a lot of knowledge about "
-                       "the points that he talks about and the topics that he responds to."
-                       "Note all the exceptional knowledge of the candidate."
-                       "Note any important lacks of knowledge, the candidate cannot lack basic understanding!"
-                       "Reply with description and reasoning, note and describe any moment where candidate"
-                       "was knowledgeable or was lacking knowledge."),
-            ("user", "The candidate was tasked with: \"{task}\""
-                     "Candidate responded with: ```{input}```")
-        ])
-
-        knowledge_chain = (
-            knowledge_prompt |
-            basic_llm |
-            output_parser
-        )
-
-        knowledge_response = knowledge_chain.invoke(params)
-        print(f"{Fore.CYAN}{Style.BRIGHT}Knowledge response:{Fore.RESET}{Style.RESET_ALL}",
-              knowledge_response)
-
-        nonlocal cache_knowledge
-        cache_knowledge = knowledge_response
-        return knowledge_response
-
-    def get_user_focus(params: dict) -> str:
-        # simple summarization w/ prompt
-        focus_prompt = ChatPromptTemplate.from_messages([
-            ("system", "You are a hiring assistant and your job is to judge focus of this candidate."
-                       "Your job is to summarize and judge if this candidate is capable on focusing on given task."
-                       "You should evaluate whether this candidate stays on point, and if he makes sense."
-                       "If candidate starts talking about unrelated topic, you have to note that."
-                       "Reply with description and reasoning, note and describe any moment where candidate"
-                       "loses focus and changes topic."),
-            ("user", "The candidate was tasked with: \"{task}\""
-                     "Candidate responded with: ```{input}```")
-        ])
-
-        focus_chain = (
-            focus_prompt |
-            basic_llm |
-            output_parser
-        )
-
-        focus_response = focus_chain.invoke(params)
-        print(f"{Fore.CYAN}{Style.BRIGHT}Focus response:{Fore.RESET}{Style.RESET_ALL}",
-              focus_response)
-
-        nonlocal cache_focus
-        cache_focus = focus_response
-        return focus_response
-
-    def get_user_independence(params: dict) -> str:
-        # simple summarization of how much the user works on themselves and their projects
-        independence_prompt = ChatPromptTemplate.from_messages([
-            ("system", "You are a hiring assistant and your job is to judge independence of this candidate."
-                       "Your job is to summarize and judge if this candidate is involved in personal projects,"
-                       "if he is engaged in self-improvement, if his ideas are original and interesting."
-                       "You should also evaluate whether this candidate has any personal projects at all,"
-                       "not having any projects is bad and should be noted. Reply with description and reasoning"),
-            ("user", "The candidate was tasked with: \"{task}\""
-                     "Candidate responded with: ```{input}```")
-        ])
-
-        independence_chain = (
-            independence_prompt |
-            basic_llm |
-            output_parser
-        )
-
-        independence_response = independence_chain.invoke(params)
-        print(f"{Fore.CYAN}{Style.BRIGHT}Independence response:{Fore.RESET}{Style.RESET_ALL}",
-              independence_response)
-
-        nonlocal cache_independence
-        cache_independence = independence_response
-        return independence_response
-
-    def get_user_factuality(params: dict) -> str:
-        # todo: INCOMPLETE - websearch loop lacking
-        # index each fact stated by the user, and confirm it with Google/rag
-        factuality_prompt = ChatPromptTemplate.from_messages([
-            ("system", "You are a hiring assistant and your job is to judge factuality of this candidate."
-                       "Your job is to summarize and judge if this candidate is factual or lying."
-                       "You are also being provided with context for his claims, this is what you should evaluate."
-                       "Each important fact and lie should get noted, but overlook minor mistakes."
-                       "Include your reasoning."),
-            ("user", "The candidate was tasked with: \"{task}\""
-                     # "Context for claims: ```{context}```"
-                     "Candidate responded with: ```{input}```")
-        ])
-
-        factuality_chain = (
-            factuality_prompt |
-            # statement extractor |
-            # websearch |
-            # rag assisted evaluation |
-            # evaluation-inclusive prompt |
-            basic_llm |
-            output_parser
-        )
-
-        factuality_response = factuality_chain.invoke(params)
-        print(f"{Fore.CYAN}{Style.BRIGHT}Factuality response:{Fore.RESET}{Style.RESET_ALL}",
-              factuality_response)
-
-        nonlocal cache_factuality
-        cache_factuality = factuality_response
-        return factuality_response
-
-    summarization_prompt = ChatPromptTemplate.from_messages([
-        ("system", "You are a hiring manager."
-                   "Your job is to summarize eligibility of employment of this particular candidate."
-                   "You are presented with summarized performance of this candidate, "
-                   "on why this candidate is eligible or not eligible for employment."
-                   "Freely write an opinion on why this candidate is a good or a poor choice,"
-                   "explain your reasoning."
-                   "You are provided with a set of evaluations about this candidate."
-                   "Remember that candidate telling lies, not having any real life knowledge, "
-                   "not having any interesting projects or not being focused on the task equals disqualification"),
-        ("user", "The candidate was tasked with: \"{task}\""
-                 "Summary on accuracy of statements: ```{user_accuracy}```"
-                 "Summary on knowledge of candidate: ```{user_knowledge}```"
-                 "Summary on focus on response to the task: ```{user_focus}```"
-                 "Summary on independence and discipline of the candidate: ```{user_independence}```"
-                 "Summary on factuality of the response: ```{user_factuality}```")
-    ])
-
-    standard_input = {'task': user_response.task_text, 'input': user_response.get_transcript()}
-
-    assess_transcript_chain = (
+    # claims are extracted and looked up once, and shared by the accuracy and factuality criteria
+    claim_context = ClaimContext(llm_chain(get_basic_llm(), basic_model_name, 'claims'), counter)
+
+    def criterion_step(criterion: str):
+        # transcripts which don't fit the context are assessed in parts, and the parts are reduced, see tokens.py
+        basic_chain = llm_chain(get_basic_llm(), basic_model_name, criterion)
+
+        def report(criterion_response: str) -> str:
+            logger.debug("%s response: %s", criterion.capitalize(), criterion_response)
+            caches[criterion] = criterion_response
+            publish(RESULT, criterion, criterion_response)
+            return criterion_response
+
+        def invoke(params: dict) -> str:
+            if criterion in reuse:
+                return report(reuse[criterion])
+            if criterion in context_criteria:
+                params = context_criteria[criterion](params, claim_context.get(params))
+                if not params['input']:
+                    return report(caches[criterion])
+            with span(criterion, candidate_id):
+                return report(map_reduce(criterion_prompts[criterion], basic_chain, params, basic_token_limit,
+                                         criterion, counter))
+
+        async def ainvoke(params: dict) -> str:
+            if criterion in reuse:
+                return report(reuse[criterion])
+            if criterion in context_criteria:
+                params = context_criteria[criterion](params, await claim_context.aget(params))
+                if not params['input']:
+                    return report(caches[criterion])
+            with span(criterion, candidate_id):
+                return report(await amap_reduce(criterion_prompts[criterion], basic_chain, params,
+                                                basic_token_limit, criterion, counter))
+
+        return RunnableLambda(invoke, afunc=ainvoke)
+
+    steps = {criterion: criterion_step(criterion) for criterion in criterion_prompts}
+
+    # the basic model is asked for a JSON answer (ollama's format option), the cache key only depends on the prompt
+    combined_chain = llm_chain(get_basic_llm().bind(format='json'), basic_model_name, 'combined', get_basic_llm())
+    combined_budget = int(basic_token_limit * token_safety_margin) - combined_response_tokens
+
+    def combined_prompt_value(params: dict, context: str):
+        # None if the transcript needs to be split, the fan-out assesses it in parts then
+        combined_params = {**params, 'context': context or "No claims could be checked."}
+        if count_prompt_tokens(combined_prompt, combined_params) > combined_budget:
+            return None
+        return combined_prompt.format_prompt(**combined_params)
+
+    def combined_judgements(prompt_value, response: str, context: str) -> dict:
+        counter.record('combined', prompt_value.to_string(), response)
+        # reused criteria keep their previous judgement
+        judgements = {criterion: judgement for criterion, judgement in parse_combined_response(response).items()
+                      if criterion not in reuse}
+        if not context:
+            # without any claims, accuracy keeps its 'No data.', as in the fan-out
+            judgements.pop('accuracy', None)
+        for criterion, judgement in judgements.items():
+            logger.debug("%s response: %s", criterion.capitalize(), judgement)
+            caches[criterion] = judgement
+            publish(RESULT, criterion, judgement)
+        missing = [criterion for criterion in criterion_prompts
+                   if criterion not in judgements and criterion not in reuse and (context or criterion != 'accuracy')]
+        if missing:
+            logger.info("Combined assessment of %s incomplete, asking separately for: %s", candidate_id, missing)
+        return judgements
+
+    def reused_judgements(judgements: dict) -> dict:
+        # reused criteria are taken as they are, the combined answer is only asked for if any criterion is stale
+        for criterion, judgement in reuse.items():
+            caches[criterion] = judgements[criterion] = judgement
+            publish(RESULT, criterion, judgement)
+        return judgements
+
+    def criteria_params(params: dict, judgements: dict) -> dict:
+        return {'task': params['task'],
+                **{f"user_{criterion}": judgements[criterion] for criterion in criterion_prompts}}
+
+    def assess_combined(params: dict) -> dict:
+        judgements = {}
+        if any(criterion not in reuse for criterion in criterion_prompts):
+            context = claim_context.get(params)
+            prompt_value = combined_prompt_value(params, context)
+            if prompt_value is not None:
+                with span('combined', candidate_id):
+                    judgements = combined_judgements(prompt_value, combined_chain.invoke(prompt_value), context)
+        judgements = reused_judgements(judgements)
+        # criteria which failed to parse fall back to a call of their own
+        for criterion in criterion_prompts:
+            if criterion not in judgements:
+                judgements[criterion] = steps[criterion].invoke(params)
+        return criteria_params(params, judgements)
+
+    async def aassess_combined(params: dict) -> dict:
+        judgements = {}
+        if any(criterion not in reuse for criterion in criterion_prompts):
+            context = await claim_context.aget(params)
+            prompt_value = combined_prompt_value(params, context)
+            if prompt_value is not None:
+                with span('combined', candidate_id):
+                    judgements = combined_judgements(prompt_value, await combined_chain.ainvoke(prompt_value),
+                                                     context)
+        judgements = reused_judgements(judgements)
+        missing = [criterion for criterion in criterion_prompts if criterion not in judgements]
+        for criterion, judgement in zip(missing, await asyncio.gather(*(steps[criterion].ainvoke(params)
+                                                                         for criterion in missing))):
+            judgements[criterion] = judgement
+        return criteria_params(params, judgements)
+
+    def summary_prompt_value(params: dict):
+        # criterion responses are shrunk evenly if together they don't fit the context of the master model
+        return summarization_prompt.format_prompt(**fit_fields(summarization_prompt, params, master_token_limit,
+                                                               summary_fields))
+
+    def summarize(params: dict) -> str:
+        prompt_value = summary_prompt_value(params)
+        with span('summary', candidate_id):
+            summary_response = master_chain.invoke(prompt_value)
+        counter.record('summary', prompt_value.to_string(), summary_response)
+        publish(RESULT, 'summary', summary_response)
+        return summary_response
+
+    async def asummarize(params: dict) -> str:
+        prompt_value = summary_prompt_value(params)
+        with span('summary', candidate_id):
+            summary_response = await master_chain.ainvoke(prompt_value)
+        counter.record('summary', prompt_value.to_string(), summary_response)
+        publish(RESULT, 'summary', summary_response)
+        return summary_response
+
+    if mode == 'combined':
+        return RunnableLambda(assess_combined, afunc=aassess_combined) | RunnableLambda(summarize, afunc=asummarize)
+
+    return (
         {
             "task": RunnableLambda(get_task),
-            "user_accuracy": RunnableLambda(get_user_accuracy),
-            "user_knowledge": RunnableLambda(get_user_knowledge),
-            "user_focus": RunnableLambda(get_user_focus),
-            "user_independence": RunnableLambda(get_user_independence),
-            "user_factuality": RunnableLambda(get_user_factuality)
+            "user_accuracy": steps['accuracy'],
+            "user_knowledge": steps['knowledge'],
+            "user_focus": steps['focus'],
+            "user_independence": steps['independence'],
+            "user_factuality": steps['factuality']
         } |
-        summarization_prompt |
-        master_llm |
-        output_parser
+        RunnableLambda(summarize, afunc=asummarize)
     )
 
-    short_filename = separate_id(user_response.video_path)
-    save_path = f"data/summaries/{short_filename}.json"
 
-    if exists(save_path) and not overwrite:
-        with open(save_path, 'r') as file:
-            complete_assessment_response = json.loads(file.read())['assessment']
-    else:
-        # force overwrite
-        complete_assessment_response = assess_transcript_chain.invoke(standard_input)
-        print(f"{Fore.YELLOW}{Style.BRIGHT}Assessment already present, overwriting!{Fore.RESET}{Style.RESET_ALL}")
-        # Save results to a file
-        with open(save_path, 'w') as file:
-            file.write(json.dumps({
-                'task': user_response.task_text,
-                'assessment': complete_assessment_response,
-                'cache_accuracy': cache_accuracy,
-                'cache_knowledge': cache_knowledge,
-                'cache_focus': cache_focus,
-                'cache_independence': cache_independence,
-                'cache_factuality': cache_factuality
-            }))
-
-    print(f"{Fore.CYAN}{Style.BRIGHT}Complete assessment response:{Fore.RESET}{Style.RESET_ALL}",
-          complete_assessment_response)
+def empty_caches() -> dict:
+    return {'accuracy': "No data.", 'knowledge': "No data.", 'focus': "No data.",
+            'independence': "No data.", 'factuality': "No data."}
+
+
+# any change to the prompts invalidates all cached assessments
+assessment_prompts_fingerprint = prompt_fingerprint(*criterion_prompts.values(), summarization_prompt, reduce_prompt,
+                                                    claims_prompt)
+
+
+def get_assessment_key(user_response: StandardTaskResponse) -> str:
+    return fingerprint('assessment', user_response.get_transcript_key(), user_response.task_text,
+                       basic_model_name, master_model_name, assessment_prompts_fingerprint, *assessment_mode_parts())
+
+
+def get_candidate_id(user_response: StandardTaskResponse) -> str:
+    return separate_id(user_response.video_path)
+
+
+# The assessment is a graph: transcript -> claims -> criteria -> summary -> votes. Each node is fingerprinted
+# by its prompt, its model and the fingerprints of its inputs, so a tuned prompt only makes its own node
+# and the nodes downstream of it stale, and a re-run recomputes just these, see get_reusable_results
+def node_fingerprints(user_response: StandardTaskResponse, mode: str = None) -> dict:
+    mode = mode or assessment_mode
+    nodes = {'transcript': user_response.get_transcript_key()}
+    nodes['claims'] = fingerprint('claims', prompt_fingerprint(claims_prompt), basic_model_name, nodes['transcript'])
+    # in the combined mode, all criteria are answered by the combined prompt, and by their own prompt as a fallback
+    mode_parts = [] if mode == 'fanout' else [mode, prompt_fingerprint(combined_prompt)]
+    for criterion, prompt in criterion_prompts.items():
+        inputs = [nodes['transcript'], nodes['claims']] if criterion in context_criteria else [nodes['transcript']]
+        nodes[criterion] = fingerprint('criterion', criterion, prompt_fingerprint(prompt, reduce_prompt),
+                                       basic_model_name, user_response.task_text, *inputs, *mode_parts)
+    nodes['summary'] = fingerprint('summary', prompt_fingerprint(summarization_prompt), master_model_name,
+                                   user_response.task_text, *(nodes[criterion] for criterion in criterion_prompts))
+    return nodes
+
+
+# assessments used to be stored as JSON files, these are only read now, see load_summary
+legacy_summaries_dir = 'data/summaries'
+videos_dir = 'data/videos'
+
+
+def build_summary(user_response: StandardTaskResponse, complete_assessment_response: str, caches: dict,
+                  assessment_key: str, counter: TokenCounter = None, nodes: dict = None) -> dict:
+    return {
+        'task': user_response.task_text,
+        'assessment': complete_assessment_response,
+        'cache_accuracy': caches['accuracy'],
+        'cache_knowledge': caches['knowledge'],
+        'cache_focus': caches['focus'],
+        'cache_independence': caches['independence'],
+        'cache_factuality': caches['factuality'],
+        'fingerprint': assessment_key,
+        'token_counts': counter.to_dict() if counter is not None else {},
+        'node_fingerprints': nodes or {}
+    }
+
+
+def save_summary(candidate_id: str, summary: dict):
+    save_assessment(candidate_id, summary)
+
+
+def read_legacy_summary(candidate_id: str) -> dict:
+    legacy_path = f"{legacy_summaries_dir}/{candidate_id}.json"
+    if not exists(legacy_path):
+        return None
+    with open(legacy_path, 'r') as file:
+        return json.loads(file.read())
+
+
+def load_summary(candidate_id: str) -> dict:
+    # the db is the source of truth, a legacy JSON file is imported on first read
+    summary = load_assessment(candidate_id)
+    if summary is None:
+        summary = read_legacy_summary(candidate_id)
+        if summary is not None:
+            save_summary(candidate_id, summary)
+    return summary
+
+
+_legacy_summaries_imported = False
+
+
+def import_legacy_summaries() -> int:
+    # one bulk import of all legacy JSON files which are not in the db yet, the directory is scanned once per process
+    global _legacy_summaries_imported
+    if _legacy_summaries_imported or not exists(legacy_summaries_dir):
+        _legacy_summaries_imported = True
+        return 0
+
+    known_ids = set(get_assessed_ids(include_rejected=True))
+    summaries = {}
+    for file_name in os.listdir(legacy_summaries_dir):
+        candidate_id = separate_id(file_name)
+        if file_name.endswith('.json') and candidate_id not in known_ids:
+            summaries[candidate_id] = read_legacy_summary(candidate_id)
+    save_assessments(summaries)
+    _legacy_summaries_imported = True
+    return len(summaries)
+
+
+_existing_videos_registered = False
+
+
+def register_existing_videos() -> int:
+    # videos copied into data/videos by hand enter the candidate manifest, the directory is scanned once per process,
+    # uploaded videos are added as they arrive, see uploads.register_video
+    global _existing_videos_registered
+    if _existing_videos_registered or not exists(videos_dir):
+        _existing_videos_registered = True
+        return 0
+
+    with os.scandir(videos_dir) as entries:
+        video_paths = {separate_id(entry.name): f"{videos_dir}/{entry.name}" for entry in entries if entry.is_file()}
+    added = advance_candidates(list(video_paths), UPLOADED, video_paths)
+    _existing_videos_registered = True
+    return added
+
+
+def get_cached_summary(user_response: StandardTaskResponse, assessment_key: str) -> dict:
+    # returns the cached summary, and makes sure the stored assessment of the candidate matches it
+    summary = assessment_cache.get(assessment_key)
+    if summary is not None:
+        assessments_total.inc(source='cache')
+        candidate_id = get_candidate_id(user_response)
+        if get_assessment_fingerprint(candidate_id) != assessment_key:
+            save_summary(candidate_id, summary)
+    return summary
+
+
+def get_duplicate_assessment_key(task_text: str, transcript: str) -> str:
+    # identical transcripts of the same task get the same assessment, whichever video they come from
+    return fingerprint('assessment-transcript', transcript_text_hash(transcript), task_text, basic_model_name,
+                       master_model_name, assessment_prompts_fingerprint, *assessment_mode_parts())
+
+
+def get_duplicate_summary(user_response: StandardTaskResponse, transcript: str, assessment_key: str) -> dict:
+    summary = assessment_cache.get(get_duplicate_assessment_key(user_response.task_text, transcript))
+    if summary is None:
+        return None
+    assessments_total.inc(source='duplicate')
+    logger.info("Exact duplicate transcript, reusing its assessment: %s", get_candidate_id(user_response))
+    return {**summary, 'fingerprint': assessment_key}
+
+
+def store_summary(user_response: StandardTaskResponse, transcript: str, summary: dict, assessment_key: str):
+    assessment_cache.put(assessment_key, summary)
+    assessment_cache.put(get_duplicate_assessment_key(user_response.task_text, transcript), summary)
+    save_summary(get_candidate_id(user_response), summary)
+
+
+def index_transcript(user_response: StandardTaskResponse, transcript: str):
+    # the index is optional, a missing embedding model must not stop the assessment
+    candidate_id = get_candidate_id(user_response)
+    try:
+        with span('index', candidate_id):
+            near_duplicates = transcript_index.add(candidate_id, transcript)
+    except Exception as error:
+        logger.warning("Transcript not indexed: %s %r", candidate_id, error)
+        return
+    if near_duplicates:
+        logger.warning("Near-duplicate transcripts of %s (candidate, similarity): %s", candidate_id, near_duplicates)
+
+
+def build_screening_chain(limiter=None):
+    # None if no screening model is registered, the screening then stops after its free first tier
+    if not is_model_screening_enabled():
+        return None
+    llm = limited_llm(get_screening_llm(), screening_model_name, limiter, stage='screening')
+    return cached_llm(llm, get_screening_llm()) | output_parser
+
+
+def full_assessment_llm_calls(mode: str = None) -> int:
+    # the least llm calls of a full assessment: the claims, every criterion (a single call in the combined mode,
+    # without its fallbacks), the summary and the viability votes, mode: see assessment_mode
+    criterion_calls = len(criterion_prompts) if (mode or assessment_mode) == 'fanout' else 1
+    return criterion_calls + 2 + vote_min_votes
+
+
+# llm stages which are not part of the assessment of a candidate, timed by limited_llm under their own stage
+non_assessment_stages = {'screening', 'vote', 'comparison'}
+
+
+def estimate_llm_seconds() -> Optional[float]:
+    # the llm time of one full assessment, from the assessments so far in this process, None before the first one
+    model_names = {basic_model_name, master_model_name}
+    assessed = assessments_total.get(source='llm')
+    seconds = sum(value for suffix, (model_name, stage), _, value in llm_call_seconds.samples()
+                  if suffix == '_sum' and model_name in model_names and stage not in non_assessment_stages)
+    if not assessed or not seconds:
+        return None
+    return seconds / assessed
+
+
+def reject_screened(user_response: StandardTaskResponse, screening: ScreeningResult, assessment_key: str,
+                    counter: TokenCounter = None) -> dict:
+    # screened out candidates are stored and rejected right away, without any vote,
+    # their summaries are not cached, the screening is cheap, and its thresholds may change until the next run
+    candidate_id = get_candidate_id(user_response)
+    summary = build_summary(user_response, f"Screened out before the assessment: {screening.reason}.",
+                            empty_caches(), fingerprint('screened', assessment_key, screening_fingerprint()), counter)
+    save_summary(candidate_id, summary)
+    record_votes(candidate_id, [], 0, 1.0, False)
+    record_screened_out(screening, full_assessment_llm_calls(), estimate_llm_seconds())
+    assessments_total.inc(source='screening')
+    logger.info("Screened out: %s %s (tier %s, %s)", candidate_id, screening.reason, screening.tier,
+                screening.measurements)
+    return summary
+
+
+def index_transcripts(transcripts: dict):
+    # transcripts: StandardTaskResponse -> transcript, the whole batch is embedded at once, with its tasks,
+    # so that the embedding model isn't needed again until the next batch, see batch.ResidencyLimiter,
+    # near duplicates are only found among the transcripts indexed before the batch
+    try:
+        with span('index'):
+            near_duplicates = transcript_index.add_many({get_candidate_id(user_response): transcript
+                                                         for user_response, transcript in transcripts.items()})
+            if screening_enabled:
+                embed_tasks([user_response.task_text for user_response in transcripts])
+    except Exception as error:
+        logger.warning("Transcripts not indexed: %r", error)
+        return
+    for candidate_id, duplicates in near_duplicates.items():
+        if duplicates:
+            logger.warning("Near-duplicate transcripts of %s (candidate, similarity): %s", candidate_id, duplicates)
+
+
+def get_reusable_results(user_response: StandardTaskResponse, nodes: dict) -> dict:
+    # criterion -> response of the stored assessment of the candidate whose node is still fresh,
+    # 'summary' -> the master summary if it's fresh as well, nothing has to be recomputed then
+    candidate_id = get_candidate_id(user_response)
+    previous = load_summary(candidate_id)
+    previous_nodes = (previous or {}).get('node_fingerprints') or {}
+    if not previous_nodes:
+        return {}
+    reuse = {criterion: previous[f"cache_{criterion}"] for criterion in criterion_prompts
+             if previous_nodes.get(criterion) == nodes[criterion] and f"cache_{criterion}" in previous}
+    if previous_nodes.get('summary') == nodes['summary']:
+        reuse['summary'] = previous['assessment']
+    stale = [node for node, node_fingerprint in nodes.items() if previous_nodes.get(node) != node_fingerprint]
+    if reuse:
+        logger.info("Re-assessing %s, stale nodes: %s", candidate_id, stale or None)
+    return reuse
+
+
+def publish_summary(events, summary: dict):
+    # the results of an assessment which didn't run through the chain (cached, reused, screened out), at once
+    if events is None:
+        return
+    for criterion in criterion_prompts:
+        events(RESULT, criterion, summary.get(f"cache_{criterion}"))
+    events(RESULT, 'summary', summary['assessment'])
+
+
+def is_assessment_cached(user_response: StandardTaskResponse) -> bool:
+    return get_assessment_key(user_response) in assessment_cache
+
+
+def generate_response_summarization(user_response: StandardTaskResponse, overwrite: bool = False):
+    # results are cached by content, see get_assessment_key, overwrite forces the whole assessment to rerun
+    assessment_key = get_assessment_key(user_response)
+    summary = None if overwrite else get_cached_summary(user_response, assessment_key)
+
+    if summary is None:
+        transcript = user_response.get_transcript()
+        index_transcript(user_response, transcript)
+        summary = None if overwrite else get_duplicate_summary(user_response, transcript, assessment_key)
+
+        if summary is None:
+            candidate_id = get_candidate_id(user_response)
+            counter = TokenCounter()
+            # only candidates which pass the cheap screening go on to the full assessment, see screening.py
+            user_response.screening = screen(user_response.task_text, transcript, candidate_id,
+                                             user_response.video_path, build_screening_chain(), counter)
+            if not user_response.screening.passed:
+                return reject_screened(user_response, user_response.screening, assessment_key, counter)['assessment']
+
+            # only the nodes whose prompt, model or inputs changed since the stored assessment are recomputed
+            nodes = node_fingerprints(user_response)
+            reuse = {} if overwrite else get_reusable_results(user_response, nodes)
+            caches = empty_caches()
+            standard_input = {'task': user_response.task_text, 'input': transcript}
+            if 'summary' in reuse:
+                caches.update(reuse)
+                complete_assessment_response = reuse['summary']
+            else:
+                complete_assessment_response = build_assessment_chain(
+                    caches, counter=counter, candidate_id=candidate_id, reuse=reuse).invoke(standard_input)
+            summary = build_summary(user_response, complete_assessment_response, caches, assessment_key, counter,
+                                    nodes)
+            assessments_total.inc(source='reuse' if 'summary' in reuse else 'llm')
+        # Save results to the cache and the db
+        store_summary(user_response, transcript, summary, assessment_key)
+
+    complete_assessment_response = summary['assessment']
+    logger.debug("Complete assessment response: %s", complete_assessment_response)
+
+    return complete_assessment_response
+
+
+async def agenerate_response_summarization(user_response: StandardTaskResponse, overwrite: bool = False,
+                                           limiter=None, events=None):
+    # async counterpart of generate_response_summarization, all four criteria run concurrently,
+    # and every llm call waits for a free slot of its model in the limiter (see batch.py),
+    # events(kind, stage, text) follows the progress, see build_assessment_chain and streams.py
+    loop = asyncio.get_running_loop()
+    # hashing the video is blocking, keep it off the event loop
+    assessment_key = await loop.run_in_executor(None, get_assessment_key, user_response)
+    summary = None if overwrite else await loop.run_in_executor(None, get_cached_summary, user_response,
+                                                                assessment_key)
+    chained = False  # the chain publishes its events as it runs, summaries from anywhere else are published at once
+
+    if summary is None:
+        # transcription runs in the worker pool, the event loop only waits for its future
+        transcript = await asyncio.wrap_future(user_response.request_transcript())
+        # embedding and the cache lookup are blocking as well
+        await loop.run_in_executor(None, index_transcript, user_response, transcript)
+        if not overwrite:
+            summary = await loop.run_in_executor(None, get_duplicate_summary, user_response, transcript,
+                                                 assessment_key)
+
+        if summary is None:
+            candidate_id = get_candidate_id(user_response)
+            counter = TokenCounter()
+            user_response.screening = await ascreen(user_response.task_text, transcript, candidate_id,
+                                                    user_response.video_path, build_screening_chain(limiter), counter)
+            if not user_response.screening.passed:
+                summary = await loop.run_in_executor(None, reject_screened, user_response, user_response.screening,
+                                                     assessment_key, counter)
+                publish_summary(events, summary)
+                return summary['assessment']
+
+            nodes = node_fingerprints(user_response)
+            reuse = {} if overwrite else await loop.run_in_executor(None, get_reusable_results, user_response, nodes)
+            caches = empty_caches()
+            standard_input = {'task': user_response.task_text, 'input': transcript}
+            if 'summary' in reuse:
+                caches.update(reuse)
+                complete_assessment_response = reuse['summary']
+            else:
+                complete_assessment_response = await build_assessment_chain(
+                    caches, limiter, counter, candidate_id, reuse=reuse, events=events).ainvoke(standard_input)
+                chained = True
+            summary = build_summary(user_response, complete_assessment_response, caches, assessment_key, counter,
+                                    nodes)
+            assessments_total.inc(source='reuse' if 'summary' in reuse else 'llm')
+        await loop.run_in_executor(None, store_summary, user_response, transcript, summary, assessment_key)
+    if not chained:
+        publish_summary(events, summary)
+
+    complete_assessment_response = summary['assessment']
+    logger.debug("Complete assessment response: %s", complete_assessment_response)
 
     return complete_assessment_response
 
 
-def is_candidate_viable(candidate_id: str, cycles: int = 3):
+filtering_prompt = ChatPromptTemplate.from_messages([
+    ("system", "You are a hiring manager."
+               "Your job is to determine if this candidate meets the minimum criteria."
+               "You are presented with summarized performance of this candidate."
+               "Candidate is good if he is truthful, and offers some potential."
+               "Candidate is bad when he lies, is incompetent or clueless."
+               "Respond with a GOOD or BAD response, DO NOT add any unnecessary text."
+               "Response has to be VERY VERY SHORT, reply with ONLY 'good' or 'bad'."),
+    ("user", "General candidate summary: ```{assessment}```"
+             "Candidate knowledge: ```{cache_knowledge}```"
+             "Candidate truthfulness: ```{cache_factuality}```")
+])
+
+
+def votes_fingerprint(nodes: dict) -> Optional[str]:
+    # the votes read the summary, knowledge and factuality, None for assessments without nodes (legacy, screened out)
+    if 'summary' not in nodes:
+        return None
+    return fingerprint('votes', prompt_fingerprint(filtering_prompt), basic_model_name, nodes['summary'],
+                       nodes['knowledge'], nodes['factuality'])
+
+
+def reopen_stale_votes() -> int:
+    # voted candidates whose votes no longer match their assessment are voted on again
+    stale = [candidate_id for candidate_id, nodes in get_node_fingerprints(FILTERED, REJECTED).items()
+             if votes_fingerprint(nodes) is not None and nodes.get('votes') != votes_fingerprint(nodes)]
+    if not stale:
+        return 0
+    reopened = reopen_candidates(stale)
+    logger.info("Votes of %s candidates are stale, voting again", reopened)
+    return reopened
+
+
+# early stop of the viability vote: once this many votes were cast and all of them agree, no more are cast
+vote_confidence = 1.0
+vote_min_votes = 2
+
+
+def is_candidate_viable(candidate_id: str, cycles: int = 3, max_wave_size: int = None,
+                        confidence: float = vote_confidence, min_votes: int = vote_min_votes, tenant: Tenant = None):
     # Input: filename (id)
     # Technically this algorithm is redundant to summary,
     # but it's very difficult to get both the final filtering response and the summary in one response reliably.
-    # Because of the simplicity of this response, and it's importance, this vote will be cast at least 5 times,
+    # Because of the simplicity of this response, and it's importance, up to cycles+1 votes will be cast,
     # the result will depend on the majority of vote.
     # For 99% of candidates, the vote will be unanimous, the rest is on the margin either way.
+    # Votes are cast in concurrent waves, and stop once the majority is settled or min_votes agree (see voting.py),
+    # so a unanimous candidate costs 2 llm calls instead of cycles+1. Use confidence=None to always settle the majority.
+    # The votes take the slots of the tenant's share of the fair_scheduler, see scheduler.py, the default company's
+    # if no tenant is given.
 
-    filtering_prompt = ChatPromptTemplate.from_messages([
-        ("system", "You are a hiring manager."
-                   "Your job is to determine if this candidate meets the minimum criteria."
-                   "You are presented with summarized performance of this candidate."
-                   "Candidate is good if he is truthful, and offers some potential."
-                   "Candidate is bad when he lies, is incompetent or clueless."
-                   "Respond with a GOOD or BAD response, DO NOT add any unnecessary text."
-                   "Response has to be VERY VERY SHORT, reply with ONLY 'good' or 'bad'."),
-        ("user", "General candidate summary: ```{assessment}```"
-                 "Candidate knowledge: ```{cache_knowledge}```"
-                 "Candidate truthfulness: ```{cache_factuality}```")
-    ])
-
+    # the votes are sampled and have to be independent, so they never go through the llm cache
     chain = (
         filtering_prompt |
-        basic_llm |
+        limited_llm(get_basic_llm(), basic_model_name, fair_scheduler, stage='vote') |
         output_parser
     )
 
-    # load candidate file
-    with open(f"data/summaries/{candidate_id}.json", 'r') as file:
-        # used: 'assessment', 'cache_knowledge', 'cache_factuality'
-        user_data_dict = json.loads(file.read())
-        print(f"{Fore.YELLOW}{Style.BRIGHT}user_file:{Fore.RESET}{Style.RESET_ALL}", user_data_dict)
+    # load candidate assessment
+    # used: 'assessment', 'cache_knowledge', 'cache_factuality'
+    user_data_dict = load_summary(candidate_id)
+    if user_data_dict is None:
+        raise KeyError(f"No assessment of candidate {candidate_id}")
+    logger.debug("user_file: %s", user_data_dict)
 
-    user_score = 0
+    async def vote() -> VoteResult:
+        current_tenant.set(tenant)
+        return await cast_votes(chain, user_data_dict, cycles + 1, max_wave_size, confidence, min_votes)
 
-    for _ in range(0, cycles+1):
-        vote_result = chain.invoke(user_data_dict).lower()
-        if 'good' in vote_result:
-            user_score += 1
-        if 'bad' in vote_result:
-            user_score -= 1
+    with span('votes', candidate_id):
+        vote_result = asyncio.run(vote())
+    viability_result = vote_result.viable
+    viability_verdicts.inc(viable=str(viability_result).lower())
+    # every vote and the verdict are kept, and the candidate moves to filtered or rejected in the manifest
+    record_votes(candidate_id, vote_result.votes, vote_result.score, vote_result.confidence, viability_result,
+                 votes_fingerprint(user_data_dict.get('node_fingerprints') or {}))
 
-    viability_result = True if user_score > 0 else False
-
-    print(f"{Fore.CYAN}{Style.BRIGHT}Candidate:{Fore.RESET}{Style.RESET_ALL}", candidate_id,
-          f"{Fore.CYAN}{Style.BRIGHT}viability:{Fore.RESET}{Style.RESET_ALL}", 'high' if viability_result else 'low',
-          f"{Fore.CYAN}{Style.BRIGHT}score:{Fore.RESET}{Style.RESET_ALL}", user_score)
+    logger.info("Candidate: %s viability: %s score: %s llm calls: %s", candidate_id,
+                'high' if viability_result else 'low', vote_result.score, vote_result.calls)
 
     return viability_result
 
 
 def get_raw_candidates() -> list:
-    # this one is useless for the classic pipeline without tasks being known any other way
-    return list(map(separate_id, os.listdir('data/videos')))
+    # every known candidate, whatever their state, see database.CandidateState
+    register_existing_videos()
+    import_legacy_summaries()
+    return get_candidates_in_state(*candidate_states)
 
 
 def get_summarized_candidates() -> list:
     # all unfiltered candidates
-    return list(map(separate_id, os.listdir('data/summaries')))
+    import_legacy_summaries()
+    return get_candidates_in_state(ASSESSED, FILTERED)
 
 
 def get_unprocessed_candidates() -> list:
     # NOTE: this function should only be used for UI if at all, caching is already done by the summarization function!!!
-    raw_list = get_raw_candidates()
-    sum_list = get_summarized_candidates()
-    diff_list = []
-    for candidate in raw_list:
-        if candidate not in sum_list:
-            diff_list.append(candidate)
-    return diff_list
-
-
-def summarize_candidates(task_list, overwrite: bool = False) -> int:
-    # todo: fix after db migration
-    candidate_list = get_raw_candidates()
-    summarized_count = 0
-    for candidate_id in candidate_list:
-        generate_response_summarization(task_list, overwrite)
+    register_existing_videos()
+    return get_candidates_in_state(UPLOADED, TRANSCRIBED)
+
+
+def summarize_candidates(response_list: list, overwrite: bool = False, limits: dict = None, job=None) -> int:
+    # Assess all given StandardTaskResponse objects concurrently, limits: model_name -> max parallel requests
+    # job (see jobs.py) is optional, it receives progress updates and can cancel the run
+    # the llm calls of each candidate are scheduled as its company's and batch's, see scheduler.py, candidates which
+    # aren't bound to a batch in the db are one batch per job
+    # todo: build the response list from the db after migration, tasks are not known any other way for now
+    from batch import assess_batch
+
+    if job is not None:
+        job.set_total(len(response_list))
+        on_start = job.item_started
+        on_result = lambda result: job.item_finished(result.succeeded)  # noqa: E731
+        cancel_event = job.cancel_event
+    else:
+        on_start = on_result = cancel_event = None
+
+    tenants = resolve_tenants([separate_id(user_response.video_path) for user_response in response_list],
+                              job.key if job is not None else hashid())
+    results = assess_batch(response_list, overwrite, limits, on_result=on_result, on_start=on_start,
+                           cancel_event=cancel_event, tenants=tenants)
+    summarized_count = len([result for result in results if result.succeeded])
 
-    print(f"{Fore.CYAN}{Style.BRIGHT}Performed summarization on all available candidates.{Fore.RESET}{Style.RESET_ALL}")
+    logger.info("Performed summarization on all available candidates.")
     return summarized_count
 
 
-def filter_summarized_candidates() -> int:
+def stream_assessment(video_path: str, task_text: str = None, overwrite: bool = False):
+    # the stream of the candidate's assessment in flight (e.g. in a batch job), see streams.py, or if there's none
+    # and task_text is given, of a new one started in the running event loop, None otherwise
+    stream = streams.stream_hub.get(separate_id(video_path))
+    if stream is None and task_text is not None:
+        from batch import start_streamed_assessment
+        stream = start_streamed_assessment(StandardTaskResponse(video_path, task_text), overwrite)
+    return stream
+
+
+def replay_assessment(candidate_id: str) -> Optional[streams.AssessmentStream]:
+    # the stored assessment of the candidate as a finished stream, its subscribers get all of it at once,
+    # None if the candidate wasn't assessed
+    summary = load_summary(candidate_id)
+    if summary is None:
+        return None
+    stream = streams.AssessmentStream(candidate_id)
+    publish_summary(stream.publish, summary)
+    stream.finish(summary['assessment'])
+    return stream
+
+
+def filter_summarized_candidates(job=None) -> int:
     # Filter any candidates who are not viable for specified position regardless of their relative attractiveness.
     # This function will eliminate any lying, clueless and unwilling to work candidates.
-    # This is why this function also takes care of physical filesystem interactions and not only opinion creation.
-    candidate_list = get_summarized_candidates()
+    # The verdict is stored with the assessment by is_candidate_viable, legacy JSON files are still moved aside.
+    # Only candidates which weren't voted on yet are pending, see database.CandidateState,
+    # and the ones whose assessment changed since their vote, see votes_fingerprint
+    # the votes are scheduled as each candidate's company and batch, as in summarize_candidates
+    import_legacy_summaries()
+    reopen_stale_votes()
+    candidate_list = get_candidates_in_state(ASSESSED)
+    tenants = resolve_tenants(candidate_list, job.key if job is not None else hashid())
     filtered_count = 0
+    if job is not None:
+        job.set_total(len(candidate_list))
+
     for candidate_id in candidate_list:
-        if not is_candidate_viable(candidate_id):
-            shutil.move(f"data/summaries/{candidate_id}", f"data/rejections/{candidate_id}")
-            filtered_count += 1
+        if job is not None:
+            if job.cancelled:
+                break
+            job.item_started(candidate_id)
+        try:
+            if not is_candidate_viable(candidate_id, tenant=tenants[candidate_id]):
+                legacy_path = f"{legacy_summaries_dir}/{candidate_id}.json"
+                if exists(legacy_path):
+                    os.makedirs('data/rejections', exist_ok=True)
+                    shutil.move(legacy_path, f"data/rejections/{candidate_id}.json")
+                filtered_count += 1
+        except Exception:
+            if job is None:
+                raise
+            job.item_finished(succeeded=False)
+        else:
+            if job is not None:
+                job.item_finished()
 
-    print(f"{Fore.CYAN}{Style.BRIGHT}Filtered{Fore.RESET}{Style.RESET_ALL}", filtered_count,
-          f"{Fore.CYAN}{Style.BRIGHT}candidates{Fore.RESET}{Style.RESET_ALL}")
+    logger.info("Filtered %s candidates", filtered_count)
     return filtered_count
@@ -0,0 +1,161 @@
+# This file is the audio pre-processing part of this project
+# Before whisper sees a video, its audio track is extracted once (mono, 16 kHz), non-speech is cut out,
+# and the result is cached in data/audio, next to a small report of how much audio was dropped.
+import json
+import os
+import subprocess
+import wave
+
+import numpy as np
+
+from cache import fingerprint, hash_file
+from metrics import get_logger
+
+from os.path import exists
+
+logger = get_logger('audio')
+
+SAMPLE_RATE = 16000  # what whisper expects
+
+# energy based speech detection, frames quieter than the noise floor + margin are considered non-speech
+frame_ms = 30
+speech_margin_db = 12.0  # above the estimated noise floor
+min_speech_db = -50.0  # frames quieter than this are never speech, regardless of the noise floor
+speech_padding_s = 0.3  # kept around each speech segment, so that word edges don't get cut
+min_silence_s = 1.0  # only silences longer than this are removed, natural pauses are kept
+
+
+def preprocessing_fingerprint() -> str:
+    # changes whenever the pre-processing would produce different audio, transcripts depend on it
+    return fingerprint(SAMPLE_RATE, frame_ms, speech_margin_db, min_speech_db, speech_padding_s, min_silence_s)
+
+
+class PreprocessResult:
+    audio_path: str
+    original_duration: float
+    kept_duration: float
+
+    def __init__(self, audio_path: str, original_duration: float, kept_duration: float):
+        self.audio_path = audio_path
+        self.original_duration = original_duration
+        self.kept_duration = kept_duration
+
+    @property
+    def dropped_duration(self) -> float:
+        return self.original_duration - self.kept_duration
+
+    @property
+    def dropped_ratio(self) -> float:
+        return self.dropped_duration / self.original_duration if self.original_duration else 0.0
+
+    def load(self) -> np.ndarray:
+        return read_wav(self.audio_path)
+
+    def to_dict(self) -> dict:
+        return {'audio_path': self.audio_path, 'original_duration': self.original_duration,
+                'kept_duration': self.kept_duration}
+
+    def __repr__(self) -> str:
+        return (f"PreprocessResult(audio_path={self.audio_path!r}, original_duration={self.original_duration:.2f}, "
+                f"kept_duration={self.kept_duration:.2f}, dropped_ratio={self.dropped_ratio:.2f})")
+
+
+def extract_audio(video_path: str) -> np.ndarray:
+    # decode only the audio stream (-vn), the video track is never decoded
+    command = ["ffmpeg", "-nostdin", "-threads", "0", "-i", video_path, "-vn",
+               "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(SAMPLE_RATE), "-"]
+    try:
+        output = subprocess.run(command, capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as error:
+        raise RuntimeError(f"Failed to extract audio from {video_path}: {error.stderr.decode()}") from error
+
+    return np.frombuffer(output, np.int16).flatten().astype(np.float32) / 32768.0
+
+
+def detect_speech(audio: np.ndarray) -> np.ndarray:
+    # returns a per-sample boolean mask of the audio which should be kept
+    frame_length = SAMPLE_RATE * frame_ms // 1000
+    frame_count = len(audio) // frame_length
+    if frame_count == 0:
+        return np.ones(len(audio), dtype=bool)
+
+    frames = audio[:frame_count * frame_length].reshape(frame_count, frame_length)
+    energy_db = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+    noise_floor_db = np.percentile(energy_db, 10)
+    speech = energy_db > max(noise_floor_db + speech_margin_db, min_speech_db)
+
+    # pad every speech frame on both sides
+    padding = int(speech_padding_s * 1000 / frame_ms)
+    if padding:
+        speech = np.convolve(speech.astype(np.int32), np.ones(2 * padding + 1, dtype=np.int32), 'same') > 0
+
+    # close gaps which are too short to be worth removing
+    min_silence_frames = int(min_silence_s * 1000 / frame_ms)
+    silence_start = None
+    for index in range(frame_count + 1):
+        is_silent = index < frame_count and not speech[index]
+        if is_silent and silence_start is None:
+            silence_start = index
+        elif not is_silent and silence_start is not None:
+            if index - silence_start < min_silence_frames:
+                speech[silence_start:index] = True
+            silence_start = None
+
+    mask = np.repeat(speech, frame_length)
+    # the trailing partial frame follows the last full frame
+    return np.concatenate([mask, np.full(len(audio) - len(mask), speech[-1])])
+
+
+def write_wav(path: str, audio: np.ndarray):
+    with wave.open(path, 'wb') as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(SAMPLE_RATE)
+        file.writeframes((np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16).tobytes())
+
+
+def read_wav(path: str) -> np.ndarray:
+    with wave.open(path, 'rb') as file:
+        return np.frombuffer(file.readframes(file.getnframes()), np.int16).astype(np.float32) / 32768.0
+
+
+def read_preprocess_report(video_path: str, cache_dir: str = 'data/audio') -> PreprocessResult:
+    # the cached pre-processing of the video, or None, never extracts anything
+    short_filename = video_path.split('.')[0].split('/')[-1]
+    audio_path = f"{cache_dir}/{short_filename}.wav"
+    report_path = f"{cache_dir}/{short_filename}.json"
+
+    if not exists(report_path) or not exists(audio_path) or not exists(video_path):
+        return None
+    with open(report_path, 'r') as file:
+        report = json.loads(file.read())
+    # the cache is only valid for the same video, pre-processed with the same parameters
+    if report.get('preprocessing') != preprocessing_fingerprint() or report.get('video_hash') != hash_file(video_path):
+        return None
+    return PreprocessResult(audio_path, report['original_duration'], report['kept_duration'])
+
+
+def preprocess_audio(video_path: str, cache_dir: str = 'data/audio') -> PreprocessResult:
+    cached = read_preprocess_report(video_path, cache_dir)
+    if cached is not None:
+        return cached
+    return save_preprocessed(video_path, extract_audio(video_path), cache_dir)
+
+
+def save_preprocessed(video_path: str, audio: np.ndarray, cache_dir: str = 'data/audio') -> PreprocessResult:
+    # audio: the extracted audio of the video, also used for audio demuxed while the video was uploaded, see ingest.py
+    short_filename = video_path.split('.')[0].split('/')[-1]
+    audio_path = f"{cache_dir}/{short_filename}.wav"
+    report_path = f"{cache_dir}/{short_filename}.json"
+    speech = audio[detect_speech(audio)]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    write_wav(audio_path, speech)
+    result = PreprocessResult(audio_path, len(audio) / SAMPLE_RATE, len(speech) / SAMPLE_RATE)
+    with open(report_path, 'w') as file:
+        file.write(json.dumps({**result.to_dict(), 'preprocessing': preprocessing_fingerprint(),
+                               'video_hash': hash_file(video_path)}))
+
+    logger.info("Audio pre-processing: %s kept %.1fs / %.1fs dropped %.0f%%", short_filename, result.kept_duration,
+                result.original_duration, result.dropped_ratio * 100)
+    return result
@@ -0,0 +1,341 @@
+# This file is the batch part of this project, it runs assessments of many candidates at once
+# Every llm call has to acquire a slot of its model first, so Ollama never gets more parallel requests than it serves.
+# Candidates are fed through a bounded queue, a failed candidate is recorded and does not stop the rest of the batch.
+import asyncio
+import contextvars
+import os
+import time
+
+from assessment import StandardTaskResponse, agenerate_response_summarization, separate_id, is_assessment_cached, \
+    full_assessment_llm_calls, estimate_llm_seconds, index_transcripts
+from metrics import get_logger, metrics_registry
+from streams import stream_hub, AssessmentStream
+from scheduler import default_llm_concurrency, llm_concurrency, fair_scheduler, current_tenant, current_priority, \
+    resolve_tenants, INTERACTIVE
+
+# 'pipelined' moves every candidate through all stages as soon as it can, 'by_model' runs the work of one model
+# across the whole batch before switching to the next one, for hosts which can only hold one model at a time
+batch_schedule = os.environ.get('SPEEDVUE_BATCH_SCHEDULE', 'pipelined')
+batch_schedules = ['pipelined', 'by_model']
+
+logger = get_logger('batch')
+candidate_seconds = metrics_registry.histogram('speedvue_candidate_seconds',
+                                               "Duration of the whole assessment of a candidate", ('result',))
+candidates_in_flight = metrics_registry.gauge('speedvue_candidates_in_flight', "Candidates being assessed")
+batch_queue_depth = metrics_registry.gauge('speedvue_batch_queue_depth',
+                                           "Candidates waiting for a free assessment worker")
+model_switches = metrics_registry.counter('speedvue_model_switches_total',
+                                          "Switches of the resident model by the batch scheduler, by the new model",
+                                          ('model',))
+model_swaps_avoided = metrics_registry.counter('speedvue_model_swaps_avoided_total',
+                                               "Model switches avoided by the batch scheduler, compared to "
+                                               "assessing the candidates one after another")
+# the candidate whose assessment runs in this task, the tasks of its chain inherit it
+current_candidate = contextvars.ContextVar('current_candidate', default=None)
+# assessments started by clients of the stream endpoint run on the server's event loop, see start_streamed_assessment
+_streamed_tasks = set()
+
+
+class ModelLimiter:
+    # per-model concurrency cap, semaphores are created lazily, so that they're bound to the running event loop
+    def __init__(self, limits: dict = None, default_limit: int = default_llm_concurrency):
+        self.limits = dict(llm_concurrency if limits is None else limits)
+        self.default_limit = default_limit
+        self._semaphores = {}
+
+    def limit(self, model_name: str) -> int:
+        return self.limits.get(model_name, self.default_limit)
+
+    def slot(self, model_name: str) -> asyncio.Semaphore:
+        if model_name not in self._semaphores:
+            self._semaphores[model_name] = asyncio.Semaphore(self.limit(model_name))
+        return self._semaphores[model_name]
+
+
+class ResidencySlot:
+    # the semaphore interface limited_llm expects, for a single model of a ResidencyLimiter
+    def __init__(self, limiter, model_name: str):
+        self.limiter = limiter
+        self.model_name = model_name
+
+        self.capacity_slot = None
+
+    async def acquire(self):
+        self.capacity_slot = await self.limiter.acquire(self.model_name)
+
+    def release(self):
+        self.limiter.release(self.model_name, self.capacity_slot)
+
+
+class ResidencyLimiter(ModelLimiter):
+    # on top of the per-model cap, only one model is resident at a time: requests of the other models wait until
+    # every queued and running request of the resident model is done, then the model with the most waiting
+    # requests becomes resident. Within one candidate the models are always used in the same order (screening,
+    # basic, master), so the wait can't go in circles.
+    # capacity: the limiter whose slots the resident model's requests take, e.g. the shared fair_scheduler,
+    # its own semaphores by default
+    def __init__(self, limits: dict = None, default_limit: int = default_llm_concurrency, capacity=None):
+        super().__init__(limits, default_limit)
+        self.capacity = capacity
+        self.resident_model = None
+        self.switches = 0
+        self.candidate_switches = 0  # changes of the model within the chain of each candidate
+        self._candidate_models = {}  # candidate id -> model of its last request
+        self._running = 0  # requests of the resident model, waiting for its semaphore or answered
+        self._waiting = {}  # model_name -> requests waiting for their model to become resident
+        self._condition = None
+
+    def _can_enter(self, model_name: str) -> bool:
+        if self.resident_model in (None, model_name):
+            return True
+        if self._running or self._waiting.get(self.resident_model):
+            return False
+        # the resident model is drained, the model with the most waiting requests goes next
+        return model_name == max(self._waiting, key=lambda name: self._waiting[name])
+
+    async def acquire(self, model_name: str):
+        # returns the slot of the capacity to release
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        candidate_id = current_candidate.get()
+        if candidate_id is not None:
+            if self._candidate_models.get(candidate_id, model_name) != model_name:
+                self.candidate_switches += 1
+            self._candidate_models[candidate_id] = model_name
+
+        async with self._condition:
+            self._waiting[model_name] = self._waiting.get(model_name, 0) + 1
+            await self._condition.wait_for(lambda: self._can_enter(model_name))
+            self._waiting[model_name] -= 1
+            if not self._waiting[model_name]:
+                del self._waiting[model_name]
+            if self.resident_model != model_name:
+                if self.resident_model is not None:
+                    self.switches += 1
+                    model_switches.inc(model=model_name)
+                    logger.info("Switching the resident model to %s, %s requests of it waiting", model_name,
+                                self._waiting.get(model_name, 0) + 1)
+                self.resident_model = model_name
+            self._running += 1
+        capacity_slot = self.capacity.slot(model_name) if self.capacity is not None else super().slot(model_name)
+        await capacity_slot.acquire()
+        return capacity_slot
+
+    def release(self, model_name: str, capacity_slot):
+        capacity_slot.release()
+        self._running -= 1
+        if not self._running:
+            # wakes up the waiting models, release is called from the event loop, not awaited
+            asyncio.ensure_future(self._notify())
+
+    async def _notify(self):
+        async with self._condition:
+            self._condition.notify_all()
+
+    def slot(self, model_name: str) -> ResidencySlot:
+        return ResidencySlot(self, model_name)
+
+    @property
+    def swaps_avoided(self) -> int:
+        # assessed one after another, every change of the model within a candidate is a switch,
+        # and so is the switch back for the next candidate
+        return max(0, 2 * self.candidate_switches - self.switches)
+
+
+class CandidateResult:
+    candidate_id: str
+    assessment: str = None
+    error: Exception = None
+    duration: float = 0.0
+    screened_out: bool = False  # rejected by the screening, before any of the assessment llm calls
+
+    def __init__(self, candidate_id: str, assessment: str = None, error: Exception = None, duration: float = 0.0,
+                 screened_out: bool = False):
+        self.candidate_id = candidate_id
+        self.assessment = assessment
+        self.error = error
+        self.duration = duration
+        self.screened_out = screened_out
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
+
+    def __repr__(self) -> str:
+        return (f"CandidateResult(candidate_id={self.candidate_id!r}, succeeded={self.succeeded!r}, "
+                f"error={self.error!r}, duration={self.duration:.2f}, screened_out={self.screened_out!r})")
+
+
+async def assess_batch_async(response_list: list, overwrite: bool = False, limiter: ModelLimiter = None,
+                             max_in_flight: int = None, on_result=None, on_start=None, cancel_event=None,
+                             schedule: str = None, tenants: dict = None) -> list:
+    # on_start(candidate_id) is called when a candidate is picked up,
+    # on_result(CandidateResult) as soon as it finishes, successfully or not.
+    # Once cancel_event (threading.Event) is set, candidates in flight finish, but no new ones are started.
+    # schedule: see batch_schedule, by_model needs a ResidencyLimiter, one is created if the limiter isn't one
+    # tenants: candidate id -> scheduler.Tenant, whose share of the fair_scheduler the llm calls of the candidate take
+    schedule = schedule or batch_schedule
+    if schedule not in batch_schedules:
+        raise ValueError(f"Unknown batch schedule: {schedule}, expected one of {batch_schedules}")
+    limiter = limiter or ModelLimiter()
+    if schedule == 'by_model' and not isinstance(limiter, ResidencyLimiter):
+        limiter = ResidencyLimiter(limiter.limits, limiter.default_limit, capacity=limiter)
+    if max_in_flight is None:
+        # keep a few candidates waiting on the semaphores, so a model never idles between two candidates,
+        # grouping by model needs the whole batch in flight, or the next candidates would wait for the last model
+        max_in_flight = (len(response_list) or 1) if schedule == 'by_model' else \
+            2 * max([limiter.default_limit] + list(limiter.limits.values()))
+
+    # backpressure: the producer blocks when the queue is full, so only a bounded amount of work is ever pending
+    queue = asyncio.Queue(maxsize=max_in_flight)
+    results = []
+
+    async def assess_one(user_response: StandardTaskResponse) -> CandidateResult:
+        candidate_id = separate_id(user_response.video_path)
+        start = time.perf_counter()
+        current_candidate.set(candidate_id)
+        if tenants is not None:
+            current_tenant.set(tenants.get(candidate_id))
+        try:
+            with candidates_in_flight.track():
+                assessment = await run_streamed(user_response, overwrite, limiter)
+            screened_out = user_response.screening is not None and not user_response.screening.passed
+            result = CandidateResult(candidate_id, assessment=assessment, duration=time.perf_counter() - start,
+                                     screened_out=screened_out)
+        except Exception as error:  # one broken chain must not take down the whole batch
+            result = CandidateResult(candidate_id, error=error, duration=time.perf_counter() - start)
+            logger.error("Assessment failed: %s %r", candidate_id, error)
+        candidate_seconds.observe(result.duration, result='succeeded' if result.succeeded else 'failed')
+        return result
+
+    async def worker():
+        while True:
+            user_response = await queue.get()
+            try:
+                if user_response is None:
+                    return
+                batch_queue_depth.dec()
+                if cancel_event is not None and cancel_event.is_set():
+                    continue
+                if on_start is not None:
+                    on_start(separate_id(user_response.video_path))
+                result = await assess_one(user_response)
+                results.append(result)
+                if on_result is not None:
+                    on_result(result)
+            finally:
+                queue.task_done()
+
+    # transcription is the slowest stage and does not touch the llm, so all of it is queued up-front,
+    # the transcription pool then works ahead of the llm stages instead of waiting for the queue
+    def request_missing_transcripts() -> list:
+        pending = [user_response for user_response in response_list
+                   if overwrite or not is_assessment_cached(user_response)]
+        for user_response in pending:
+            user_response.request_transcript()
+        return pending
+
+    # hashing the videos for the cache lookup is blocking, keep it off the event loop
+    loop = asyncio.get_running_loop()
+    pending = await loop.run_in_executor(None, request_missing_transcripts)
+    if schedule == 'by_model':
+        # whisper, then the embedding model, each for the whole batch, before any llm, failed transcripts are
+        # left to the assessment, which records the failure
+        transcripts = await asyncio.gather(*(asyncio.wrap_future(user_response.request_transcript())
+                                             for user_response in pending), return_exceptions=True)
+        await loop.run_in_executor(None, index_transcripts, {
+            user_response: transcript for user_response, transcript in zip(pending, transcripts)
+            if not isinstance(transcript, BaseException)})
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(max_in_flight)]
+    for user_response in response_list:
+        if cancel_event is not None and cancel_event.is_set():
+            break
+        batch_queue_depth.inc()
+        await queue.put(user_response)
+    for _ in workers:
+        await queue.put(None)
+    await asyncio.gather(*workers)
+
+    if isinstance(limiter, ResidencyLimiter) and limiter.candidate_switches:
+        model_swaps_avoided.inc(limiter.swaps_avoided)
+        logger.info("Resident model switched %s times, avoided %s switches", limiter.switches, limiter.swaps_avoided)
+    return results
+
+
+async def run_streamed(user_response: StandardTaskResponse, overwrite: bool = False,
+                       limiter: ModelLimiter = None) -> str:
+    # runs the assessment and publishes its progress, see streams.py, if the candidate is already being assessed
+    # (by another batch, or for a client of the stream endpoint), its result is awaited instead
+    stream, created = stream_hub.open(separate_id(user_response.video_path))
+    if not created:
+        logger.info("Assessment of %s already in flight, waiting for it", stream.candidate_id)
+        return await stream.result()
+    return await publish_assessment(stream, user_response, overwrite, limiter)
+
+
+async def publish_assessment(stream: AssessmentStream, user_response: StandardTaskResponse, overwrite: bool = False,
+                             limiter: ModelLimiter = None) -> str:
+    try:
+        assessment = await agenerate_response_summarization(user_response, overwrite, limiter, stream.publish)
+    except BaseException as error:
+        stream_hub.close(stream, error=error)
+        raise
+    stream_hub.close(stream, assessment)
+    return assessment
+
+
+def start_streamed_assessment(user_response: StandardTaskResponse, overwrite: bool = False,
+                              limiter: ModelLimiter = None) -> AssessmentStream:
+    # the stream of the candidate's assessment, started in the running event loop unless it's already in flight,
+    # the assessment goes on when its clients disconnect, its result is stored as any other
+    stream, created = stream_hub.open(separate_id(user_response.video_path))
+    if not created:
+        return stream
+    if limiter is None:
+        limiter = fair_scheduler
+
+    async def run():
+        # a client is waiting for this one, it goes before the bulk work of every tenant, within its tenant's share
+        current_priority.set(INTERACTIVE)
+        try:
+            tenants = await asyncio.get_running_loop().run_in_executor(None, resolve_tenants, [stream.candidate_id])
+            current_tenant.set(tenants[stream.candidate_id])
+            await publish_assessment(stream, user_response, overwrite, limiter)
+        except Exception as error:
+            stream_hub.close(stream, error=error)  # already closed, unless the tenant couldn't be looked up
+            logger.error("Streamed assessment failed: %s %r", stream.candidate_id, error)
+
+    task = asyncio.ensure_future(run())
+    _streamed_tasks.add(task)
+    task.add_done_callback(_streamed_tasks.discard)
+    return stream
+
+
+def assess_batch(response_list: list, overwrite: bool = False, limits: dict = None, max_in_flight: int = None,
+                 on_result=None, on_start=None, cancel_event=None, schedule: str = None,
+                 tenants: dict = None) -> list:
+    # blocking entry point, must not be called from a running event loop,
+    # the llm calls share the fair_scheduler with every other batch and client, unless limits are given
+    start = time.perf_counter()
+    limiter = ModelLimiter(limits) if limits is not None else fair_scheduler
+    results = asyncio.run(assess_batch_async(response_list, overwrite, limiter, max_in_flight, on_result, on_start,
+                                             cancel_event, schedule, tenants))
+    failed_count = len([result for result in results if not result.succeeded])
+
+    logger.info("Assessed %s candidates, failed: %s in %.2fs", len(results) - failed_count, failed_count,
+                time.perf_counter() - start)
+    report_screening(results)
+    return results
+
+
+def report_screening(results: list):
+    # what the screening saved in this batch, the llm time is estimated from the fully assessed candidates so far
+    screened_count = len([result for result in results if result.screened_out])
+    if not screened_count:
+        return
+    llm_seconds = estimate_llm_seconds()
+    saved_time = f"about {screened_count * llm_seconds:.1f}s of llm time" if llm_seconds is not None else \
+        "an unknown llm time, no candidate was fully assessed yet"
+    logger.info("Screening ruled out %s of %s candidates, saving %s llm calls and %s", screened_count, len(results),
+                screened_count * full_assessment_llm_calls(), saved_time)
@@ -0,0 +1,98 @@
+# Query count of loading a whole batch (applications, applicants, responses, assessments) as the batch grows,
+# queries.load_batch against walking the ORM relationships lazily.
+# Runs against an in-memory SQLite database: python benchmarks/batch_loading.py [sizes...]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event, insert, select
+
+import database
+from database import Company, Batch, Recruiter, Applicant, Application, Response, Assessment, hashid
+from queries import load_batch
+
+default_sizes = [10, 100, 500, 2000]
+responses_per_application = 3
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self.on_execute)
+
+    def on_execute(self, *_):
+        self.count += 1
+
+
+def create_batch(session, size: int) -> str:
+    company_id, batch_id = hashid(), hashid()
+    session.execute(insert(Company), [{'id': company_id, 'name': f"company {size}"}])
+    session.execute(insert(Batch), [{'id': batch_id, 'company_id': company_id, 'job_title': 'engineer',
+                                     'description': f"{size} applications"}])
+    recruiters = [{'id': hashid(), 'company_id': company_id, 'name': 'name', 'surname': 'surname', 'title': 'hr',
+                   'email': 'hr@example.com', 'country': 'country', 'city': 'city'} for _ in range(2)]
+    session.execute(insert(Recruiter), recruiters)
+    session.execute(insert(database.association_table), [{'batch_id': batch_id, 'recruiter_id': recruiter['id']}
+                                                          for recruiter in recruiters])
+
+    applicants, applications, responses, assessments = [], [], [], []
+    for _ in range(size):
+        applicant_id, application_id = hashid(), hashid()
+        applicants.append({'id': applicant_id, 'name': 'name', 'surname': 'surname', 'email': 'a@example.com',
+                           'phone': '123456789', 'phone_country_code': '48', 'phone_extension': '',
+                           'country': 'country', 'city': 'city', 'address': 'address'})
+        applications.append({'id': application_id, 'batch_id': batch_id, 'applicant_id': applicant_id})
+        for _ in range(responses_per_application):
+            response_id = hashid()
+            responses.append({'id': response_id, 'application_id': application_id, 'task_text': 'task'})
+            assessments.append({'id': hashid(), 'response_id': response_id, 'fingerprint': hashid(),
+                                'task_text': 'task', 'summary': 'summary', 'token_counts': {}})
+    session.execute(insert(Applicant), applicants)
+    session.execute(insert(Application), applications)
+    session.execute(insert(Response), responses)
+    session.execute(insert(Assessment), assessments)
+    return batch_id
+
+
+def walk_lazily(session, batch_id: str) -> int:
+    # what a naive dashboard does, every relationship access is a query of its own
+    batch = session.scalars(select(Batch).where(Batch.id == batch_id)).one()
+    items = len(batch.recruiters) + len(batch.company.name)
+    for application in batch.applications:
+        items += len(application.applicant.name)
+        for response in application.responses:
+            items += 1 if response.assessment is not None else 0
+    return items
+
+
+def run(sizes: list):
+    engine = database.get_engine('sqlite://')
+    counter = QueryCounter(engine)
+
+    print(f"{'applications':>12} {'load_batch queries':>19} {'load_batch ms':>14} {'lazy queries':>13} "
+          f"{'lazy ms':>9}")
+    for size in sizes:
+        with database.get_session() as session, session.begin():
+            batch_id = create_batch(session, size)
+
+        counter.count = 0
+        start = time.perf_counter()
+        batch = load_batch(batch_id)
+        eager_ms = (time.perf_counter() - start) * 1000
+        eager_queries = counter.count
+        assert len(batch.applications) == size
+
+        with database.get_session() as session:
+            counter.count = 0
+            start = time.perf_counter()
+            walk_lazily(session, batch_id)
+            lazy_ms = (time.perf_counter() - start) * 1000
+            lazy_queries = counter.count
+
+        print(f"{size:>12} {eager_queries:>19} {eager_ms:>14.1f} {lazy_queries:>13} {lazy_ms:>9.1f}")
+
+
+if __name__ == "__main__":
+    run([int(size) for size in sys.argv[1:]] or default_sizes)
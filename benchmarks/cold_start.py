@@ -0,0 +1,91 @@
+# Cold start of a server process (see models.py): the time and resident memory of importing assessment,
+# which every api worker does, and of the first use of each model of the registry, what the import used to pay
+# up front. Runs the real libraries, each tree in fresh processes, an older commit is compared from a checkout:
+# git worktree add /tmp/before <commit> && python benchmarks/cold_start.py --tree /tmp/before --tree .
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+heavy_modules = ['torch', 'whisper', 'tiktoken', 'langchain_community.llms.ollama']
+
+
+def rss_mb() -> float:
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def run_child(tree: str, module: str) -> dict:
+    os.chdir(tree)
+    sys.path.insert(0, tree)
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    __import__(module)
+    report = {'import_seconds': time.perf_counter() - start, 'import_rss_mb': rss_mb() - rss_before,
+              'loaded': [name for name in heavy_modules if name in sys.modules], 'models': {}}
+
+    # trees from before the registry loaded every model in the import above
+    if 'models' in sys.modules and hasattr(sys.modules['models'], 'model_registry'):
+        registry = sys.modules['models'].model_registry
+        for name in registry.names():
+            rss_before = rss_mb()
+            start = time.perf_counter()
+            try:
+                registry.get(name)
+                error = None
+            except Exception as exception:
+                error = f"{type(exception).__name__}: {str(exception).splitlines()[0][:80]}"
+            report['models'][name] = {'seconds': time.perf_counter() - start, 'rss_mb': rss_mb() - rss_before,
+                                      'error': error}
+    report['rss_mb'] = rss_mb()
+    return report
+
+
+def run_tree(tree: str, module: str, runs: int):
+    reports = []
+    for _ in range(runs):
+        command = [sys.executable, os.path.abspath(__file__), '--child', tree, '--module', module]
+        finished = subprocess.run(command, capture_output=True, text=True,
+                                  env={**os.environ, 'SPEEDVUE_LOG_LEVEL': 'WARNING'})
+        if finished.returncode != 0:
+            print(f"{tree}: importing {module} failed, {finished.stderr.strip().splitlines()[-1]}")
+            return
+        reports.append(json.loads(finished.stdout.strip().splitlines()[-1]))
+
+    import_seconds = statistics.median(report['import_seconds'] for report in reports)
+    import_rss = statistics.median(report['import_rss_mb'] for report in reports)
+    print(f"{tree}: import {module} {import_seconds:.3f}s, +{import_rss:.1f} MB resident "
+          f"(median of {runs}), loads {', '.join(reports[0]['loaded']) or 'no model library'}")
+    for name in reports[0]['models']:
+        seconds = statistics.median(report['models'][name]['seconds'] for report in reports)
+        rss = statistics.median(report['models'][name]['rss_mb'] for report in reports)
+        error = reports[0]['models'][name]['error']
+        print(f"  first use of {name:<20} {seconds:7.3f}s, +{rss:6.1f} MB" + (f", failed: {error}" if error else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start time and memory of importing the assessment")
+    parser.add_argument('--tree', action='append', default=None, help="checkout to measure, repeatable")
+    parser.add_argument('--module', default='assessment', help="module a server process imports")
+    parser.add_argument('--runs', type=int, default=5, help="fresh processes per tree")
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(run_child(args.child, args.module)))
+        return
+
+    for tree in args.tree or [repo_root]:
+        run_tree(os.path.abspath(tree), args.module, args.runs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,404 @@
+# Deterministic stand-ins for every model of the pipeline, with a configurable latency.
+# They are installed through the model registry, the pipeline code runs unchanged, only no Ollama, whisper or GPU
+# is needed. Answers depend only on the prompt, so runs are repeatable, and every call is recorded per stage.
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, List, Optional
+
+import numpy as np
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+
+# prompts are recognized by a phrase only they contain, see assessment.py, factcheck.py, tokens.py and ranking.py
+STAGE_MARKERS = [
+    ('screening', "genuine attempt to answer"),
+    ('combined', "on every criterion at once"),
+    ('claims', "fact checking assistant"),
+    ('reduce', "judged separately on"),
+    ('knowledge', "judge knowledge"),
+    ('focus', "judge focus"),
+    ('independence', "judge independence"),
+    ('factuality', "judge factuality"),
+    ('accuracy', "judge accuracy"),
+    ('summary', "summarize eligibility"),
+    ('vote', "GOOD or BAD"),
+    ('comparison', "FIRST or SECOND"),
+]
+
+CRITERIA = ['accuracy', 'knowledge', 'focus', 'independence', 'factuality']
+
+# facts the fake claim extractor picks from, the same ones come up for many candidates, as in real batches
+CLAIM_POOL = [
+    "Python is a programming language created by Guido van Rossum",
+    "PostgreSQL is an open source relational database",
+    "Kubernetes orchestrates containers across clusters of machines",
+    "React is a JavaScript library for building user interfaces",
+    "Git is a distributed version control system",
+    "TCP guarantees ordered delivery of packets",
+    "Rust prevents data races at compile time",
+    "Linux is an open source operating system kernel",
+    "Docker packages applications into containers",
+    "Redis keeps its data in memory",
+    "HTTP is a stateless protocol",
+    "SQL databases use indexes to speed up lookups",
+]
+
+WORD_POOL = ("project team python database deploy customer deadline bug feature release design review test "
+             "performance cloud server api learn mentor lead refactor migrate scale monitor incident fix ship "
+             "product user data model pipeline cache queue latency throughput budget estimate plan").split()
+# spoken english is about half stopwords, the screening checks for them, see screening.py
+FILLER_POOL = "i the and we to of a it was that so in my you is on with for".split()
+# words of the benchmark tasks, every answer uses some of them, so the answers are related to the tasks
+TASK_POOL = "project team database problem work solution".split()
+# the first bytes of a synthetic video choose a response the screening should rule out
+NON_ANSWERS = {b'short': "Sorry, I have to go.", b'loop': "Thank you. " * 150}
+# synthetic speech, see speech_audio: every spoken word is a run of this many samples of the same value (0.4s)
+SPEECH_WORD_SAMPLES = 6400
+
+
+def stable_hash(text: str) -> int:
+    return int(hashlib.sha256(text.encode()).hexdigest()[:12], 16)
+
+
+def prompt_stage(prompt: str) -> str:
+    for stage, marker in STAGE_MARKERS:
+        if marker in prompt:
+            return stage
+    return 'other'
+
+
+def speech_audio(word_count: int, seed: int = 0) -> np.ndarray:
+    # int16 "audio" of word_count words, the fake transcriber reads every complete run of samples as a word of
+    # WORD_POOL, runs cut by the edge of a window are missed, as whisper misses words cut in half
+    generator = random.Random(seed)
+    values = []
+    for _ in range(word_count):
+        # neighbouring words differ, so that their runs can be told apart
+        values.append(generator.choice([index for index in range(1, len(WORD_POOL) + 1)
+                                        if not values or index != values[-1]]))
+    return np.repeat(np.array(values, dtype=np.int16), SPEECH_WORD_SAMPLES)
+
+
+def read_speech(samples: np.ndarray) -> str:
+    values = np.round(np.asarray(samples) * 32768.0).astype(np.int32) if samples.dtype != np.int16 else samples
+    if not len(values):
+        return ""
+    starts = np.flatnonzero(np.diff(values)) + 1
+    bounds = zip(np.concatenate([[0], starts]), np.concatenate([starts, [len(values)]]))
+    return ' '.join(WORD_POOL[values[start] - 1] for start, end in bounds
+                    if end - start == SPEECH_WORD_SAMPLES and 0 < values[start] <= len(WORD_POOL))
+
+
+class CallRecorder:
+    # stage -> [seconds], the wall time of every llm call, thread-safe
+    def __init__(self):
+        self.durations = {}
+        self.prompt_chars = {}
+        self.swaps = 0  # of the model loaded on the ModelHost
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float, prompt: str):
+        with self._lock:
+            self.durations.setdefault(stage, []).append(seconds)
+            self.prompt_chars[stage] = self.prompt_chars.get(stage, 0) + len(prompt)
+
+    def record_swap(self):
+        with self._lock:
+            self.swaps += 1
+
+    def reset(self):
+        with self._lock:
+            self.durations = {}
+            self.prompt_chars = {}
+            self.swaps = 0
+
+
+class ModelHost:
+    # an ollama host with memory for a single llm, a call of another model than the loaded one costs swap_latency
+    def __init__(self, swap_latency: float = 0.0, recorder: CallRecorder = None):
+        self.swap_latency = swap_latency
+        self.recorder = recorder
+        self.loaded_model = None
+        self._lock = threading.Lock()
+
+    def load(self, model: str) -> float:
+        # the extra delay of a call of this model
+        with self._lock:
+            if self.loaded_model == model:
+                return 0.0
+            swapped = self.loaded_model is not None
+            self.loaded_model = model
+        if swapped and self.recorder is not None:
+            self.recorder.record_swap()
+        return self.swap_latency
+
+
+class FakeLLM(LLM):
+    # latency: seconds per call, plus token_latency per generated word and prompt_latency per word of the prompt
+    name_tag: str = 'fake'
+    model: str = 'fake'  # the configured model it stands in for, what the host has to load
+    host: Any = None
+    latency: float = 0.02
+    token_latency: float = 0.0
+    prompt_latency: float = 0.0
+    answer_words: int = 60
+    recorder: Any = None
+
+    @property
+    def _llm_type(self) -> str:
+        return 'fake'
+
+    @property
+    def _identifying_params(self) -> dict:
+        # part of the llm cache key, see llm_cache.py
+        return {'model': self.name_tag, 'answer_words': self.answer_words}
+
+    def answer(self, prompt: str) -> str:
+        stage = prompt_stage(prompt)
+        seed = stable_hash(prompt)
+        if stage == 'vote':
+            # most candidates are unanimously good, some are bad, a few are on the margin
+            return 'bad' if seed % 7 == 0 else 'good'
+        if stage == 'screening':
+            return 'no' if seed % 13 == 0 else 'yes'
+        if stage == 'comparison':
+            return 'first' if seed % 2 == 0 else 'second'
+        if stage == 'claims':
+            return '\n'.join(f"- {claim}" for claim in random.Random(seed).sample(CLAIM_POOL, 3))
+        generator = random.Random(seed)
+        if stage == 'combined':
+            judgements = {criterion: f"{criterion.capitalize()} judgement: "
+                                     f"{' '.join(generator.choices(WORD_POOL, k=self.answer_words))}."
+                          for criterion in CRITERIA}
+            # small models get the json wrong now and then, a field goes missing, or the answer is cut short
+            if seed % 5 == 0:
+                judgements.pop(generator.choice(CRITERIA))
+            answer = json.dumps(judgements)
+            return answer[:len(answer) // 2] if seed % 17 == 0 else answer
+        words = generator.choices(WORD_POOL, k=self.answer_words)
+        return f"{stage.capitalize()} judgement: {' '.join(words)}."
+
+    def delay(self, prompt: str, answer: str) -> float:
+        swap = self.host.load(self.model) if self.host is not None else 0.0
+        return swap + self.latency + self.prompt_latency * len(prompt.split()) + \
+            self.token_latency * len(answer.split())
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> str:
+        start = time.perf_counter()
+        answer = self.answer(prompt)
+        time.sleep(self.delay(prompt, answer))
+        if self.recorder is not None:
+            self.recorder.record(prompt_stage(prompt), time.perf_counter() - start, prompt)
+        return answer
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> str:
+        start = time.perf_counter()
+        answer = self.answer(prompt)
+        await asyncio.sleep(self.delay(prompt, answer))
+        if self.recorder is not None:
+            self.recorder.record(prompt_stage(prompt), time.perf_counter() - start, prompt)
+        return answer
+
+    def stream_parts(self, answer: str) -> list:
+        # the answer word by word, as ollama streams it, the token latency is spread over the words
+        return re.findall(r"\S+\s*", answer) or [answer]
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs):
+        start = time.perf_counter()
+        answer = self.answer(prompt)
+        parts = self.stream_parts(answer)
+        time.sleep(max(0.0, self.delay(prompt, answer) - self.token_latency * len(parts)))
+        for part in parts:
+            time.sleep(self.token_latency)
+            yield GenerationChunk(text=part)
+        if self.recorder is not None:
+            self.recorder.record(prompt_stage(prompt), time.perf_counter() - start, prompt)
+
+    async def _astream(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs):
+        start = time.perf_counter()
+        answer = self.answer(prompt)
+        parts = self.stream_parts(answer)
+        await asyncio.sleep(max(0.0, self.delay(prompt, answer) - self.token_latency * len(parts)))
+        for part in parts:
+            await asyncio.sleep(self.token_latency)
+            yield GenerationChunk(text=part)
+        if self.recorder is not None:
+            self.recorder.record(prompt_stage(prompt), time.perf_counter() - start, prompt)
+
+
+class FakeEmbeddings(Embeddings):
+    # hashed bag of words, similar texts get similar vectors, which is all the indexes need
+    def __init__(self, dimensions: int = 384, latency: float = 0.0):
+        self.dimensions = dimensions
+        self.latency = latency
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency)
+        vectors = np.full((len(texts), self.dimensions), 1e-3, dtype='float32')
+        for row, text in enumerate(texts):
+            for word in re.findall(r"[a-z0-9]+", text.lower()):
+                vectors[row, stable_hash(word) % self.dimensions] += 1.0
+        return vectors.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class FakeTokenEncoder:
+    # whitespace tokens, only used when tiktoken can't load its encoding (offline)
+    def encode(self, text: str, disallowed_special=()) -> list:
+        return text.split(' ')
+
+    def decode(self, tokens: list) -> str:
+        return ' '.join(tokens)
+
+
+class FakeTranscriptionModel:
+    # same interface as a loaded whisper model, it gets the video path instead of the audio,
+    # the transcript is derived from the file contents, so identical videos get identical transcripts
+    def __init__(self, latency: float = 0.05, words: int = 300, recorder: CallRecorder = None):
+        self.latency = latency
+        self.words = words
+        self.recorder = recorder
+
+    def transcribe(self, video_path, **kwargs) -> dict:
+        # as whisper, it takes audio as well, transcribing it takes as long as its share of a 30s window
+        start = time.perf_counter()
+        if isinstance(video_path, np.ndarray):
+            time.sleep(self.latency * len(video_path) / (16000 * 30))
+            if self.recorder is not None:
+                self.recorder.record('transcription_window', time.perf_counter() - start, '')
+            return {'text': read_speech(video_path)}
+        with open(video_path, 'rb') as file:
+            content = file.read()
+        seed = stable_hash(content.hex())
+        time.sleep(self.latency)
+        if self.recorder is not None:
+            self.recorder.record('transcription', time.perf_counter() - start, video_path)
+        for prefix, text in NON_ANSWERS.items():
+            if content.startswith(prefix):
+                return {'text': text}
+        # every candidate talks about a few topics of their own, so unrelated transcripts aren't near duplicates
+        generator = random.Random(seed)
+        topics = generator.sample(WORD_POOL, 8)
+        pools = [(0.4, FILLER_POOL), (0.5, TASK_POOL), (1.0, topics)]
+        words = []
+        for _ in range(self.words):
+            draw = generator.random()
+            words.append(generator.choice(next(pool for share, pool in pools if draw < share)))
+        return {'text': ' '.join(words)}
+
+
+class FakeTranscriptionService:
+    # stands in for transcription.TranscriptionService: the real one runs whisper in spawned worker processes,
+    # which can't see models registered in this process, this one runs the registered model in threads
+    def __init__(self, workers: int = 4):
+        from transcription import get_transcript_key
+        from cache import transcript_cache
+        self._get_transcript_key = get_transcript_key
+        self._cache = transcript_cache
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fake-transcription')
+        self._in_flight = {}
+        self._lock = threading.RLock()
+
+    def _transcribe(self, video_path: str) -> str:
+        from models import get_transcription_model
+        return get_transcription_model().transcribe(video_path)['text']
+
+    def submit(self, video_path: str) -> Future:
+        transcript_key = self._get_transcript_key(video_path)
+        cached = self._cache.get(transcript_key)
+        if cached is not None:
+            future = Future()
+            future.set_result(cached['text'])
+            return future
+        with self._lock:
+            future = self._in_flight.get(transcript_key)
+            if future is None:
+                future = self._executor.submit(self._transcribe, video_path)
+                self._in_flight[transcript_key] = future
+                future.add_done_callback(lambda done: self._finish(transcript_key, done))
+            return future
+
+    def _finish(self, transcript_key: str, future: Future):
+        if future.exception() is None:
+            self._cache.put(transcript_key, {'text': future.result()})
+        with self._lock:
+            self._in_flight.pop(transcript_key, None)
+
+    def submit_samples(self, samples) -> Future:
+        from models import get_transcription_model
+        return self._executor.submit(lambda: get_transcription_model().transcribe(samples)['text'])
+
+    def submit_ingested(self, video_path: str, ingest) -> Future:
+        # the stitched transcript of a streamed upload, or the whole video if the streaming failed
+        transcript_key = self._get_transcript_key(video_path)
+        future = Future()
+        with self._lock:
+            self._in_flight[transcript_key] = future
+            future.add_done_callback(lambda done: self._finish(transcript_key, done))
+
+        def complete():
+            try:
+                future.set_result(ingest.transcript(video_path))
+            except Exception:
+                future.set_result(self._transcribe(video_path))
+
+        threading.Thread(target=complete, daemon=True).start()
+        return future
+
+    def transcribe(self, video_path: str) -> str:
+        return self.submit(video_path).result()
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+
+def install_fakes(llm_latency: float = 0.02, token_latency: float = 0.0, transcription_latency: float = 0.05,
+                  transcript_words: int = 300, transcription_workers: int = 4, recorder: CallRecorder = None,
+                  fake_tokenizer: bool = None, prompt_latency: float = 0.0, swap_latency: float = 0.0) -> CallRecorder:
+    # registers the stand-ins in the model registry, and replaces the transcription service,
+    # fake_tokenizer=None uses tiktoken if its encoding can be loaded,
+    # the screening model gets a fast stand-in only if one is configured (SPEEDVUE_SCREENING_MODEL),
+    # all llms share a host which holds one model at a time, switching costs swap_latency
+    import transcription
+    from models import model_registry, screening_model_name, basic_model_name, master_model_name
+
+    recorder = recorder or CallRecorder()
+    host = ModelHost(swap_latency, recorder)
+    basic_llm = FakeLLM(name_tag='fake-basic', model=basic_model_name, host=host, latency=llm_latency,
+                        token_latency=token_latency, prompt_latency=prompt_latency, recorder=recorder)
+    master_llm = FakeLLM(name_tag='fake-master', model=master_model_name, host=host, latency=llm_latency,
+                         token_latency=token_latency, prompt_latency=prompt_latency, recorder=recorder,
+                         answer_words=120)
+    embeddings = FakeEmbeddings()
+    transcription_model = FakeTranscriptionModel(transcription_latency, transcript_words, recorder)
+
+    model_registry.unload()
+    model_registry.register('basic_llm', lambda: basic_llm)
+    model_registry.register('master_llm', lambda: master_llm)
+    model_registry.register('embeddings', lambda: embeddings)
+    if screening_model_name:
+        screening_llm = FakeLLM(name_tag='fake-screening', model=screening_model_name, host=host,
+                                latency=llm_latency / 10, recorder=recorder)
+        model_registry.register('screening_llm', lambda: screening_llm)
+    model_registry.register('transcription_model', lambda: transcription_model)
+    if fake_tokenizer is None:
+        try:
+            model_registry.get('token_encoder')
+            fake_tokenizer = False
+        except Exception:
+            fake_tokenizer = True
+    if fake_tokenizer:
+        model_registry.register('token_encoder', FakeTokenEncoder)
+
+    transcription.transcription_service_singleton = FakeTranscriptionService(transcription_workers)
+    return recorder
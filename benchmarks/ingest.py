@@ -0,0 +1,93 @@
+# Benchmark of the streaming ingest (see ingest.py): how long after the end of an upload its transcript is ready,
+# transcribed in windows while the upload streams, against transcribing the whole recording once it's uploaded.
+# The "video" is synthetic speech as raw audio (see fakes.speech_audio), so the demuxer is a plain pass-through,
+# and the upload is throttled to take --upload-seconds: python benchmarks/ingest.py [options]
+import argparse
+import asyncio
+import difflib
+import os
+import sys
+import tempfile
+import time
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+
+class ThrottledUpload:
+    # the part of fastapi's UploadFile which uploads.save_upload reads, delivered at a fixed rate
+    def __init__(self, filename: str, content: bytes, seconds: float):
+        self.filename = filename
+        self.content = content
+        self.rate = len(content) / seconds if seconds else None
+        self.position = 0
+
+    async def read(self, size: int) -> bytes:
+        chunk = self.content[self.position:self.position + size]
+        self.position += len(chunk)
+        if chunk and self.rate:
+            await asyncio.sleep(len(chunk) / self.rate)
+        return chunk
+
+
+async def upload(name: str, content: bytes, seconds: float) -> float:
+    import uploads
+    start = time.perf_counter()
+    await uploads.save_upload(ThrottledUpload(f"{name}.raw", content, seconds))
+    return time.perf_counter() - start
+
+
+def run(options):
+    from benchmarks.fakes import install_fakes, speech_audio, read_speech, SPEECH_WORD_SAMPLES
+
+    install_fakes(transcription_latency=options.window_latency, transcription_workers=options.workers)
+    import ingest
+    from transcription import get_transcription_service
+
+    ingest.demux_command = ['cat']  # the uploads are raw audio already
+    words = int(options.minutes * 60 * 16000 / SPEECH_WORD_SAMPLES)
+    audio = speech_audio(words, seed=1)
+    content = audio.tobytes()
+    expected = read_speech(audio).split()
+    print(f"recording: {options.minutes:.1f} min, {words} words, upload: {options.upload_seconds:.1f}s, "
+          f"transcription: {options.window_latency:.2f}s per {ingest.window_seconds:.0f}s of audio")
+
+    # streamed: the windows are transcribed while the upload runs
+    upload_seconds = asyncio.run(upload('streamed', content, options.upload_seconds))
+    start = time.perf_counter()
+    transcript = get_transcription_service().submit('data/videos/streamed.raw').result()
+    streamed_lag = time.perf_counter() - start
+    agreement = difflib.SequenceMatcher(None, transcript.split(), expected, autojunk=False).ratio()
+    print(f"streamed: upload {upload_seconds:.2f}s, transcript ready {streamed_lag:.2f}s after it, "
+          f"words {len(transcript.split())} / {len(expected)}, agreement with the whole recording {agreement:.4f}")
+
+    # whole: the recording is transcribed once it's uploaded, as before
+    ingest.streaming_ingest_enabled = False
+    upload_seconds = asyncio.run(upload('whole', content, options.upload_seconds))
+    start = time.perf_counter()
+    get_transcription_service().submit_samples(audio.astype('float32') / 32768.0).result()
+    whole_lag = time.perf_counter() - start
+    print(f"whole: upload {upload_seconds:.2f}s, transcript ready {whole_lag:.2f}s after it")
+    print(f"end to end: {options.upload_seconds + streamed_lag:.2f}s streamed, "
+          f"{options.upload_seconds + whole_lag:.2f}s whole")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the streaming transcription of uploads")
+    parser.add_argument('--minutes', type=float, default=5.0, help="length of the recording")
+    parser.add_argument('--upload-seconds', type=float, default=20.0, help="how long the upload takes")
+    parser.add_argument('--window-latency', type=float, default=1.5,
+                        help="seconds to transcribe 30 seconds of audio")
+    parser.add_argument('--workers', type=int, default=4, help="transcription workers")
+    parser.add_argument('--workspace', default=None, help="directory of the run, a temporary one by default")
+    options = parser.parse_args()
+
+    workspace = options.workspace or tempfile.mkdtemp(prefix='speedvue-ingest-')
+    os.makedirs(f"{workspace}/data/videos", exist_ok=True)
+    os.chdir(workspace)
+    os.environ.setdefault('SPEEDVUE_LOG_LEVEL', 'WARNING')
+    run(options)
+
+
+if __name__ == '__main__':
+    main()
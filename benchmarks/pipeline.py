@@ -0,0 +1,315 @@
+# End-to-end benchmark of the pipeline (transcription, assessment, filtering, optionally ranking) on synthetic
+# batches, with the deterministic stand-ins of benchmarks/fakes.py instead of Ollama and whisper.
+# Reports throughput, latency percentiles per candidate and per stage, peak memory, file and database operations.
+# Every batch size runs in a fresh process and a fresh workspace: python benchmarks/pipeline.py [sizes...] [options]
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+default_sizes = [10, 100, 1000]
+assessment_modes = ['fanout', 'combined']  # see assessment.assessment_modes, not imported outside of the children
+tasks = [
+    "Tell us about a project you are proud of.",
+    "How would you find the cause of a slow database query?",
+    "Describe a time you disagreed with your team, and what happened next.",
+]
+# file operations counted by the audit hook, see OperationCounter
+file_events = {'open', 'os.listdir', 'os.scandir', 'os.rename', 'os.replace', 'os.remove', 'os.utime', 'shutil.move'}
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {'p50': 0.0, 'p90': 0.0, 'p99': 0.0}
+    values = sorted(values)
+    return {name: values[min(len(values) - 1, int(len(values) * share))]
+            for name, share in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))}
+
+
+class OperationCounter:
+    # counts file operations (through an audit hook, which can't be removed, hence the enabled flag)
+    # and database queries of the SQLAlchemy engine
+    def __init__(self):
+        self.enabled = False
+        self.files = {}
+        self.queries = 0
+        sys.addaudithook(self.on_audit)
+
+    def on_audit(self, name: str, _):
+        if self.enabled and name in file_events:
+            self.files[name] = self.files.get(name, 0) + 1
+
+    def on_query(self, *_):
+        if self.enabled:
+            self.queries += 1
+
+    def take(self) -> dict:
+        counts = {'files': dict(self.files), 'file_total': sum(self.files.values()), 'db_queries': self.queries}
+        self.files = {}
+        self.queries = 0
+        return counts
+
+
+def create_workspace(root: str, size: int, duplicate_share: float, non_answer_share: float):
+    # synthetic "videos", their bytes only seed the fake transcriber, a share of them are re-uploads of others,
+    # and a share of them are non-answers, which the screening should rule out, see fakes.NON_ANSWERS
+    os.makedirs(f"{root}/data/videos", exist_ok=True)
+    os.makedirs(f"{root}/data/text", exist_ok=True)
+    os.makedirs(f"{root}/data/corpus", exist_ok=True)
+    from benchmarks.fakes import CLAIM_POOL, NON_ANSWERS
+    with open(f"{root}/data/corpus/facts.md", 'w') as file:
+        file.write('\n\n'.join(f"{claim}. It is widely documented." for claim in CLAIM_POOL))
+
+    duplicates = int(size * duplicate_share)
+    non_answers = int(size * non_answer_share)
+    prefixes = list(NON_ANSWERS)
+    for index in range(size):
+        source = index % (size - duplicates) if index >= size - duplicates else index
+        # spread evenly over the batch
+        step = size // non_answers if non_answers else 0
+        prefix = prefixes[source // step % len(prefixes)] if step and source % step == 0 else b''
+        with open(f"{root}/data/videos/candidate{index:05d}.mp4", 'wb') as file:
+            file.write(prefix + f"synthetic video {source}".encode() * 64)
+
+
+def run_stage(name: str, counter: OperationCounter, function) -> tuple:
+    counter.enabled = True
+    start = time.perf_counter()
+    result = function()
+    duration = time.perf_counter() - start
+    counter.enabled = False
+    return result, {'stage': name, 'seconds': duration, **counter.take()}
+
+
+def run_size(args):
+    # runs in the child process, inside the workspace, the repo modules resolve data/ relative to it,
+    # so they are only imported here
+    import resource
+
+    from benchmarks.fakes import install_fakes
+    import assessment
+    from batch import assess_batch
+    import database
+    from sqlalchemy import event
+    from cache import transcript_cache, assessment_cache, claim_cache
+    from llm_cache import llm_cache
+    from models import basic_model_name, master_model_name
+    from metrics import metrics_registry
+
+    recorder = install_fakes(args.llm_latency, args.token_latency, args.transcription_latency,
+                             args.transcript_words, args.transcription_workers, prompt_latency=args.prompt_latency,
+                             swap_latency=args.swap_latency)
+    counter = OperationCounter()
+    event.listen(database.get_engine(), 'before_cursor_execute', counter.on_query)
+    # the limiter is keyed by the configured model names, the fakes stand in for those models
+    limits = {name: args.llm_concurrency for name in (basic_model_name, master_model_name)}
+
+    def new_responses() -> list:
+        return [assessment.StandardTaskResponse(f"data/videos/candidate{index:05d}.mp4", tasks[index % len(tasks)])
+                for index in range(args.size)]
+
+    results = []
+    stages = []
+
+    def assess():
+        results.extend(assess_batch(new_responses(), limits=limits, schedule=args.schedule))
+
+    _, stage = run_stage('assess', counter, assess)
+    stage['model_swaps'] = recorder.swaps
+    stages.append(stage)
+    _, stage = run_stage('filter', counter, assessment.filter_summarized_candidates)
+    stages.append(stage)
+    if args.rank:
+        from ranking import rank_candidates
+        _, stage = run_stage('rank', counter, rank_candidates)
+        stages.append(stage)
+    llm_durations = {name: list(durations) for name, durations in recorder.durations.items()}
+
+    if args.warm:
+        # the same batch again, everything should come from the caches
+        recorder.reset()
+        _, stage = run_stage('assess (warm)', counter, lambda: assess_batch(new_responses(), limits=limits,
+                                                                             schedule=args.schedule))
+        stage['llm_calls'] = sum(len(durations) for durations in recorder.durations.values())
+        stages.append(stage)
+
+    # the token counts of all llm stages, summed from the metrics, see tokens.TokenCounter
+    tokens = {'prompt': 0, 'completion': 0}
+    for _, (_, kind), _, value in metrics_registry.get('speedvue_llm_tokens_total').samples():
+        tokens[kind] = tokens.get(kind, 0) + int(value)
+
+    failed = [result for result in results if not result.succeeded]
+    screened_count = len([result for result in results if result.screened_out])
+    llm_seconds = assessment.estimate_llm_seconds()
+    return {
+        'size': args.size,
+        'failed': len(failed),
+        'assessment_mode': args.assessment_mode,
+        'schedule': args.schedule,
+        'tokens': tokens,
+        'screening': {'mode': args.screening, 'screened_out': screened_count,
+                      'saved_llm_calls': screened_count * assessment.full_assessment_llm_calls(),
+                      'saved_llm_seconds': screened_count * llm_seconds if llm_seconds is not None else None},
+        'errors': sorted({repr(result.error) for result in failed})[:5],
+        'candidate_seconds': percentiles([result.duration for result in results]),
+        'llm_stages': {name: {'calls': len(durations), **percentiles(durations)}
+                       for name, durations in sorted(llm_durations.items())},
+        'stages': stages,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'caches': {'llm': llm_cache.stats(),
+                   **{name: {'hits': cache.hits, 'misses': cache.misses}
+                      for name, cache in (('transcripts', transcript_cache), ('assessments', assessment_cache),
+                                          ('claims', claim_cache))}},
+    }
+
+
+def run_child(args, size: int) -> dict:
+    workspace = tempfile.mkdtemp(prefix=f"speedvue-bench-{size}-", dir=args.workspace)
+    create_workspace(workspace, size, args.duplicate_share, args.non_answer_share)
+    result_path = f"{workspace}/result.json"
+    command = [sys.executable, os.path.abspath(__file__), '--child', str(size), '--result', result_path,
+               *child_arguments(args)]
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join([repo_root, os.environ.get('PYTHONPATH', '')]),
+           'SPEEDVUE_SCREENING': '0' if args.screening == 'off' else '1',
+           'SPEEDVUE_ASSESSMENT_MODE': args.assessment_mode}
+    if args.master_model:
+        env['SPEEDVUE_MASTER_MODEL'] = args.master_model
+    # the fakes stand in for the screening model as soon as one is configured
+    env.pop('SPEEDVUE_SCREENING_MODEL', None)
+    if args.screening == 'model':
+        env['SPEEDVUE_SCREENING_MODEL'] = 'fake-screening'
+
+    # the pipeline is chatty, its output goes to a log file in the workspace
+    with open(f"{workspace}/pipeline.log", 'w') as log:
+        finished = subprocess.run(command, cwd=workspace, env=env, stdout=log, stderr=subprocess.STDOUT)
+    if finished.returncode != 0 or not os.path.exists(result_path):
+        raise RuntimeError(f"Benchmark of {size} candidates failed, see {workspace}/pipeline.log")
+    with open(result_path, 'r') as file:
+        result = json.loads(file.read())
+    result['workspace'] = workspace
+    return result
+
+
+def child_arguments(args) -> list:
+    arguments = ['--llm-latency', str(args.llm_latency), '--token-latency', str(args.token_latency),
+                 '--prompt-latency', str(args.prompt_latency),
+                 '--transcription-latency', str(args.transcription_latency),
+                 '--transcript-words', str(args.transcript_words),
+                 '--transcription-workers', str(args.transcription_workers),
+                 '--llm-concurrency', str(args.llm_concurrency), '--screening', args.screening,
+                 '--assessment-mode', args.assessment_mode, '--schedule', args.schedule,
+                 '--swap-latency', str(args.swap_latency)]
+    if args.rank:
+        arguments.append('--rank')
+    if args.warm:
+        arguments.append('--warm')
+    return arguments
+
+
+def print_result(result: dict):
+    print(f"\n=== {result['size']} candidates ({result['assessment_mode']}, {result['schedule']}), "
+          f"failed: {result['failed']}, "
+          f"peak memory: {result['peak_rss_mb']:.0f} MB ===")
+    for error in result['errors']:
+        print(f"  error: {error}")
+    print(f"{'stage':>14} {'seconds':>9} {'per second':>11} {'file ops':>9} {'db queries':>11}")
+    for stage in result['stages']:
+        print(f"{stage['stage']:>14} {stage['seconds']:>9.2f} {result['size'] / stage['seconds']:>11.1f} "
+              f"{stage['file_total']:>9} {stage['db_queries']:>11}"
+              + (f"  (llm calls: {stage['llm_calls']})" if 'llm_calls' in stage else '')
+              + (f"  (model swaps: {stage['model_swaps']})" if 'model_swaps' in stage else ''))
+    screening = result['screening']
+    saved_seconds = screening['saved_llm_seconds']
+    print(f"screening ({screening['mode']}): {screening['screened_out']} screened out, saved "
+          f"{screening['saved_llm_calls']} llm calls"
+          + (f", about {saved_seconds:.1f}s of llm time" if saved_seconds is not None else ''))
+    tokens = result['tokens']
+    print(f"llm tokens: prompt {tokens['prompt']} ({tokens['prompt'] / result['size']:.0f} per candidate), "
+          f"completion {tokens['completion']} ({tokens['completion'] / result['size']:.0f} per candidate)")
+    candidate = result['candidate_seconds']
+    print(f"candidate latency: p50 {candidate['p50']:.3f}s, p90 {candidate['p90']:.3f}s, p99 {candidate['p99']:.3f}s")
+    print(f"{'llm stage':>14} {'calls':>7} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8}")
+    for name, stage in result['llm_stages'].items():
+        print(f"{name:>14} {stage['calls']:>7} {stage['p50'] * 1000:>8.1f} {stage['p90'] * 1000:>8.1f} "
+              f"{stage['p99'] * 1000:>8.1f}")
+    print('caches:', ', '.join(f"{name} {stats['hits']}/{stats['hits'] + stats['misses']}"
+                               for name, stats in result['caches'].items()))
+
+
+def print_mode_comparison(results: list):
+    # the same batches in each assessment mode: latency, llm calls and tokens per candidate
+    print(f"\n{'size':>6} {'mode':>9} {'assess s':>9} {'p50 s':>7} {'p90 s':>7} {'llm calls':>10} "
+          f"{'prompt tok':>11} {'compl. tok':>11}")
+    for result in results:
+        size = result['size']
+        calls = sum(stage['calls'] for name, stage in result['llm_stages'].items() if name != 'transcription')
+        print(f"{size:>6} {result['assessment_mode']:>9} {result['stages'][0]['seconds']:>9.2f} "
+              f"{result['candidate_seconds']['p50']:>7.3f} {result['candidate_seconds']['p90']:>7.3f} "
+              f"{calls / size:>10.1f} {result['tokens']['prompt'] / size:>11.0f} "
+              f"{result['tokens']['completion'] / size:>11.0f}")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="SpeedVue pipeline benchmark with fake models")
+    parser.add_argument('sizes', nargs='*', type=int, default=default_sizes)
+    parser.add_argument('--llm-latency', type=float, default=0.02, help="seconds per llm call")
+    parser.add_argument('--token-latency', type=float, default=0.0, help="extra seconds per generated word")
+    parser.add_argument('--prompt-latency', type=float, default=0.0, help="extra seconds per word of the prompt")
+    parser.add_argument('--transcription-latency', type=float, default=0.05, help="seconds per video")
+    parser.add_argument('--transcript-words', type=int, default=300)
+    parser.add_argument('--transcription-workers', type=int, default=4)
+    parser.add_argument('--llm-concurrency', type=int, default=4, help="parallel requests per model")
+    parser.add_argument('--duplicate-share', type=float, default=0.05, help="share of re-uploaded videos")
+    parser.add_argument('--non-answer-share', type=float, default=0.1,
+                        help="share of videos which don't answer the task")
+    parser.add_argument('--screening', choices=['off', 'heuristics', 'model'], default='heuristics',
+                        help="screening ahead of the llm: none, the heuristics only, or also the small model")
+    parser.add_argument('--assessment-mode', choices=['fanout', 'combined', 'both'], default='fanout',
+                        help="a call per criterion, or one call with a JSON answer for all of them, "
+                             "both: every size in each mode, compared side by side")
+    parser.add_argument('--schedule', choices=['pipelined', 'by_model'], default='pipelined',
+                        help="candidates through all stages at once, or the whole batch one model after another")
+    parser.add_argument('--swap-latency', type=float, default=0.0,
+                        help="seconds to load another llm, the fake host holds one model at a time")
+    parser.add_argument('--master-model', default=None,
+                        help="name of the master model, set it apart from the basic model to see model swaps")
+    parser.add_argument('--rank', action='store_true', help="also rank the viable candidates")
+    parser.add_argument('--warm', action='store_true', help="assess the same batch again, from the caches")
+    parser.add_argument('--workspace', default=None, help="directory for the workspaces, default: temp")
+    parser.add_argument('--json', action='store_true', help="print the results as json")
+    parser.add_argument('--child', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--result', default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if args.child is not None:
+        args.size = args.child
+        result = run_size(args)
+        with open(args.result, 'w') as file:
+            file.write(json.dumps(result))
+        return
+
+    modes = assessment_modes if args.assessment_mode == 'both' else [args.assessment_mode]
+    results = []
+    for size in args.sizes:
+        for mode in modes:
+            result = run_child(argparse.Namespace(**{**vars(args), 'assessment_mode': mode}), size)
+            results.append(result)
+            if not args.json:
+                print_result(result)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    elif len(modes) > 1:
+        print_mode_comparison(results)
+
+
+if __name__ == "__main__":
+    main()
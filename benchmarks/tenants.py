@@ -0,0 +1,133 @@
+# Benchmark of the fair-share scheduling of the llm (see scheduler.py): a company submits several large batches,
+# a second one submits a small batch shortly after, and a client asks for a single candidate of a third one.
+# Reported: when each of them is done, and the per-company wait for llm slots, with the fair share
+# against first come, first served (every request of the same tenant). Each mode runs in a fresh process
+# and workspace, with the stand-ins of benchmarks/fakes.py: python benchmarks/tenants.py [options]
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+modes = ['fair', 'fifo']
+task = "Tell us about a project you are proud of."
+
+
+def create_tenants(batches: dict):
+    # batches: batch name -> candidate ids, the company is the name up to the first '-',
+    # the responses are bound to the videos by their names
+    from database import Company, Batch, Applicant, Application, Response, get_session
+
+    with get_session() as session, session.begin():
+        companies = {}
+        for batch_name, candidate_ids in batches.items():
+            company_name = batch_name.split('-')[0]
+            if company_name not in companies:
+                companies[company_name] = Company(id=company_name, name=company_name)
+            batch = Batch(id=batch_name, company=companies[company_name], job_title="Engineer", description="")
+            session.add(batch)
+            for candidate_id in candidate_ids:
+                applicant = Applicant(name=candidate_id, surname='', email='', phone='', phone_country_code='',
+                                      phone_extension='', country='', city='', address='')
+                application = Application(batch=batch, applicant=applicant)
+                session.add_all([applicant, application, Response(id=candidate_id, application=application,
+                                                                  task_text=task)])
+
+
+def run_mode(args):
+    # runs in the child process, inside the workspace
+    from benchmarks.fakes import install_fakes
+
+    install_fakes(args.llm_latency, transcription_latency=0.01, transcription_workers=8)
+    import assessment
+    from batch import assess_batch, start_streamed_assessment
+    from scheduler import fair_scheduler, resolve_tenants
+
+    batches = {f"large-{batch}": [f"large{batch}-{index:05d}" for index in range(args.large)]
+               for batch in range(args.large_batches)}
+    batches.update({'small-0': [f"small0-{index:05d}" for index in range(args.small)],
+                    'interactive-0': ['single00000']})
+    for candidate_ids in batches.values():
+        for candidate_id in candidate_ids:
+            with open(f"data/videos/{candidate_id}.mp4", 'wb') as file:
+                file.write(f"synthetic video {candidate_id}".encode() * 64)
+    create_tenants(batches)
+    done = {}
+    start = time.perf_counter()
+
+    def run_batch(batch_name: str, delay: float):
+        time.sleep(delay)
+        responses = [assessment.StandardTaskResponse(f"data/videos/{candidate_id}.mp4", task)
+                     for candidate_id in batches[batch_name]]
+        tenants = resolve_tenants(batches[batch_name]) if args.mode == 'fair' else None
+        submitted = time.perf_counter()
+        assess_batch(responses, tenants=tenants)
+        done[batch_name] = (submitted - start, time.perf_counter() - submitted)
+
+    async def run_interactive():
+        await asyncio.sleep(args.delay * 2)
+        user_response = assessment.StandardTaskResponse("data/videos/single00000.mp4", task)
+        submitted = time.perf_counter()
+        if args.mode == 'fair':
+            await start_streamed_assessment(user_response).result()
+        else:  # as bulk work of the same tenant as everyone else
+            await asyncio.get_running_loop().run_in_executor(None, assess_batch, [user_response])
+        done['interactive-0'] = (submitted - start, time.perf_counter() - submitted)
+
+    threads = [threading.Thread(target=run_batch, args=(f"large-{batch}", 0.0)) for batch in range(args.large_batches)]
+    threads += [threading.Thread(target=run_batch, args=('small-0', args.delay)),
+                threading.Thread(target=asyncio.run, args=(run_interactive(),))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {'mode': args.mode, 'done': done, 'tenants': fair_scheduler.tenant_stats()}
+
+
+def print_report(report: dict):
+    print(f"{report['mode']}:")
+    for batch_name, (submitted, seconds) in sorted(report['done'].items(), key=lambda item: item[1][0]):
+        print(f"  {batch_name:<14} submitted at {submitted:6.2f}s, done {seconds:7.2f}s later")
+    for stats in report['tenants']:
+        mean_wait = stats['mean_wait_seconds'] or 0.0
+        print(f"  {stats['company_id']:<14} {stats['requests']:>6} llm requests, mean wait {mean_wait:.3f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the fair-share scheduling of the llm across tenants")
+    parser.add_argument('--large', type=int, default=100, help="candidates of each large batch")
+    parser.add_argument('--large-batches', type=int, default=3, help="large batches, of the same company")
+    parser.add_argument('--small', type=int, default=10, help="candidates of the small batch")
+    parser.add_argument('--delay', type=float, default=0.5, help="seconds between the large and the small batch")
+    parser.add_argument('--llm-latency', type=float, default=0.02, help="seconds per llm call")
+    parser.add_argument('--mode', choices=modes, default=None, help="a single mode, in this process")
+    parser.add_argument('--workspace', default=None, help="directory of the run, a temporary one by default")
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        os.makedirs(f"{args.workspace}/data/videos", exist_ok=True)
+        os.chdir(args.workspace)
+        os.environ.setdefault('SPEEDVUE_LOG_LEVEL', 'WARNING')
+        print(json.dumps(run_mode(args)))
+        return
+
+    root = args.workspace or tempfile.mkdtemp(prefix='speedvue-tenants-')
+    for mode in modes:
+        workspace = f"{root}/{mode}"
+        command = [sys.executable, os.path.abspath(__file__), '--mode', mode, '--workspace', workspace,
+                   '--large', str(args.large), '--large-batches', str(args.large_batches), '--small', str(args.small),
+                   '--delay', str(args.delay), '--llm-latency', str(args.llm_latency)]
+        output = subprocess.run(command, check=True, capture_output=True, text=True,
+                                env={**os.environ, 'SPEEDVUE_LOG_LEVEL': 'WARNING'}).stdout
+        print_report(json.loads(output.strip().splitlines()[-1]))
+
+
+if __name__ == '__main__':
+    main()
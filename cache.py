@@ -0,0 +1,152 @@
+# This file is the caching part of this project
+# Results are stored under a key derived from everything they depend on: the video bytes, the models and the prompts.
+# A re-uploaded video, a different model or a changed prompt gets a new key, everything else is reused as-is.
+import hashlib
+import json
+import os
+import threading
+
+from os.path import exists
+
+from metrics import metrics_registry
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+_file_hashes = {}  # (path, size, mtime_ns) -> sha256, so that unchanged videos are hashed only once per process
+_file_hashes_lock = threading.Lock()
+
+
+def hash_file(path: str) -> str:
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _file_hashes_lock:
+        if memo_key in _file_hashes:
+            return _file_hashes[memo_key]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    with _file_hashes_lock:
+        _file_hashes[memo_key] = digest.hexdigest()
+    return digest.hexdigest()
+
+
+def register_file_hash(path: str, file_hash: str):
+    # used when the hash is already known, e.g. computed while the file was being uploaded
+    stat = os.stat(path)
+    with _file_hashes_lock:
+        _file_hashes[(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)] = file_hash
+
+
+def fingerprint(*parts) -> str:
+    # stable hash of any json serializable values
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def prompt_fingerprint(*prompts) -> str:
+    # only the templates matter, two equal prompts built separately get the same fingerprint
+    parts = []
+    for prompt in prompts:
+        for message in prompt.messages:
+            template = getattr(getattr(message, 'prompt', None), 'template', None)
+            parts.append([type(message).__name__, template if template is not None else repr(message)])
+    return fingerprint(parts)
+
+
+class ContentCache:
+    # JSON values stored under data/cache/{name}/{key[:2]}/{key}.json
+    # Once the cache grows over max_bytes or max_entries, the least recently used entries are evicted,
+    # reading an entry bumps its mtime, which is used as the LRU clock.
+    def __init__(self, name: str, max_bytes: int, max_entries: int, root: str = 'data/cache'):
+        self.directory = f"{root}/{name}"
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._sizes = None  # key -> size in bytes, loaded from disk on first use
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: str) -> str:
+        return f"{self.directory}/{key[:2]}/{key}.json"
+
+    def _load_index(self):
+        if self._sizes is not None:
+            return
+        self._sizes = {}
+        if exists(self.directory):
+            for shard in os.listdir(self.directory):
+                for filename in os.listdir(f"{self.directory}/{shard}"):
+                    self._sizes[filename[:-len('.json')]] = os.path.getsize(f"{self.directory}/{shard}/{filename}")
+        self._total_bytes = sum(self._sizes.values())
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            with open(path, 'r') as file:
+                value = json.loads(file.read())
+            os.utime(path)
+        except (FileNotFoundError, json.JSONDecodeError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps(value)
+        # write to a temporary file first, so that readers never see a partially written entry
+        temporary_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary_path, 'w') as file:
+            file.write(data)
+        os.replace(temporary_path, path)
+
+        with self._lock:
+            self._load_index()
+            self._total_bytes += len(data) - self._sizes.get(key, 0)
+            self._sizes[key] = len(data)
+            if self._total_bytes > self.max_bytes or len(self._sizes) > self.max_entries:
+                self._evict(keep=key)
+
+    def _evict(self, keep: str):
+        # only called with the lock held, evicts down to 90% of the limits, so that eviction doesn't run on every put
+        def last_used(key: str) -> float:
+            try:
+                return os.path.getmtime(self._path(key))
+            except FileNotFoundError:
+                return 0.0
+
+        for key in sorted(self._sizes, key=last_used):
+            if self._total_bytes <= self.max_bytes * 0.9 and len(self._sizes) <= self.max_entries * 0.9:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            self._total_bytes -= self._sizes.pop(key)
+
+    def __contains__(self, key: str) -> bool:
+        return exists(self._path(key))
+
+
+transcript_cache = ContentCache('transcripts', max_bytes=256 * 1024 * 1024, max_entries=100000)
+assessment_cache = ContentCache('assessments', max_bytes=512 * 1024 * 1024, max_entries=100000)
+# factcheck.py: fetched web pages, and the retrieved context of each claim
+page_cache = ContentCache('pages', max_bytes=1024 * 1024 * 1024, max_entries=200000)
+claim_cache = ContentCache('claims', max_bytes=256 * 1024 * 1024, max_entries=500000)
+
+# name -> cache with hits and misses attributes, reported as metrics, llm_cache.py adds its own
+monitored_caches = {'transcripts': transcript_cache, 'assessments': assessment_cache, 'pages': page_cache,
+                    'claims': claim_cache}
+metrics_registry.counter('speedvue_cache_lookups_total', "Cache lookups by cache and result (hit, miss)",
+                         ('cache', 'result')).set_function(
+    lambda: {(name, result): count for name, cache in list(monitored_caches.items())
+             for result, count in (('hit', cache.hits), ('miss', cache.misses))})
@@ -0,0 +1,414 @@
+# This file is the fact checking part of this project
+# Claims are extracted from the transcript, and each one is looked up in a search backend (the web, or a local
+# document corpus which works offline). Found pages are cached, chunked and added to the persistent factcheck FAISS
+# store, from which the context of every claim is retrieved. Claims are deduplicated across candidates: a claim which
+# was already looked up (a common technology, a well known company) is answered from the claim cache without any search.
+import asyncio
+import atexit
+import json
+import math
+import os
+import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from os.path import exists
+
+from langchain_core.prompts import ChatPromptTemplate
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from models import get_embeddings, embedding_model_name, embedding_token_limit, basic_token_limit
+from cache import page_cache, claim_cache, fingerprint
+from tokens import TokenCounter, count_tokens, split_to_fit, prompt_budget, truncate_tokens
+from metrics import get_logger, metrics_registry, span
+
+# comma separated, queried in this order: local (data/corpus, offline), google
+search_backend_names = [name.strip() for name in os.environ.get('SPEEDVUE_SEARCH_BACKENDS', 'local').split(',')
+                        if name.strip()]
+search_concurrency = int(os.environ.get('SPEEDVUE_SEARCH_CONCURRENCY', '4'))  # lookups in flight, all candidates
+search_results_per_claim = 3
+context_chunks_per_claim = 2
+max_claims = 10  # per response, the most important ones come first
+context_token_share = 3  # the context may take up to 1/3 of the prompt budget
+
+corpus_dir = 'data/corpus'  # .txt and .md reference documents of the local backend
+factcheck_store_dir = 'data/index/factcheck'
+store_save_interval = 32  # the factcheck store is written to disk every this many added sources, and on exit
+
+logger = get_logger('factcheck')
+
+claims_prompt = ChatPromptTemplate.from_messages([
+    ("system", "You are a fact checking assistant."
+               "Your job is to list the factual claims made by this candidate, which can be verified."
+               "Only list claims about the world: technologies, companies, science, history, events."
+               "Do not list opinions, or claims about the candidate himself which can't be verified."
+               "Write one short, self-contained claim per line, most important claims first."
+               "DO NOT add any other text. If there are no such claims, reply with NONE."),
+    ("user", "The candidate was tasked with: \"{task}\""
+             "Candidate responded with: ```{input}```")
+])
+
+
+def normalize_claim(claim: str) -> str:
+    return ' '.join(re.findall(r"[a-z0-9]+", claim.lower()))
+
+
+def parse_claims(claims_response: str) -> list:
+    # one claim per line, list markers are dropped, and so are duplicates and fragments
+    claims = []
+    seen = set()
+    for line in claims_response.splitlines():
+        claim = re.sub(r"^\s*(?:[-*•]|\d+[.)])\s*", '', line).strip()
+        normalized = normalize_claim(claim)
+        if len(normalized.split()) < 3 or normalized == 'none' or normalized in seen:
+            continue
+        seen.add(normalized)
+        claims.append(claim)
+    return claims
+
+
+class SearchHit:
+    source: str  # url, or path of the document
+    title: str
+    text: str
+
+    def __init__(self, source: str, title: str, text: str):
+        self.source = source
+        self.title = title
+        self.text = text
+
+    def __repr__(self) -> str:
+        return f"SearchHit(source={self.source!r}, title={self.title!r}, length={len(self.text)!r})"
+
+
+class SearchBackend:
+    # search(query, max_results) -> [SearchHit], called from many threads at once
+    name: str = 'none'
+
+    def search(self, query: str, max_results: int) -> list:
+        raise NotImplementedError
+
+
+class GoogleSearchBackend(SearchBackend):
+    name = 'google'
+
+    def fetch(self, url: str) -> SearchHit:
+        # pages are cached by url, popular pages are downloaded once
+        key = fingerprint('page', url)
+        page = page_cache.get(key)
+        if page is None:
+            from langchain_community.document_loaders import WebBaseLoader
+            documents = WebBaseLoader(url).load()
+            page = {'title': documents[0].metadata.get('title', url) if documents else url,
+                    'text': ' '.join(' '.join(document.page_content.split()) for document in documents)}
+            page_cache.put(key, page)
+        return SearchHit(url, page['title'], page['text'])
+
+    def search(self, query: str, max_results: int) -> list:
+        from googlesearch import search
+        hits = []
+        for url in search(query, num=max_results, stop=max_results, pause=1.0):
+            try:
+                hits.append(self.fetch(url))
+            except Exception as error:
+                logger.warning("Page not fetched: %s %r", url, error)
+        return hits
+
+
+class LocalCorpusBackend(SearchBackend):
+    # keyword (tf-idf) search over the paragraphs of the documents in corpus_dir, no network and no model needed
+    name = 'local'
+
+    def __init__(self, directory: str = corpus_dir):
+        self.directory = directory
+        self._paragraphs = None  # [(source, title, text, term counts)]
+        self._postings = {}  # term -> indexes of the paragraphs containing it
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._paragraphs is not None:
+                return
+            paragraphs = []
+            postings = {}
+            if exists(self.directory):
+                for root, _, file_names in os.walk(self.directory):
+                    for file_name in sorted(file_names):
+                        if not file_name.endswith(('.txt', '.md')):
+                            continue
+                        path = os.path.join(root, file_name)
+                        with open(path, 'r', errors='replace') as file:
+                            content = file.read()
+                        for number, text in enumerate(re.split(r"\n\s*\n", content)):
+                            counts = {}
+                            for term in re.findall(r"[a-z0-9]+", text.lower()):
+                                counts[term] = counts.get(term, 0) + 1
+                            if not counts:
+                                continue
+                            for term in counts:
+                                postings.setdefault(term, []).append(len(paragraphs))
+                            # every paragraph is a source of its own, so that the store chunks each one
+                            paragraphs.append((f"{path}#{number}", file_name, ' '.join(text.split()), counts))
+            self._postings = postings
+            self._paragraphs = paragraphs
+
+    def reload(self):
+        with self._lock:
+            self._paragraphs = None
+        self._load()
+
+    def search(self, query: str, max_results: int) -> list:
+        self._load()
+        total = len(self._paragraphs)
+        scores = {}
+        for term in set(re.findall(r"[a-z0-9]+", query.lower())):
+            indexes = self._postings.get(term, [])
+            idf = math.log(1 + total / len(indexes)) if indexes else 0.0
+            for index in indexes:
+                scores[index] = scores.get(index, 0.0) + (1 + math.log(self._paragraphs[index][3][term])) * idf
+        best = sorted(scores, key=lambda index: -scores[index])[:max_results]
+        return [SearchHit(*self._paragraphs[index][:3]) for index in best]
+
+
+# name -> factory of the backend, see register_search_backend
+search_backends = {
+    'google': GoogleSearchBackend,
+    'local': LocalCorpusBackend,
+}
+
+
+def register_search_backend(name: str, factory):
+    search_backends[name] = factory
+
+
+class FactcheckStore:
+    # persistent FAISS store of the chunks of all found pages and documents, shared by all candidates
+    # the embedding runs outside the lock, which is only held while the store is searched or changed,
+    # and the store is written to disk every store_save_interval added sources, and on exit
+    def __init__(self, directory: str = factcheck_store_dir):
+        self.directory = directory
+        self._store = None
+        self._sources = set()  # sources already chunked into the store
+        self._unsaved = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def metadata_path(self) -> str:
+        return f"{self.directory}/metadata.json"
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        atexit.register(self.save)
+        if not exists(f"{self.directory}/index.faiss") or not exists(self.metadata_path):
+            return
+        with open(self.metadata_path, 'r') as file:
+            metadata = json.loads(file.read())
+        if metadata.get('model') != embedding_model_name:
+            # vectors of different models can't be compared, the store is rebuilt as claims get looked up again
+            return
+
+        from langchain_community.vectorstores import FAISS
+        try:
+            self._store = FAISS.load_local(self.directory, get_embeddings(), allow_dangerous_deserialization=True)
+        except TypeError:
+            # langchain-community older than 0.0.19 doesn't know the flag, and always allows it
+            self._store = FAISS.load_local(self.directory, get_embeddings())
+        self._sources = set(metadata['sources'])
+
+    def save(self):
+        with self._lock:
+            if self._store is None or not self._unsaved:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._store.save_local(self.directory, 'index.tmp')
+            with open(f"{self.metadata_path}.tmp", 'w') as file:
+                file.write(json.dumps({'model': embedding_model_name, 'sources': sorted(self._sources)}))
+            # the metadata is replaced last, an interrupted save leaves the old sources, which are only chunked again
+            os.replace(f"{self.directory}/index.tmp.faiss", f"{self.directory}/index.faiss")
+            os.replace(f"{self.directory}/index.tmp.pkl", f"{self.directory}/index.pkl")
+            os.replace(f"{self.metadata_path}.tmp", self.metadata_path)
+            self._unsaved = 0
+
+    def add(self, hits: list):
+        from langchain_community.vectorstores import FAISS
+        with self._lock:
+            self._load()
+            new_hits = {hit.source: hit for hit in hits if hit.source not in self._sources}
+        if not new_hits:
+            return
+
+        # chunking and embedding are the slow part, they run outside the lock
+        splitter = RecursiveCharacterTextSplitter(chunk_size=int(embedding_token_limit * 0.8), chunk_overlap=0,
+                                                  length_function=count_tokens)
+        chunks = [(chunk, {'source': hit.source, 'title': hit.title})
+                  for hit in new_hits.values() for chunk in splitter.split_text(hit.text)]
+        vectors = get_embeddings().embed_documents([chunk for chunk, _ in chunks]) if chunks else []
+
+        with self._lock:
+            # a source added by a concurrent lookup in the meantime is not added twice
+            added = [(chunk, metadata, vector) for (chunk, metadata), vector in zip(chunks, vectors)
+                     if metadata['source'] not in self._sources]
+            if added:
+                text_embeddings = [(chunk, vector) for chunk, _, vector in added]
+                metadatas = [metadata for _, metadata, _ in added]
+                if self._store is None:
+                    self._store = FAISS.from_embeddings(text_embeddings, get_embeddings(), metadatas=metadatas)
+                else:
+                    self._store.add_embeddings(text_embeddings, metadatas=metadatas)
+            fresh = set(new_hits) - self._sources
+            self._sources.update(fresh)
+            self._unsaved += len(fresh)
+            if self._unsaved < store_save_interval:
+                return
+        self.save()
+
+    def retrieve(self, claim: str, k: int = context_chunks_per_claim) -> list:
+        with self._lock:
+            self._load()
+            if self._store is None:
+                return []
+        vector = get_embeddings().embed_query(claim)
+        with self._lock:
+            return self._store.similarity_search_by_vector(vector, k=k)
+
+
+class ClaimRetriever:
+    # looks up claims concurrently, at most search_concurrency at a time across all candidates,
+    # a claim which is being looked up for one candidate is shared with all others which made it too
+    def __init__(self, backend_names: list = None, concurrency: int = search_concurrency):
+        self.backend_names = backend_names or search_backend_names
+        self.backends = [search_backends[name]() for name in self.backend_names]
+        self.store = FactcheckStore()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='factcheck')
+        self._in_flight = {}  # claim key -> Future
+        self._lock = threading.Lock()
+
+    def claim_key(self, claim: str) -> str:
+        return fingerprint('claim', normalize_claim(claim), self.backend_names, embedding_model_name)
+
+    def lookup(self, claim: str) -> Future:
+        # future of [{'source', 'title', 'text'}], the context of the claim
+        key = self.claim_key(claim)
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                return future
+            cached = claim_cache.get(key)
+            future = Future()
+            if cached is not None:
+                future.set_result(cached)
+                return future
+            future = self._executor.submit(self._lookup, claim)
+            self._in_flight[key] = future
+        future.add_done_callback(lambda done: self._finish(key, done))
+        return future
+
+    def _finish(self, key: str, future: Future):
+        with self._lock:
+            self._in_flight.pop(key, None)
+        if future.exception() is None:
+            claim_cache.put(key, future.result())
+
+    def _lookup(self, claim: str) -> list:
+        hits = []
+        for backend in self.backends:
+            try:
+                with span(f"search_{backend.name}"):
+                    hits.extend(backend.search(claim, search_results_per_claim))
+            except Exception as error:
+                logger.warning("Search failed: %s %r", backend.name, error)
+        self.store.add(hits)
+        return [{'source': document.metadata.get('source'), 'title': document.metadata.get('title'),
+                 'text': document.page_content} for document in self.store.retrieve(claim)]
+
+    def lookup_many(self, claims: list) -> dict:
+        # claim -> context, a claim whose lookup failed gets an empty context
+        futures = {claim: self.lookup(claim) for claim in claims}
+        contexts = {}
+        for claim, future in futures.items():
+            try:
+                contexts[claim] = future.result()
+            except Exception as error:
+                logger.warning("Claim not checked: %s %r", claim, error)
+                contexts[claim] = []
+        return contexts
+
+
+_retriever = None
+_retriever_lock = threading.Lock()
+
+
+def get_claim_retriever() -> ClaimRetriever:
+    global _retriever
+    with _retriever_lock:
+        if _retriever is None:
+            _retriever = ClaimRetriever()
+        return _retriever
+
+
+metrics_registry.gauge('speedvue_claim_lookups_pending', "Claims being looked up, all candidates").set_function(
+    lambda: len(_retriever._in_flight) if _retriever is not None else 0)
+
+
+def format_context(contexts: dict) -> str:
+    # claims without any context are kept, the model has to know they couldn't be checked
+    sections = []
+    for claim, snippets in contexts.items():
+        sources = '\n'.join(f"[{snippet['title']}] {snippet['text']}" for snippet in snippets) or "No sources found."
+        sections.append(f"Claim: {claim}\nSources:\n{sources}")
+    return '\n\n'.join(sections)
+
+
+class ClaimContext:
+    # claims and their context for a single response, computed once and shared by the criteria which need it
+    def __init__(self, llm_chain, counter: TokenCounter = None):
+        self.llm_chain = llm_chain
+        self.counter = counter
+        self._context = None
+        self._lock = threading.Lock()
+        self._future = None  # of the async computation
+
+    def _claims_prompt_values(self, params: dict) -> list:
+        chunks = split_to_fit(claims_prompt, params, basic_token_limit)
+        return [claims_prompt.format_prompt(**{**params, 'input': chunk}) for chunk in chunks]
+
+    def _context_of(self, prompt_values: list, claims_responses: list) -> str:
+        claims = []
+        seen = set()
+        for prompt_value, claims_response in zip(prompt_values, claims_responses):
+            if self.counter is not None:
+                self.counter.record('claims', prompt_value.to_string(), claims_response, len(prompt_values))
+            for claim in parse_claims(claims_response):
+                if normalize_claim(claim) not in seen:
+                    seen.add(normalize_claim(claim))
+                    claims.append(claim)
+        if not claims:
+            return ''
+        context = format_context(get_claim_retriever().lookup_many(claims[:max_claims]))
+        return truncate_tokens(context, prompt_budget(basic_token_limit) // context_token_share)
+
+    def get(self, params: dict) -> str:
+        with self._lock:
+            if self._context is None:
+                with span('claims'):
+                    prompt_values = self._claims_prompt_values(params)
+                    self._context = self._context_of(prompt_values, self.llm_chain.batch(prompt_values))
+            return self._context
+
+    async def aget(self, params: dict) -> str:
+        # the first caller computes the context, the others wait for it
+        if self._context is None:
+            if self._future is None:
+                self._future = asyncio.ensure_future(self._acompute(params))
+            await asyncio.shield(self._future)
+        return self._context
+
+    async def _acompute(self, params: dict):
+        with span('claims'):
+            prompt_values = self._claims_prompt_values(params)
+            claims_responses = await self.llm_chain.abatch(prompt_values)
+            loop = asyncio.get_running_loop()
+            # the lookups block on the search threads
+            self._context = await loop.run_in_executor(None, self._context_of, prompt_values, claims_responses)
@@ -0,0 +1,251 @@
+# This file is the streaming ingest part of this project
+# While a video is still being uploaded, its bytes are piped into ffmpeg, which demuxes the audio track as it arrives.
+# The audio is cut into overlapping windows, each window is transcribed in the worker pool as soon as it's complete,
+# and the window transcripts are stitched together, so the transcript is ready seconds after the upload finished.
+import difflib
+import os
+import re
+import subprocess
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from starlette.concurrency import run_in_threadpool
+
+from os.path import exists
+
+from audio import SAMPLE_RATE, save_preprocessed
+from metrics import get_logger, metrics_registry
+
+streaming_ingest_enabled = os.environ.get('SPEEDVUE_STREAMING_INGEST', '1') != '0'
+
+window_seconds = 30.0  # whisper's own window
+overlap_seconds = 5.0  # heard by two windows, words cut at the end of one window are whole in the next
+stitch_search_words = 40  # at each end of two neighbouring window transcripts, the overlap is looked for in these
+stitch_min_words = 3  # the overlap is only merged if both transcripts agree on this many words in a row
+read_size = 64 * 1024
+# a streaming ingest which got no bytes for this long is given up (an abandoned upload, or one continued on another
+# worker): its demuxer is killed and its audio removed, the upload is transcribed as a whole if it's ever completed
+ingest_idle_seconds = float(os.environ.get('SPEEDVUE_INGEST_IDLE_SECONDS', '300'))
+
+# webm and matroska (browser recordings), mpeg-ts, ... can be demuxed from a stream,
+# mp4 usually can't, its index is written last, these uploads are transcribed as a whole once complete
+demux_command = ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", "pipe:0", "-vn",
+                 "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(SAMPLE_RATE), "pipe:1"]
+
+logger = get_logger('ingest')
+ingest_windows = metrics_registry.counter('speedvue_ingest_windows_total',
+                                          "Audio windows sent to transcription while uploads were streaming")
+transcript_lag = metrics_registry.histogram('speedvue_ingest_transcript_lag_seconds',
+                                            "From the end of a streamed upload to its stitched transcript")
+
+
+def normalize_word(word: str) -> str:
+    return re.sub(r"[^\w']", '', word.lower())
+
+
+def stitch_words(left: list, right: list) -> list:
+    # the overlap is heard at the end of left and at the start of right, the longest run of words
+    # both transcripts agree on is kept once: left up to its end, right after it,
+    # without such a run (e.g. silence in the overlap) both are kept whole, a repeated word is better than a lost one
+    tail = left[-stitch_search_words:]
+    head = right[:stitch_search_words]
+    matcher = difflib.SequenceMatcher(None, [normalize_word(word) for word in tail],
+                                      [normalize_word(word) for word in head], autojunk=False)
+    match = matcher.find_longest_match(0, len(tail), 0, len(head))
+    if match.size < stitch_min_words:
+        return left + right
+    return left[:len(left) - len(tail) + match.a + match.size] + right[match.b + match.size:]
+
+
+def stitch_transcripts(texts: list) -> str:
+    # texts: transcripts of consecutive overlapping windows
+    words = []
+    for text in texts:
+        words = stitch_words(words, text.split())
+    return ' '.join(words)
+
+
+class StreamingIngest:
+    # the bytes of one upload have to be fed in order, any gap (a resumed upload, a failed part) stops the streaming,
+    # the upload is then transcribed as a whole, as if it was never streamed
+    pcm_path: str
+    fed_bytes: int
+    failed: str = None  # why the streaming stopped
+
+    def __init__(self, pcm_path: str):
+        self.pcm_path = pcm_path  # all of the demuxed audio, pre-processed once the upload is complete
+        self.fed_bytes = 0
+        self.failed = None
+        self.fed_at = time.monotonic()  # of the last bytes, see ingest_idle_seconds
+        self.finishing = False  # the upload is complete, the last windows are being transcribed
+        self._windows = []  # futures of the window transcripts, in order
+        self._buffer = bytearray()  # demuxed audio of the window being filled
+        self._errors = deque(maxlen=20)  # the last lines ffmpeg logged
+        self._process = None
+        self._reader = None
+        self._error_reader = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        # raises OSError if ffmpeg is missing
+        self._process = subprocess.Popen(demux_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE)
+        self._reader = threading.Thread(target=self._read, name='ingest-reader', daemon=True)
+        self._reader.start()
+        # stderr is drained all along, ffmpeg would stall on a full pipe otherwise
+        self._error_reader = threading.Thread(target=self._read_errors, name='ingest-errors', daemon=True)
+        self._error_reader.start()
+        watch(self)
+
+    def _read(self):
+        window_bytes = int(window_seconds * SAMPLE_RATE) * 2  # 16 bit samples
+        step_bytes = int((window_seconds - overlap_seconds) * SAMPLE_RATE) * 2
+        try:
+            with open(self.pcm_path, 'wb') as pcm:
+                for data in iter(lambda: self._process.stdout.read(read_size), b''):
+                    pcm.write(data)
+                    self._buffer.extend(data)
+                    while len(self._buffer) >= window_bytes:
+                        self._submit(bytes(self._buffer[:window_bytes]))
+                        del self._buffer[:step_bytes]
+            # the rest, unless it's only the overlap, which the last window already heard
+            if len(self._buffer) > window_bytes - step_bytes or not self._windows:
+                self._submit(bytes(self._buffer))
+        except Exception as error:
+            self._fail(f"demuxed audio not read: {error!r}")
+
+    def _read_errors(self):
+        try:
+            for line in iter(self._process.stderr.readline, b''):
+                self._errors.append(line.decode(errors='replace').strip())
+        except (OSError, ValueError):  # closed by abort
+            pass
+
+    def _submit(self, data: bytes):
+        from transcription import get_transcription_service
+
+        samples = np.frombuffer(data, np.int16).astype(np.float32) / 32768.0
+        with self._lock:
+            if self.failed is None:
+                self._windows.append(get_transcription_service().submit_samples(samples))
+                ingest_windows.inc()
+
+    def _fail(self, reason: str):
+        with self._lock:
+            if self.failed is None:
+                self.failed = reason
+                logger.info("Streaming transcription stopped: %s", reason)
+
+    def feed(self, chunk: bytes):
+        if self.failed is not None:
+            return
+        try:
+            self._process.stdin.write(chunk)
+        # ffmpeg gave up on the stream (e.g. an mp4 with its index at the end), or the ingest was aborted meanwhile
+        except (OSError, ValueError) as error:
+            self._fail(f"demuxer closed: {error!r}")
+            return
+        self.fed_bytes += len(chunk)
+        self.fed_at = time.monotonic()
+
+    async def tee(self, chunks):
+        # passes the chunks of an upload through, and feeds them to the demuxer on the way
+        async for chunk in chunks:
+            if chunk and self.failed is None:
+                await run_in_threadpool(self.feed, chunk)
+            yield chunk
+
+    def transcript(self, video_path: str) -> str:
+        # blocks until all windows are transcribed, raises if the streaming failed, see transcription.submit_ingested
+        start = time.perf_counter()
+        self.finishing = True
+        try:
+            try:
+                self._process.stdin.close()
+            except OSError:
+                pass
+            self._reader.join()
+            self._error_reader.join()
+            if self._process.wait() != 0:
+                self._fail(f"demuxer failed: {' '.join(self._errors)[-500:]}")
+            if self.failed is not None:
+                raise RuntimeError(self.failed)
+            texts = [window.result() for window in self._windows]
+            # the same pre-processing report as for a transcribed video, the screening reads it, see screening.py
+            save_preprocessed(video_path, np.fromfile(self.pcm_path, np.int16).astype(np.float32) / 32768.0)
+        finally:
+            self.close()
+        transcript_lag.observe(time.perf_counter() - start)
+        logger.info("Streamed transcript of %s: %s windows, ready %.2fs after the upload", video_path, len(texts),
+                    time.perf_counter() - start)
+        return stitch_transcripts(texts)
+
+    def abort(self, reason: str = "upload aborted"):
+        self._fail(reason)
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+        self.close()
+
+    def close(self):
+        unwatch(self)
+        for window in self._windows:
+            window.cancel()
+        if self._process is not None:
+            for stream in (self._process.stdin, self._process.stdout, self._process.stderr):
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+        if exists(self.pcm_path):
+            os.remove(self.pcm_path)
+
+    def __repr__(self) -> str:
+        return (f"StreamingIngest(pcm_path={self.pcm_path!r}, fed_bytes={self.fed_bytes!r}, "
+                f"windows={len(self._windows)!r}, failed={self.failed!r})")
+
+
+_watched = set()  # ingests in progress, see watch_idle
+_watched_lock = threading.Lock()
+_watchdog = None
+
+
+def watch(ingest: StreamingIngest):
+    global _watchdog
+    with _watched_lock:
+        _watched.add(ingest)
+        if _watchdog is None:
+            _watchdog = threading.Thread(target=watch_idle, name='ingest-watchdog', daemon=True)
+            _watchdog.start()
+
+
+def unwatch(ingest: StreamingIngest):
+    with _watched_lock:
+        _watched.discard(ingest)
+
+
+def watch_idle():
+    # one thread for all ingests of the process, it aborts the ones which got no bytes for ingest_idle_seconds
+    while True:
+        time.sleep(min(30.0, ingest_idle_seconds / 2))
+        with _watched_lock:
+            ingests = list(_watched)
+        for ingest in ingests:
+            idle = time.monotonic() - ingest.fed_at
+            if not ingest.finishing and idle > ingest_idle_seconds:
+                ingest.abort(f"no bytes for {idle:.0f}s")
+
+
+def start_ingest(pcm_path: str):
+    # None if streaming is disabled or the demuxer can't be started, the upload is then transcribed once complete
+    if not streaming_ingest_enabled:
+        return None
+    ingest = StreamingIngest(pcm_path)
+    try:
+        ingest.start()
+    except OSError as error:
+        logger.warning("Streaming transcription unavailable: %r", error)
+        return None
+    return ingest
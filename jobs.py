@@ -0,0 +1,163 @@
+# This file is the job part of this project
+# Long running work (summarizing, filtering) runs in worker threads, the api only submits it and returns a job id.
+# Jobs report their progress, can be cancelled, and submitting the same work twice returns the already running job.
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from database import hashid
+from metrics import get_logger, metrics_registry
+
+logger = get_logger('jobs')
+
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# summarizing jobs mostly wait for the llm, whose capacity the scheduler shares fairly (see scheduler.py),
+# so the jobs of all tenants run side by side, instead of a large batch holding up the jobs submitted after it
+summarizing_workers = int(os.environ.get('SPEEDVUE_SUMMARIZING_JOBS', '16'))
+# finished jobs kept for the api, the oldest ones are dropped, queued and running jobs are always kept
+finished_jobs_kept = int(os.environ.get('SPEEDVUE_FINISHED_JOBS_KEPT', '200'))
+
+
+class Job:
+    job_id: str
+    kind: str
+    key: str  # identifies the work, used for deduplication
+    status: str = QUEUED
+
+    def __init__(self, kind: str, key: str):
+        self.job_id = hashid()
+        self.kind = kind
+        self.key = key
+        self.status = QUEUED
+        self.total = 0
+        self.done = 0
+        self.in_flight = 0
+        self.failed = 0
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self._lock = threading.Lock()
+
+    # progress reporting, called by the work itself
+    def set_total(self, total: int):
+        self.total = total
+
+    def item_started(self, *_):
+        with self._lock:
+            self.in_flight += 1
+
+    def item_finished(self, succeeded: bool = True):
+        with self._lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            if succeeded:
+                self.done += 1
+            else:
+                self.failed += 1
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    @property
+    def active(self) -> bool:
+        return self.status in (QUEUED, RUNNING)
+
+    def eta(self) -> float:
+        # seconds until completion, based on the throughput so far, None until the first item finishes
+        finished = self.done + self.failed
+        if self.status != RUNNING or not finished or not self.total:
+            return None
+        elapsed = time.time() - self.started_at
+        return elapsed / finished * (self.total - finished)
+
+    def to_dict(self) -> dict:
+        return {'job_id': self.job_id, 'kind': self.kind, 'status': self.status, 'total': self.total,
+                'done': self.done, 'in_flight': self.in_flight, 'failed': self.failed, 'eta': self.eta(),
+                'submitted_at': self.submitted_at, 'started_at': self.started_at, 'finished_at': self.finished_at,
+                'result': self.result, 'error': self.error}
+
+    def __repr__(self) -> str:
+        return (f"Job(job_id={self.job_id!r}, kind={self.kind!r}, status={self.status!r}, "
+                f"done={self.done!r}, failed={self.failed!r}, total={self.total!r})")
+
+
+class JobManager:
+    # kind_workers: kind -> workers of its own pool, the other kinds share a pool of max_workers
+    def __init__(self, max_workers: int = 2, kind_workers: dict = None, finished_kept: int = finished_jobs_kept):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._kind_executors = {kind: ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'job-{kind}')
+                                for kind, workers in (kind_workers or {}).items()}
+        self._jobs = {}  # job_id -> Job
+        self._active = {}  # (kind, key) -> Job, only queued or running jobs
+        self._finished = deque()  # job ids, in order of completion
+        self.finished_kept = finished_kept
+        self._lock = threading.Lock()
+
+    def submit(self, kind: str, key: str, function, *args, **kwargs) -> Job:
+        # function(*args, job=job, **kwargs) runs in a worker thread, its return value becomes job.result
+        with self._lock:
+            job = self._active.get((kind, key))
+            if job is not None:
+                return job
+            job = Job(kind, key)
+            self._jobs[job.job_id] = job
+            self._active[(kind, key)] = job
+
+        self._kind_executors.get(kind, self._executor).submit(self._run, job, function, args, kwargs)
+        return job
+
+    def _run(self, job: Job, function, args, kwargs):
+        try:
+            if job.cancelled:
+                job.status = CANCELLED
+                return
+            job.status = RUNNING
+            job.started_at = time.time()
+            job.result = function(*args, job=job, **kwargs)
+            job.status = CANCELLED if job.cancelled else COMPLETED
+        except Exception as error:
+            job.error = repr(error)
+            job.status = FAILED
+            logger.error("Job failed: %s %r", job.job_id, error)
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                self._active.pop((job.kind, job.key), None)
+                self._finished.append(job.job_id)
+                while len(self._finished) > self.finished_kept:
+                    self._jobs.pop(self._finished.popleft(), None)
+
+    def get(self, job_id: str) -> Job:
+        return self._jobs.get(job_id)
+
+    def list(self) -> list:
+        return list(self._jobs.values())
+
+    def cancel(self, job_id: str) -> Job:
+        # work which is already in flight finishes, nothing new gets started
+        job = self._jobs.get(job_id)
+        if job is not None and job.active:
+            job.cancel_event.set()
+        return job
+
+
+def count_jobs(job_list: list) -> dict:
+    counts = {}
+    for job in job_list:
+        counts[(job.kind, job.status)] = counts.get((job.kind, job.status), 0) + 1
+    return counts
+
+
+job_manager = JobManager(kind_workers={'summarizing': summarizing_workers})
+metrics_registry.gauge('speedvue_jobs', "Jobs by kind and status", ('kind', 'status')).set_function(
+    lambda: count_jobs(job_manager.list()))
@@ -0,0 +1,133 @@
+# This file is the llm response cache of this project
+# Responses are stored in SQLite, keyed by the model, its sampling parameters and the exact prompt text.
+# A byte-identical prompt sent to the same model is answered from disk, reruns after a crash are almost free.
+# Sampled calls whose answers have to be independent (the viability votes) must not use this cache.
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+
+from langchain_core.runnables import RunnableLambda
+
+from cache import fingerprint, monitored_caches
+
+llm_cache_enabled = os.environ.get('SPEEDVUE_LLM_CACHE_ENABLED', '1') != '0'
+llm_cache_path = os.environ.get('SPEEDVUE_LLM_CACHE', 'data/cache/llm.sqlite')
+llm_cache_max_entries = 200000
+llm_cache_ttl = 30 * 24 * 60 * 60  # seconds, 0 disables expiry
+
+
+class LLMCache:
+    def __init__(self, path: str = llm_cache_path, max_entries: int = llm_cache_max_entries,
+                 ttl: float = llm_cache_ttl):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()  # sqlite connections can't be shared between threads
+        self._lock = threading.Lock()
+        self._puts_since_eviction = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, model TEXT, "
+                               "response TEXT, created_at REAL, last_used REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_used ON llm_cache (last_used)")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str) -> str:
+        connection = self._connection()
+        row = connection.execute("SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is not None and self.ttl and now - row[1] > self.ttl:
+            connection.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            row = None
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        connection.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def put(self, key: str, model: str, response: str):
+        now = time.time()
+        self._connection().execute("INSERT OR REPLACE INTO llm_cache (key, model, response, created_at, last_used) "
+                                   "VALUES (?, ?, ?, ?, ?)", (key, model, response, now, now))
+        with self._lock:
+            self._puts_since_eviction += 1
+            # counting rows on every put would be wasteful, the limit is enforced every 1% of it
+            evict = self._puts_since_eviction >= max(1, self.max_entries // 100)
+            if evict:
+                self._puts_since_eviction = 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        # drops expired entries, then the least recently used ones over the limit
+        connection = self._connection()
+        if self.ttl:
+            connection.execute("DELETE FROM llm_cache WHERE created_at < ?", (time.time() - self.ttl,))
+        count = connection.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        if count > self.max_entries:
+            connection.execute("DELETE FROM llm_cache WHERE key IN "
+                               "(SELECT key FROM llm_cache ORDER BY last_used LIMIT ?)", (count - self.max_entries,))
+
+    def clear(self):
+        self._connection().execute("DELETE FROM llm_cache")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': self._connection().execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]}
+
+
+llm_cache = LLMCache()
+monitored_caches['llm'] = llm_cache
+
+
+def llm_cache_key(llm, prompt_text: str) -> str:
+    # _identifying_params holds the model name and every sampling option (temperature, top_p, num_ctx, ...)
+    return fingerprint(type(llm).__name__, getattr(llm, '_identifying_params', {}), prompt_text)
+
+
+def cached_llm(runnable, llm, cache: LLMCache = None):
+    # runnable: llm itself, or a wrapper of it (e.g. limited_llm), llm identifies the model for the key,
+    # lookups happen before the runnable, so cache hits never wait for a concurrency slot
+    if not llm_cache_enabled:
+        return runnable
+    cache = cache or llm_cache
+    model = getattr(llm, 'model', type(llm).__name__)
+
+    def prompt_text(prompt_value) -> str:
+        return prompt_value if isinstance(prompt_value, str) else prompt_value.to_string()
+
+    def invoke(prompt_value) -> str:
+        key = llm_cache_key(llm, prompt_text(prompt_value))
+        response = cache.get(key)
+        if response is None:
+            response = runnable.invoke(prompt_value)
+            cache.put(key, model, response)
+        return response
+
+    async def ainvoke(prompt_value) -> str:
+        # sqlite is blocking, the event loop is shared with every other assessment and with the server's requests
+        loop = asyncio.get_running_loop()
+        key = llm_cache_key(llm, prompt_text(prompt_value))
+        response = await loop.run_in_executor(None, cache.get, key)
+        if response is None:
+            response = await runnable.ainvoke(prompt_value)
+            await loop.run_in_executor(None, cache.put, key, model, response)
+        return response
+
+    return RunnableLambda(invoke, afunc=ainvoke)
@@ -0,0 +1,247 @@
+# This file is the instrumentation part of this project
+# Stages of the pipeline are timed with spans, and counted with counters, histograms and gauges, which server.py
+# exposes in the Prometheus text format under /metrics. No client library is needed, the format is plain text.
+# Logging goes through the 'speedvue' logger, its level is set with SPEEDVUE_LOG_LEVEL (DEBUG, INFO, ..., OFF).
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from colorama import Fore, Style
+
+log_level = os.environ.get('SPEEDVUE_LOG_LEVEL', 'INFO').upper()
+# seconds, from a cached llm response to a long transcription
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+level_colors = {
+    logging.DEBUG: Fore.WHITE,
+    logging.INFO: Fore.CYAN,
+    logging.WARNING: Fore.YELLOW,
+    logging.ERROR: Fore.RED,
+    logging.CRITICAL: Fore.RED,
+}
+
+
+class ColorFormatter(logging.Formatter):
+    # the level and the logger are highlighted when logging to a terminal, files get plain lines
+    def __init__(self, colored: bool):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+        self.colored = colored
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        if not self.colored:
+            return line
+        prefix = f"{record.levelname} {record.name}:"
+        color = level_colors.get(record.levelno, Fore.WHITE)
+        return line.replace(prefix, f"{color}{Style.BRIGHT}{prefix}{Fore.RESET}{Style.RESET_ALL}", 1)
+
+
+def configure_logging(level: str = log_level):
+    root_logger = logging.getLogger('speedvue')
+    if level == 'OFF':
+        root_logger.setLevel(logging.CRITICAL + 1)
+    else:
+        root_logger.setLevel(getattr(logging, level, logging.INFO))
+    if not root_logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(ColorFormatter(sys.stdout.isatty()))
+        root_logger.addHandler(handler)
+        root_logger.propagate = False
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"speedvue.{name}")
+
+
+def format_labels(names: tuple, values: tuple, extra: str = None) -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metric:
+    # values are kept per label values, in the order of labelnames
+    metric_type: str = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._function = None
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def set_function(self, function):
+        # the value is read at scrape time: function() -> value, or {label values tuple: value}
+        self._function = function
+
+    def samples(self) -> list:
+        # [(suffix, label values, extra label, value)]
+        if self._function is not None:
+            values = self._function()
+            values = values if isinstance(values, dict) else {(): values}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [('', key, None, value) for key, value in sorted(values.items())]
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(self.labelnames, key, extra)} {float(value)!r}")
+        return lines
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(name={self.name!r}, labelnames={self.labelnames!r})"
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Counter):
+    metric_type = 'gauge'
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    @contextmanager
+    def track(self, **labels):
+        # the number of threads or tasks inside the block
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = default_buckets):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, observations = self._values.get(key, ((0,) * len(self.buckets), 0.0, 0))
+            counts = tuple(count + (value <= bound) for count, bound in zip(counts, self.buckets))
+            self._values[key] = (counts, total + value, observations + 1)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            return self._values.get(self._key(labels), ((), 0.0, 0))[2]
+
+    def sum(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), ((), 0.0, 0))[1]
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list:
+        # buckets are cumulative, +Inf counts every observation, also the ones above the last bucket
+        with self._lock:
+            values = dict(self._values)
+        samples = []
+        for key, (counts, total, observations) in sorted(values.items()):
+            for count, bound in zip(counts, self.buckets):
+                samples.append(('_bucket', key, f'le="{bound!r}"', count))
+            samples.append(('_bucket', key, 'le="+Inf"', observations))
+            samples.append(('_sum', key, None, total))
+            samples.append(('_count', key, None, observations))
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: Metric) -> Metric:
+        with self._lock:
+            # registering a name again returns the metric registered first
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = default_buckets) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def get(self, name: str) -> Metric:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as error:  # one broken collector must not break the whole scrape
+                logger.warning("Metric not collected: %s %r", metric.name, error)
+        return '\n'.join(lines) + '\n'
+
+
+configure_logging()
+logger = get_logger('metrics')
+metrics_registry = MetricsRegistry()
+
+stage_seconds = metrics_registry.histogram(
+    'speedvue_stage_seconds', "Duration of pipeline stages (transcription, criteria, summary, votes, ...)", ('stage',))
+stage_failures = metrics_registry.counter(
+    'speedvue_stage_failures_total', "Pipeline stages which raised an error", ('stage',))
+llm_tokens = metrics_registry.counter(
+    'speedvue_llm_tokens_total', "Tokens sent to (prompt) and received from (completion) the llms", ('stage', 'kind'))
+llm_calls = metrics_registry.counter('speedvue_llm_calls_total', "Llm calls, cached ones included", ('stage',))
+
+
+@contextmanager
+def span(stage: str, candidate_id: str = None):
+    # times the block into speedvue_stage_seconds, and logs the duration of this candidate's stage
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        stage_failures.inc(stage=stage)
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        stage_seconds.observe(duration, stage=stage)
+        if candidate_id is not None:
+            logger.debug("Stage %s of %s took %.3fs", stage, candidate_id, duration)
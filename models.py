@@ -0,0 +1,180 @@
+# This file manages all the models used by the assessment pipeline
+# Nothing heavy is loaded on import, every model is loaded on first use, and then shared between all callers.
+# Server workers which only handle uploads or serve the frontend never pay for whisper, torch or the llm clients.
+import gc
+import os
+import sys
+import threading
+import time
+
+from metrics import get_logger, metrics_registry
+
+# MODELS: zephyr:7b-beta-q5_K_M is really the minimum i will allow for the basic evaluation
+#         for master_, we have to find something much better to give more insight based on the responses.
+#         for embedding_, choice is between MiniLM-L6 and Glove, MiniLM-L6 it is: `ollama pull all-minilm`,
+#         22M parameters and 384 dimensions, a 7B chat model is far too slow and heavy for embeddings.
+
+basic_model_name = os.environ.get('SPEEDVUE_BASIC_MODEL', "zephyr:7b-beta-q5_K_M")  # "llama2-uncensored:7b"
+basic_model_base_name = basic_model_name.split(':')[0]
+basic_token_limit = 4096  # depending on VRAM, try 2048, 3072 or 4096. 2048 works great on 4GB VRAM
+
+master_model_name = os.environ.get('SPEEDVUE_MASTER_MODEL', "zephyr:7b-beta-q5_K_M")  # "llama2-uncensored:7b"
+master_model_base_name = master_model_name.split(':')[0]
+master_token_limit = 4096
+
+embedding_model_name = "all-minilm:l6-v2"
+embedding_model_base_name = embedding_model_name.split(':')[0]
+embedding_token_limit = 256  # longer inputs are cut by the model, see transcript_index.embed_text
+
+# optional second tier of the screening, a small and fast model, off unless named, see screening.py
+screening_model_name = os.environ.get('SPEEDVUE_SCREENING_MODEL')  # e.g. "qwen2:0.5b"
+screening_token_limit = 2048
+
+# how long ollama keeps a model loaded after its last request, batches keep the model they use warm with it,
+# see batch.ResidencyLimiter, ollama's own default is 5 minutes
+llm_keep_alive = os.environ.get('SPEEDVUE_LLM_KEEP_ALIVE', '30m')
+
+transcription_model_name = "base.en"
+token_encoder_name = "cl100k_base"
+
+
+def get_device() -> str:
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def ollama_llm(**options):
+    from langchain_community.llms.ollama import Ollama
+    # keep_alive is only known to newer clients, older ones use ollama's default
+    if 'keep_alive' in Ollama.__fields__:
+        options['keep_alive'] = llm_keep_alive
+    return Ollama(**options)
+
+
+def load_basic_llm():
+    # num_ctx has to match the token limit, otherwise ollama uses its own default, and silently cuts longer prompts
+    return ollama_llm(model=basic_model_name, num_ctx=basic_token_limit)
+
+
+def load_master_llm():
+    return ollama_llm(model=master_model_name, num_ctx=master_token_limit)
+
+
+def load_screening_llm():
+    # the answer is a single word, a short one is forced
+    return ollama_llm(model=screening_model_name, num_ctx=screening_token_limit, num_predict=8)
+
+
+def load_embeddings():
+    from langchain_community.embeddings import OllamaEmbeddings
+    return OllamaEmbeddings(model=embedding_model_name)
+
+
+def load_transcription_model():
+    import whisper
+    return whisper.load_model(transcription_model_name, device=get_device())
+
+
+def load_token_encoder():
+    import tiktoken
+    return tiktoken.get_encoding(token_encoder_name)
+
+
+class ModelRegistry:
+    # Thread-safe, lazy container of named models.
+    # Each model has its own lock, so loading whisper does not block a request which only needs the tokenizer.
+    def __init__(self):
+        self._loaders = {}
+        self._models = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self.load_times = {}  # name -> seconds spent in the last load
+
+    def register(self, name: str, loader):
+        with self._lock:
+            self._loaders[name] = loader
+            self._locks[name] = threading.Lock()
+
+    def names(self) -> list:
+        return list(self._loaders.keys())
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._models
+
+    def get(self, name: str):
+        model = self._models.get(name)
+        if model is not None:
+            return model
+
+        if name not in self._loaders:
+            raise KeyError(f"Unknown model: {name}")
+
+        with self._locks[name]:
+            # another thread could have finished loading while we were waiting for the lock
+            model = self._models.get(name)
+            if model is None:
+                start = time.perf_counter()
+                model = self._loaders[name]()
+                self.load_times[name] = time.perf_counter() - start
+                self._models[name] = model
+                logger.info("Loaded model: %s in %.2fs", name, self.load_times[name])
+        return model
+
+    def warm_up(self, *names: str):
+        # load the given models ahead of time, or all of them if none are given
+        for name in names or self.names():
+            self.get(name)
+
+    def unload(self, *names: str):
+        # drop the given models, or all of them if none are given, they will be reloaded on next use
+        unloaded_any = False
+        for name in names or self.names():
+            with self._locks[name]:
+                if self._models.pop(name, None) is not None:
+                    unloaded_any = True
+
+        if unloaded_any:
+            gc.collect()
+            # only touch torch if a model already imported it, importing it here would defeat the purpose
+            if 'torch' in sys.modules:
+                import torch
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+
+
+logger = get_logger('models')
+model_registry = ModelRegistry()
+metrics_registry.gauge('speedvue_model_load_seconds', "Duration of the last load of each loaded model",
+                       ('model',)).set_function(
+    lambda: {(name,): seconds for name, seconds in model_registry.load_times.items() if model_registry.is_loaded(name)})
+model_registry.register('basic_llm', load_basic_llm)
+model_registry.register('master_llm', load_master_llm)
+if screening_model_name:
+    model_registry.register('screening_llm', load_screening_llm)
+model_registry.register('embeddings', load_embeddings)
+model_registry.register('transcription_model', load_transcription_model)
+model_registry.register('token_encoder', load_token_encoder)
+
+
+def get_basic_llm():
+    return model_registry.get('basic_llm')
+
+
+def get_master_llm():
+    return model_registry.get('master_llm')
+
+
+def get_screening_llm():
+    return model_registry.get('screening_llm')
+
+
+def get_embeddings():
+    return model_registry.get('embeddings')
+
+
+def get_transcription_model():
+    return model_registry.get('transcription_model')
+
+
+def get_token_encoder():
+    return model_registry.get('token_encoder')
@@ -0,0 +1,124 @@
+# This file is the read side of the database of this project
+# Whole batches are loaded in a fixed number of queries (one per level of the tree, filtered by the batch ids,
+# not by the ids of the level above), and returned as read-only views (named tuples) built from plain rows,
+# so that nothing outside this file touches live ORM objects or triggers lazy loads.
+from typing import List, NamedTuple, Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from database import get_session, association_table, Company, Batch, Recruiter, Applicant, Application, Response, \
+    Assessment
+
+
+class ApplicantView(NamedTuple):
+    id: str
+    name: str
+    surname: str
+    email: str
+    phone: str
+    phone_country_code: str
+    phone_extension: str
+    country: str
+    city: str
+    address: str
+
+
+class RecruiterView(NamedTuple):
+    id: str
+    name: str
+    surname: str
+    title: str
+    email: str
+
+
+class AssessmentView(NamedTuple):
+    # the texts of the assessment are left out, see database.load_assessment for those
+    id: str
+    fingerprint: str
+    viable: Optional[bool]
+    vote_score: Optional[int]
+    vote_confidence: Optional[float]
+    updated_at: float
+
+
+class ResponseView(NamedTuple):
+    id: str
+    task_text: str
+    assessment: Optional[AssessmentView]
+
+
+class ApplicationView(NamedTuple):
+    id: str
+    applicant: ApplicantView
+    responses: tuple  # of ResponseView
+
+    def __repr__(self) -> str:
+        return f"ApplicationView(id={self.id!r}, applicant_id={self.applicant.id!r}, responses={len(self.responses)})"
+
+
+class BatchView(NamedTuple):
+    id: str
+    company_id: str
+    company_name: str
+    job_title: str
+    description: str
+    recruiters: tuple  # of RecruiterView
+    applications: tuple  # of ApplicationView
+
+    def __repr__(self) -> str:
+        return (f"BatchView(id={self.id!r}, company_id={self.company_id!r}, job_title={self.job_title!r}, "
+                f"recruiters={len(self.recruiters)}, applications={len(self.applications)})")
+
+
+def load_batches(batch_ids: List[str], session: Session = None) -> List[BatchView]:
+    # 4 queries no matter the size of the batches: batches with their companies, recruiters,
+    # applications with their applicants, responses with their assessments
+    # session: optional, an already open session to run the queries in
+    if session is None:
+        with get_session() as session:
+            return load_batches(batch_ids, session)
+
+    batch_rows = session.execute(
+        select(Batch.id, Batch.company_id, Company.name, Batch.job_title, Batch.description)
+        .outerjoin(Company, Company.id == Batch.company_id)
+        .where(Batch.id.in_(batch_ids))).all()
+
+    recruiters = {batch_id: [] for batch_id in batch_ids}
+    for row in session.execute(
+            select(association_table.c.batch_id, Recruiter.id, Recruiter.name, Recruiter.surname, Recruiter.title,
+                   Recruiter.email)
+            .join(Recruiter, Recruiter.id == association_table.c.recruiter_id)
+            .where(association_table.c.batch_id.in_(batch_ids))):
+        recruiters[row[0]].append(RecruiterView(*row[1:]))
+
+    responses = {}  # application id -> [ResponseView]
+    for row in session.execute(
+            select(Response.application_id, Response.id, Response.task_text, Assessment.id, Assessment.fingerprint,
+                   Assessment.viable, Assessment.vote_score, Assessment.vote_confidence, Assessment.updated_at)
+            .join(Application, Application.id == Response.application_id)
+            .outerjoin(Assessment, Assessment.response_id == Response.id)
+            .where(Application.batch_id.in_(batch_ids))
+            .order_by(Response.id)):
+        assessment = AssessmentView(*row[3:]) if row[3] is not None else None
+        responses.setdefault(row[0], []).append(ResponseView(row[1], row[2], assessment))
+
+    applications = {batch_id: [] for batch_id in batch_ids}
+    for row in session.execute(
+            select(Application.batch_id, Application.id, Applicant.id, Applicant.name, Applicant.surname,
+                   Applicant.email, Applicant.phone, Applicant.phone_country_code, Applicant.phone_extension,
+                   Applicant.country, Applicant.city, Applicant.address)
+            .join(Applicant, Applicant.id == Application.applicant_id)
+            .where(Application.batch_id.in_(batch_ids))
+            .order_by(Application.id)):
+        applications[row[0]].append(ApplicationView(row[1], ApplicantView(*row[2:]),
+                                                    tuple(responses.get(row[1], ()))))
+
+    return [BatchView(batch_id, company_id, company_name, job_title, description, tuple(recruiters[batch_id]),
+                      tuple(applications[batch_id]))
+            for batch_id, company_id, company_name, job_title, description in batch_rows]
+
+
+def load_batch(batch_id: str, session: Session = None) -> Optional[BatchView]:
+    batches = load_batches([batch_id], session)
+    return batches[0] if batches else None
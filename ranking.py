@@ -0,0 +1,217 @@
+# This file is the ranking part of this project
+# Candidates are ranked by comparing their assessments with each other, two at a time, using binary insertion:
+# every candidate is inserted into the already ranked list with O(log n) comparisons, O(n log n) for a whole batch.
+# Every comparison asks both orderings of the pair (to cancel out the bias of the llm towards one position),
+# and its verdict is stored, so ranking again, or adding a new candidate to a ranking, reuses all earlier verdicts.
+# The comparisons take the slots of the inserted candidate's tenant in the fair_scheduler, see scheduler.py.
+import asyncio
+import re
+
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+
+from metrics import get_logger, span
+
+from models import get_basic_llm, basic_model_name
+from cache import fingerprint, prompt_fingerprint
+from database import load_assessments, get_comparison, save_comparison, load_ranking, save_ranking, hashid
+from scheduler import fair_scheduler, current_tenant, resolve_tenants, Tenant
+
+FIRST = 1
+SECOND = -1
+
+comparison_prompt = ChatPromptTemplate.from_messages([
+    ("system", "You are a hiring manager."
+               "Your job is to choose the better of two candidates for the position."
+               "You are presented with summarized performances of both candidates, the first and the second one."
+               "Prefer candidates who are truthful, knowledgeable and offer more potential."
+               "Respond with a FIRST or SECOND response, DO NOT add any unnecessary text."
+               "Response has to be VERY VERY SHORT, reply with ONLY 'first' or 'second'."),
+    ("user", "First candidate was tasked with: \"{first_task}\""
+             "First candidate summary: ```{first_assessment}```"
+             "First candidate knowledge: ```{first_knowledge}```"
+             "Second candidate was tasked with: \"{second_task}\""
+             "Second candidate summary: ```{second_assessment}```"
+             "Second candidate knowledge: ```{second_knowledge}```")
+])
+
+# a changed prompt or model invalidates all cached comparisons
+comparison_prompt_fingerprint = prompt_fingerprint(comparison_prompt)
+
+default_ranking_id = 'default'
+
+logger = get_logger('ranking')
+
+
+def parse_preference(comparison_response: str):
+    # strict, same as voting.parse_vote: has to start with 'first' or 'second', and must not mention the other one
+    words = re.findall(r"[a-z]+", comparison_response.lower())
+    if not words or words[0] not in ('first', 'second'):
+        return None
+    if words[0] == 'first':
+        return None if 'second' in words else FIRST
+    return None if 'first' in words else SECOND
+
+
+def comparison_key(first_fingerprint: str, second_fingerprint: str) -> str:
+    # the key is bound to the assessments, not the candidates, a re-assessed candidate gets compared again
+    return fingerprint('comparison', first_fingerprint, second_fingerprint, basic_model_name,
+                       comparison_prompt_fingerprint)
+
+
+class ComparisonResult:
+    score: int  # -2 .. 2, positive when the first candidate is better
+    confidence: float  # 1.0 when both orderings agree, 0.5 when they contradict each other
+
+    def __init__(self, score: int, confidence: float):
+        self.score = score
+        self.confidence = confidence
+
+    def __repr__(self) -> str:
+        return f"ComparisonResult(score={self.score!r}, confidence={self.confidence!r})"
+
+
+class Comparator:
+    def __init__(self, summaries: dict, tenants: dict = None, max_retries: int = 2):
+        # summaries: candidate id -> summary, see assessment.build_summary
+        # tenants: candidate id -> scheduler.Tenant, the comparisons of a candidate's insertion are its tenant's
+        from assessment import limited_llm
+        self.summaries = summaries
+        self.tenants = tenants or {}
+        self.max_retries = max_retries
+        self.chain = (comparison_prompt | limited_llm(get_basic_llm(), basic_model_name, fair_scheduler,
+                                                        stage='comparison') | StrOutputParser())
+        self.comparisons = 0
+        self.cache_hits = 0
+        self.calls = 0
+
+    def params(self, first_id: str, second_id: str) -> dict:
+        first, second = self.summaries[first_id], self.summaries[second_id]
+        return {'first_task': first['task'], 'first_assessment': first['assessment'],
+                'first_knowledge': first.get('cache_knowledge', ''),
+                'second_task': second['task'], 'second_assessment': second['assessment'],
+                'second_knowledge': second.get('cache_knowledge', '')}
+
+    async def ask(self, first_id: str, second_id: str, tenant: Tenant = None) -> ComparisonResult:
+        # both orderings are asked at once, only answers which could not be parsed are asked again
+        current_tenant.set(tenant)
+        requests = [self.params(first_id, second_id), self.params(second_id, first_id)]
+        answers = [None, None]
+        pending = [0, 1]
+        with span('comparison'):
+            for _ in range(self.max_retries + 1):
+                if not pending:
+                    break
+                responses = await self.chain.abatch([requests[index] for index in pending])
+                self.calls += len(pending)
+                for index, response in zip(pending, responses):
+                    answers[index] = parse_preference(response)
+                pending = [index for index in pending if answers[index] is None]
+
+        # in the swapped ordering, 'second' is a vote for the first candidate
+        score = (answers[0] or 0) - (answers[1] or 0)
+        return ComparisonResult(score, 0.5 + abs(score) / 4)
+
+    def compare(self, first_id: str, second_id: str) -> ComparisonResult:
+        self.comparisons += 1
+        tenant = self.tenants.get(first_id)  # first_id is the candidate being inserted, see insertion_position
+        first_fingerprint = self.summaries[first_id]['fingerprint']
+        second_fingerprint = self.summaries[second_id]['fingerprint']
+        # verdicts are stored for one ordering of the pair only, and flipped when asked the other way around
+        flipped = first_fingerprint > second_fingerprint
+        if flipped:
+            first_id, second_id = second_id, first_id
+            first_fingerprint, second_fingerprint = second_fingerprint, first_fingerprint
+
+        key = comparison_key(first_fingerprint, second_fingerprint)
+        stored = get_comparison(key)
+        if stored is not None:
+            self.cache_hits += 1
+            result = ComparisonResult(stored.score, stored.confidence)
+        else:
+            result = asyncio.run(self.ask(first_id, second_id, tenant))
+            save_comparison(key, first_id, second_id, result.score, result.confidence)
+
+        return ComparisonResult(-result.score, result.confidence) if flipped else result
+
+
+def insertion_position(ranked_ids: list, candidate_id: str, comparator: Comparator) -> tuple:
+    # binary search for the position of the candidate in ranked_ids (best first), ties are placed after,
+    # returns (position, confidence), the confidence being the lowest of the comparisons which decided it
+    low, high = 0, len(ranked_ids)
+    confidence = 1.0
+    while low < high:
+        middle = (low + high) // 2
+        result = comparator.compare(candidate_id, ranked_ids[middle])
+        confidence = min(confidence, result.confidence)
+        if result.score > 0:
+            high = middle
+        else:
+            low = middle + 1
+    return low, confidence
+
+
+class RankedCandidate:
+    candidate_id: str
+    position: int
+    confidence: float
+
+    def __init__(self, candidate_id: str, position: int, confidence: float):
+        self.candidate_id = candidate_id
+        self.position = position
+        self.confidence = confidence
+
+    def to_dict(self) -> dict:
+        return {'candidate_id': self.candidate_id, 'position': self.position, 'confidence': self.confidence}
+
+    def __repr__(self) -> str:
+        return (f"RankedCandidate(candidate_id={self.candidate_id!r}, position={self.position!r}, "
+                f"confidence={self.confidence!r})")
+
+
+def get_ranking(ranking_id: str = default_ranking_id) -> list:
+    return [RankedCandidate(entry.assessment_id, entry.position, entry.confidence)
+            for entry in load_ranking(ranking_id)]
+
+
+def rank_candidates(candidate_ids: list = None, ranking_id: str = default_ranking_id, job=None) -> list:
+    # ranks the given candidates (by default all summarized candidates which weren't rejected), best first
+    # the stored ranking is extended: candidates already in it keep their place, unless their assessment changed,
+    # candidates which are not given anymore are dropped from it
+    # the comparisons are scheduled as the candidates' companies and batches, as in assessment.summarize_candidates
+    if candidate_ids is None:
+        from assessment import get_summarized_candidates
+        candidate_ids = get_summarized_candidates()
+
+    summaries = load_assessments(candidate_ids)
+    ranked = [entry for entry in load_ranking(ranking_id)
+              if entry.assessment_id in summaries
+              and entry.fingerprint == summaries[entry.assessment_id]['fingerprint']]
+    ranked_ids = [entry.assessment_id for entry in ranked]
+    confidences = {entry.assessment_id: entry.confidence for entry in ranked}
+    pending = [candidate_id for candidate_id in candidate_ids
+               if candidate_id in summaries and candidate_id not in confidences]
+
+    comparator = Comparator(summaries, resolve_tenants(pending, job.key if job is not None else hashid()))
+    if job is not None:
+        job.set_total(len(pending))
+
+    for candidate_id in pending:
+        if job is not None:
+            if job.cancelled:
+                break
+            job.item_started(candidate_id)
+        position, confidence = insertion_position(ranked_ids, candidate_id, comparator)
+        ranked_ids.insert(position, candidate_id)
+        confidences[candidate_id] = confidence
+        if job is not None:
+            job.item_finished()
+
+    save_ranking(ranking_id, [{'assessment_id': candidate_id, 'fingerprint': summaries[candidate_id]['fingerprint'],
+                               'confidence': confidences[candidate_id]} for candidate_id in ranked_ids])
+
+    logger.info("Ranked %s candidates, comparisons: %s cached: %s llm calls: %s", len(ranked_ids),
+                comparator.comparisons, comparator.cache_hits, comparator.calls)
+
+    return [RankedCandidate(candidate_id, position, confidences[candidate_id])
+            for position, candidate_id in enumerate(ranked_ids)]
@@ -0,0 +1,270 @@
+# This file is the scheduling part of this project
+# Every llm call of every job and of every stream client waits here for a slot of its model, so the llm host is shared
+# by all tenants (companies, and the batches of each company). Free slots are handed out by weighted fair queuing:
+# the company which got the least llm time so far (over its weight) goes next, and within it the batch which got
+# the least, so one company's huge batch can't starve everyone else. Interactive requests (a client following
+# a single candidate) go before bulk work, and a company can be capped in its concurrent requests.
+import asyncio
+import contextvars
+import itertools
+import os
+import threading
+import time
+from collections import deque
+
+from database import get_tenants
+from metrics import metrics_registry
+
+# number of parallel requests each model is allowed to receive, should match OLLAMA_NUM_PARALLEL of the server
+default_llm_concurrency = 2
+llm_concurrency = {}  # model_name -> limit, overrides default_llm_concurrency
+tenant_weights = {}  # company id -> weight, 1 by default, a company of weight 2 gets twice the llm time of weight 1
+tenant_quotas = {}  # company id -> max concurrent llm requests, overrides default_tenant_quota
+default_tenant_quota = int(os.environ.get('SPEEDVUE_TENANT_QUOTA', '0'))  # 0: no cap, the fair share only
+default_company = 'default'  # tenant of the candidates which aren't bound to a batch in the db
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+tenant_wait_seconds = metrics_registry.histogram('speedvue_tenant_wait_seconds',
+                                                 "Wait of llm requests for a slot, by company and priority",
+                                                 ('company', 'priority'))
+# the tenant and the priority of the llm calls made in this task, the tasks of an assessment's chain inherit them
+current_tenant = contextvars.ContextVar('current_tenant', default=None)
+current_priority = contextvars.ContextVar('current_priority', default=BULK)
+
+
+class Tenant:
+    company_id: str
+    batch_id: str
+
+    def __init__(self, company_id: str, batch_id: str):
+        self.company_id = company_id
+        self.batch_id = batch_id
+
+    def __repr__(self) -> str:
+        return f"Tenant(company_id={self.company_id!r}, batch_id={self.batch_id!r})"
+
+
+class Ticket:
+    # one llm request waiting for, or holding, a slot, woken up on the event loop it waits on
+    def __init__(self, model_name: str, tenant: Tenant, priority: str, sequence: int):
+        self.model_name = model_name
+        self.company_id = tenant.company_id
+        self.batch_key = (tenant.company_id, tenant.batch_id)
+        self.priority = priority
+        self.sequence = sequence  # first come, first served within a batch
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+        self.queued_at = time.perf_counter()
+        self.granted_at = None
+        self.charge = 0.0  # llm seconds charged to the tenant when granted, corrected on release
+
+    def __repr__(self) -> str:
+        return (f"Ticket(model_name={self.model_name!r}, batch_key={self.batch_key!r}, "
+                f"priority={self.priority!r}, granted={self.granted_at is not None!r})")
+
+
+class SchedulerSlot:
+    # the semaphore interface limited_llm expects, the tenant is the one of the calling task
+    def __init__(self, scheduler, model_name: str):
+        self.scheduler = scheduler
+        self.model_name = model_name
+        self.ticket = None
+
+    async def acquire(self):
+        self.ticket = await self.scheduler.acquire(self.model_name, current_tenant.get(), current_priority.get())
+
+    def release(self):
+        self.scheduler.release(self.ticket)
+
+
+class FairScheduler:
+    # the same per-model cap as batch.ModelLimiter, but shared by every thread and event loop of the process:
+    # every job runs its batch on an event loop of its own, the stream clients on the server's one.
+    # Tenants are charged the time their requests hold a slot (an estimate when granted, corrected on release),
+    # over their weight. A tenant which becomes active starts at the lowest charge of the active ones,
+    # so an idle tenant doesn't save up a share to flood the host with later.
+    def __init__(self, limits: dict = None, default_limit: int = default_llm_concurrency, weights: dict = None,
+                 quotas: dict = None, default_quota: int = None):
+        self.limits = dict(llm_concurrency if limits is None else limits)
+        self.default_limit = default_limit
+        self.weights = dict(tenant_weights if weights is None else weights)
+        self.quotas = dict(tenant_quotas if quotas is None else quotas)
+        self.default_quota = default_tenant_quota if default_quota is None else default_quota
+        self._queues = {}  # model_name -> {(priority, company id, batch id): deque of waiting tickets}
+        self._running = {}  # model_name -> granted tickets
+        self._company_running = {}  # company id -> granted tickets, for the quotas
+        self._company_load = {}  # company id -> waiting and granted tickets, a company is active while it has any
+        self._batch_load = {}  # (company id, batch id) -> waiting and granted tickets
+        self._company_clock = {}  # company id -> llm seconds over weight, of the active companies
+        self._batch_clock = {}  # (company id, batch id) -> llm seconds, of the active batches
+        self._hold_seconds = {}  # model_name -> moving average of how long a request holds a slot
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def limit(self, model_name: str) -> int:
+        return self.limits.get(model_name, self.default_limit)
+
+    def weight(self, company_id: str) -> float:
+        return self.weights.get(company_id, 1.0)
+
+    def quota(self, company_id: str) -> int:
+        return self.quotas.get(company_id, self.default_quota)
+
+    def slot(self, model_name: str) -> SchedulerSlot:
+        return SchedulerSlot(self, model_name)
+
+    async def acquire(self, model_name: str, tenant: Tenant = None, priority: str = BULK) -> Ticket:
+        ticket = Ticket(model_name, tenant or Tenant(default_company, default_company), priority,
+                        next(self._sequence))
+        with self._lock:
+            self._enter(ticket)
+            flow = (priority,) + ticket.batch_key
+            self._queues.setdefault(model_name, {}).setdefault(flow, deque()).append(ticket)
+            granted = self._dispatch(model_name)
+        self._wake(granted)
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if ticket.granted_at is None:
+                    self._queues[model_name][flow].remove(ticket)
+                    if not self._queues[model_name][flow]:
+                        del self._queues[model_name][flow]
+                    self._leave(ticket)
+            if ticket.granted_at is not None:
+                self.release(ticket)
+            raise
+        tenant_wait_seconds.observe(ticket.granted_at - ticket.queued_at, company=ticket.company_id,
+                                    priority=priority)
+        return ticket
+
+    def release(self, ticket: Ticket):
+        held = time.perf_counter() - ticket.granted_at
+        with self._lock:
+            self._running[ticket.model_name] -= 1
+            self._company_running[ticket.company_id] -= 1
+            self._charge(ticket, held - ticket.charge)
+            average = self._hold_seconds.get(ticket.model_name)
+            self._hold_seconds[ticket.model_name] = held if average is None else 0.9 * average + 0.1 * held
+            self._leave(ticket)
+            # a freed quota can let in a request of any model
+            granted = [granted for model_name in list(self._queues) for granted in self._dispatch(model_name)]
+        self._wake(granted)
+
+    def _enter(self, ticket: Ticket):
+        company_id, batch_key = ticket.company_id, ticket.batch_key
+        if not self._company_load.get(company_id):
+            self._company_clock[company_id] = min(self._company_clock.values(), default=0.0)
+        self._company_load[company_id] = self._company_load.get(company_id, 0) + 1
+        if not self._batch_load.get(batch_key):
+            self._batch_clock[batch_key] = min((clock for key, clock in self._batch_clock.items()
+                                                if key[0] == company_id), default=0.0)
+        self._batch_load[batch_key] = self._batch_load.get(batch_key, 0) + 1
+
+    def _leave(self, ticket: Ticket):
+        # an idle tenant is forgotten, it starts over at the lowest charge of the active ones, see _enter
+        company_id, batch_key = ticket.company_id, ticket.batch_key
+        self._batch_load[batch_key] -= 1
+        if not self._batch_load[batch_key]:
+            del self._batch_load[batch_key], self._batch_clock[batch_key]
+        self._company_load[company_id] -= 1
+        if not self._company_load[company_id]:
+            del self._company_load[company_id], self._company_clock[company_id]
+            self._company_running.pop(company_id, None)
+
+    def _charge(self, ticket: Ticket, seconds: float):
+        self._company_clock[ticket.company_id] += seconds / self.weight(ticket.company_id)
+        self._batch_clock[ticket.batch_key] += seconds
+
+    def _next_flow(self, queues: dict):
+        # interactive requests first, then the company and its batch which were served the least,
+        # the companies at their quota wait
+        best, best_key = None, None
+        for flow, tickets in queues.items():
+            priority, company_id = flow[0], flow[1]
+            quota = self.quota(company_id)
+            if quota and self._company_running.get(company_id, 0) >= quota:
+                continue
+            key = (priority != INTERACTIVE, self._company_clock[company_id], self._batch_clock[flow[1:]],
+                   tickets[0].sequence)
+            if best_key is None or key < best_key:
+                best, best_key = flow, key
+        return best
+
+    def _dispatch(self, model_name: str) -> list:
+        queues = self._queues.get(model_name, {})
+        granted = []
+        while queues and self._running.get(model_name, 0) < self.limit(model_name):
+            flow = self._next_flow(queues)
+            if flow is None:
+                break
+            ticket = queues[flow].popleft()
+            if not queues[flow]:
+                del queues[flow]
+            ticket.granted_at = time.perf_counter()
+            # nothing is charged up-front until the model's hold time is known, all of it is charged on release then
+            ticket.charge = self._hold_seconds.get(model_name, 0.0)
+            self._charge(ticket, ticket.charge)
+            self._running[model_name] = self._running.get(model_name, 0) + 1
+            self._company_running[ticket.company_id] = self._company_running.get(ticket.company_id, 0) + 1
+            granted.append(ticket)
+        return granted
+
+    def _wake(self, granted: list):
+        for ticket in granted:
+            try:
+                ticket.loop.call_soon_threadsafe(grant, ticket.future)
+            except RuntimeError:  # the loop of the request is gone, and the request with it
+                self.release(ticket)
+
+    def tenant_stats(self) -> list:
+        # per company: requests waiting and in flight, and how long its requests waited for a slot so far
+        with self._lock:
+            waiting = {}
+            for queues in self._queues.values():
+                for flow, tickets in queues.items():
+                    waiting[flow[1]] = waiting.get(flow[1], 0) + len(tickets)
+            running = dict(self._company_running)
+        stats = []
+        for company_id in sorted(set(waiting) | set(running) | waited_companies()):
+            requests = sum(tenant_wait_seconds.count(company=company_id, priority=priority)
+                           for priority in (INTERACTIVE, BULK))
+            seconds = sum(tenant_wait_seconds.sum(company=company_id, priority=priority)
+                          for priority in (INTERACTIVE, BULK))
+            stats.append({'company_id': company_id, 'waiting': waiting.get(company_id, 0),
+                          'in_flight': running.get(company_id, 0), 'weight': self.weight(company_id),
+                          'quota': self.quota(company_id) or None, 'requests': requests,
+                          'mean_wait_seconds': seconds / requests if requests else None})
+        return stats
+
+    def __repr__(self) -> str:
+        with self._lock:
+            return (f"FairScheduler(limits={self.limits!r}, default_limit={self.default_limit!r}, "
+                    f"running={self._running!r}, companies={len(self._company_load)!r})")
+
+
+def grant(future: asyncio.Future):
+    # runs on the loop of the request, which may have been cancelled in the meantime, see FairScheduler.acquire
+    if not future.done():
+        future.set_result(None)
+
+
+def waited_companies() -> set:
+    return {labels[0] for _, labels, _, _ in tenant_wait_seconds.samples()}
+
+
+def resolve_tenants(candidate_ids: list, default_batch: str = default_company) -> dict:
+    # candidate id -> Tenant, from the batch of its response in the db, candidates which aren't bound to a batch
+    # (bare video files) are the default company's, in default_batch, e.g. the candidates submitted together
+    tenants = get_tenants(candidate_ids)
+    return {candidate_id: Tenant(*tenants[candidate_id]) if candidate_id in tenants else
+            Tenant(default_company, default_batch) for candidate_id in candidate_ids}
+
+
+fair_scheduler = FairScheduler()
+metrics_registry.gauge('speedvue_tenant_requests', "Llm requests by company and state (waiting, in_flight)",
+                       ('company', 'state')).set_function(
+    lambda: {(stats['company_id'], state): stats[state] for stats in fair_scheduler.tenant_stats()
+             for state in ('waiting', 'in_flight')})
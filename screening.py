@@ -0,0 +1,231 @@
+# This file is the screening part of this project
+# A cheap-first cascade runs ahead of the llm assessment: tier one are free heuristics on the transcript (length,
+# language, repetition, speech ratio, similarity to the task), tier two is an optional small and fast model.
+# Only candidates which pass go on to the criteria and the master summary, the rest is rejected right away.
+import asyncio
+import os
+import re
+import threading
+from typing import Optional
+
+import numpy as np
+
+from langchain_core.prompts import ChatPromptTemplate
+
+from audio import read_preprocess_report
+from cache import fingerprint, prompt_fingerprint
+from metrics import get_logger, metrics_registry, span
+from models import model_registry, screening_model_name, screening_token_limit
+from tokens import TokenCounter, count_prompt_tokens, prompt_budget, truncate_tokens
+from transcript_index import transcript_index, embed_texts
+
+screening_enabled = os.environ.get('SPEEDVUE_SCREENING', '1') != '0'
+
+# tier one only rules out responses which clearly aren't answers, anything borderline goes on to the llm
+min_words = 40  # about 15 seconds of speech
+language_window = 200  # words, the language and repetition checks only read the beginning of the transcript
+min_stopword_share = 0.15  # english speech is 40-50% stopwords, whisper base.en turns other languages into noise
+min_unique_share = 0.1  # whisper hallucination loops ("Thank you. Thank you. ...") repeat a handful of words
+min_speech_seconds = 10.0  # left after silence removal, see audio.py
+min_speech_ratio = 0.15  # of the whole video
+min_task_similarity = 0.05  # cosine similarity of the transcript and task embeddings, off-topic speech is still above
+
+stopwords = set("a about after all also an and any are as at be because been but by can could did do does for "
+                "from had has have he her his how i if in into is it its just like me more my no not now of on one "
+                "or our out so some than that the their them then there they this to up us was we were what when "
+                "which who will with would you your".split())
+
+logger = get_logger('screening')
+screened_out = metrics_registry.counter('speedvue_screened_out_total',
+                                        "Candidates rejected by the screening, by tier and check", ('tier', 'check'))
+saved_llm_calls = metrics_registry.counter('speedvue_screening_saved_llm_calls_total',
+                                           "Llm calls of the full assessment skipped for screened out candidates")
+saved_llm_seconds = metrics_registry.counter('speedvue_screening_saved_llm_seconds_total',
+                                             "Estimated llm time skipped for screened out candidates")
+
+screening_prompt = ChatPromptTemplate.from_messages([
+    ("system", "You are screening job candidates before a detailed assessment."
+               "Decide if the response is a genuine attempt to answer the task."
+               "The quality of the answer doesn't matter, only whether the candidate tries to answer."
+               "Reply with ONLY 'yes' or 'no', DO NOT add any unnecessary text."),
+    ("user", "The candidate was tasked with: \"{task}\""
+             "Candidate responded with: ```{input}```")
+])
+
+
+class ScreeningResult:
+    passed: bool
+    tier: int  # the tier which decided, 0 if the screening is disabled
+    check: str = None  # the check which rejected the candidate
+    reason: str = None
+    measurements: dict  # e.g. {'words': 312, 'stopword_share': 0.41, 'task_similarity': 0.38}
+
+    def __init__(self, passed: bool, tier: int, check: str = None, reason: str = None, measurements: dict = None):
+        self.passed = passed
+        self.tier = tier
+        self.check = check
+        self.reason = reason
+        self.measurements = measurements or {}
+
+    def to_dict(self) -> dict:
+        return {'passed': self.passed, 'tier': self.tier, 'check': self.check, 'reason': self.reason,
+                'measurements': self.measurements}
+
+    def __repr__(self) -> str:
+        return (f"ScreeningResult(passed={self.passed!r}, tier={self.tier!r}, check={self.check!r}, "
+                f"reason={self.reason!r})")
+
+
+def screening_fingerprint() -> str:
+    # changes whenever the screening could decide differently
+    return fingerprint(screening_enabled, min_words, language_window, min_stopword_share, min_unique_share,
+                       min_speech_seconds, min_speech_ratio, min_task_similarity, sorted(stopwords),
+                       screening_model_name if is_model_screening_enabled() else None,
+                       prompt_fingerprint(screening_prompt))
+
+
+def is_model_screening_enabled() -> bool:
+    # tier two only runs if a screening model is registered, see models.screening_model_name
+    return 'screening_llm' in model_registry.names()
+
+
+def transcript_words(transcript: str) -> list:
+    return re.findall(r"[a-z']+", transcript.lower())
+
+
+_task_vectors = {}  # task text -> embedding, there are only a handful of tasks
+_task_vectors_lock = threading.Lock()
+
+
+def embed_tasks(task_texts: list):
+    # all tasks which weren't embedded yet, in a single request
+    with _task_vectors_lock:
+        missing = sorted({task_text for task_text in task_texts if task_text not in _task_vectors})
+    if not missing:
+        return
+    vectors = embed_texts(missing)
+    with _task_vectors_lock:
+        _task_vectors.update(zip(missing, vectors))
+
+
+def task_similarity(task_text: str, transcript: str, candidate_id: str = None) -> Optional[float]:
+    # the transcript was just indexed (see assessment.index_transcript), so its embedding is usually already there,
+    # None if the embedding model is unavailable, the check is skipped then
+    try:
+        vector = transcript_index.vector(candidate_id) if candidate_id is not None else None
+        if vector is None:
+            vector = embed_texts([transcript])[0]
+        embed_tasks([task_text])
+        with _task_vectors_lock:
+            task_vector = _task_vectors[task_text]
+    except Exception as error:
+        logger.warning("Task similarity not measured: %s %r", candidate_id, error)
+        return None
+    return float(np.dot(vector, task_vector))
+
+
+def heuristic_screen(task_text: str, transcript: str, candidate_id: str = None,
+                     video_path: str = None) -> ScreeningResult:
+    # tier one, the cheapest checks come first, the first failed check rejects the candidate
+    words = transcript_words(transcript)
+    measurements = {'words': len(words)}
+    if len(words) < min_words:
+        return ScreeningResult(False, 1, 'length', f"too short, {len(words)} words", measurements)
+
+    window = words[:language_window]
+    measurements['stopword_share'] = round(sum(word in stopwords for word in window) / len(window), 3)
+    if measurements['stopword_share'] < min_stopword_share:
+        return ScreeningResult(False, 1, 'language', "not recognized as english speech", measurements)
+    measurements['unique_share'] = round(len(set(window)) / len(window), 3)
+    if measurements['unique_share'] < min_unique_share:
+        return ScreeningResult(False, 1, 'repetition', "the same few words repeated", measurements)
+
+    # the pre-processing report only exists for videos transcribed with silence removal, see audio.py
+    report = read_preprocess_report(video_path) if video_path is not None else None
+    if report is not None and report.original_duration:
+        measurements['speech_seconds'] = round(report.kept_duration, 1)
+        measurements['speech_ratio'] = round(1 - report.dropped_ratio, 3)
+        if report.kept_duration < min_speech_seconds:
+            return ScreeningResult(False, 1, 'speech', f"only {report.kept_duration:.0f}s of speech", measurements)
+        if measurements['speech_ratio'] < min_speech_ratio:
+            return ScreeningResult(False, 1, 'speech', "mostly silence", measurements)
+
+    similarity = task_similarity(task_text, transcript, candidate_id)
+    if similarity is not None:
+        measurements['task_similarity'] = round(similarity, 3)
+        if similarity < min_task_similarity:
+            return ScreeningResult(False, 1, 'relevance', "unrelated to the task", measurements)
+    return ScreeningResult(True, 1, measurements=measurements)
+
+
+def model_screen_params(task_text: str, transcript: str) -> dict:
+    # the small model only reads the beginning of long transcripts, which is enough to tell a non-answer
+    budget = prompt_budget(screening_token_limit) - count_prompt_tokens(screening_prompt, {'task': task_text,
+                                                                                         'input': ''})
+    return {'task': task_text, 'input': truncate_tokens(transcript, max(budget, 0))}
+
+
+def parse_screening_answer(response: str) -> Optional[bool]:
+    words = re.findall(r"[a-z]+", response.lower())
+    if not words or words[0] not in ('yes', 'no'):
+        return None
+    return words[0] == 'yes'
+
+
+def model_result(response: str, heuristic: ScreeningResult) -> ScreeningResult:
+    # an unclear answer lets the candidate through, the full assessment decides then
+    measurements = {**heuristic.measurements, 'model_answer': response.strip()[:32]}
+    if parse_screening_answer(response) is False:
+        return ScreeningResult(False, 2, 'model', "no attempt to answer the task, according to the screening model",
+                               measurements)
+    return ScreeningResult(True, 2, measurements=measurements)
+
+
+def screen(task_text: str, transcript: str, candidate_id: str = None, video_path: str = None, llm_chain=None,
+           counter: TokenCounter = None) -> ScreeningResult:
+    # llm_chain: prompt value -> str of the screening model, tier two is skipped without it
+    if not screening_enabled:
+        return ScreeningResult(True, 0)
+    with span('screening', candidate_id):
+        result = heuristic_screen(task_text, transcript, candidate_id, video_path)
+    if not result.passed or llm_chain is None:
+        return result
+
+    prompt_value = screening_prompt.format_prompt(**model_screen_params(task_text, transcript))
+    with span('screening_model', candidate_id):
+        response = llm_chain.invoke(prompt_value)
+    if counter is not None:
+        counter.record('screening', prompt_value.to_string(), response)
+    return model_result(response, result)
+
+
+async def ascreen(task_text: str, transcript: str, candidate_id: str = None, video_path: str = None, llm_chain=None,
+                  counter: TokenCounter = None) -> ScreeningResult:
+    # async counterpart of screen, tier one embeds and reads files, so it runs in the executor
+    if not screening_enabled:
+        return ScreeningResult(True, 0)
+    loop = asyncio.get_running_loop()
+
+    def screen_heuristics() -> ScreeningResult:
+        with span('screening', candidate_id):
+            return heuristic_screen(task_text, transcript, candidate_id, video_path)
+
+    result = await loop.run_in_executor(None, screen_heuristics)
+    if not result.passed or llm_chain is None:
+        return result
+
+    prompt_value = screening_prompt.format_prompt(**await loop.run_in_executor(None, model_screen_params, task_text,
+                                                                               transcript))
+    with span('screening_model', candidate_id):
+        response = await llm_chain.ainvoke(prompt_value)
+    if counter is not None:
+        counter.record('screening', prompt_value.to_string(), response)
+    return model_result(response, result)
+
+
+def record_screened_out(result: ScreeningResult, llm_calls: int, llm_seconds: float = None):
+    # llm_calls and llm_seconds: what the full assessment of the candidate would have cost
+    screened_out.inc(tier=result.tier, check=result.check)
+    saved_llm_calls.inc(llm_calls)
+    if llm_seconds is not None:
+        saved_llm_seconds.inc(llm_seconds)
@@ -1,17 +1,40 @@
-from fastapi import FastAPI, UploadFile, File, Form
-from fastapi.responses import HTMLResponse
+import os
+from typing import List, Optional
+
+from fastapi import FastAPI, UploadFile, File, Form, Request, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
+import models  # the registry which assessment loads its models from, not a copy of it
 from . import assessment
+from . import uploads
+from . import jobs
+from . import ranking
 
 app = FastAPI()
 
 
+@app.on_event("startup")
+async def warm_up_models():
+    # models are loaded on first use, workers which are going to run assessments can preload them instead,
+    # e.g. SPEEDVUE_WARM_MODELS=basic_llm,master_llm
+    names = [name.strip() for name in os.environ.get('SPEEDVUE_WARM_MODELS', '').split(',') if name.strip()]
+    if names:
+        models.model_registry.warm_up(*names)
+
+
 class VideoData(BaseModel):
     task_id: str
     recruitment_id: str
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    # Prometheus text format, the pipeline modules register their metrics on import, see metrics.py
+    return PlainTextResponse(assessment.metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/", response_class=HTMLResponse)
 async def read_root():
     with open(f"client/build/index.html", 'r') as file:
@@ -20,23 +43,159 @@ async def read_root():
 
 @app.post("/candidate/upload")
 async def update_item(video: UploadFile = File(...), task_id: str = Form(...), recruitment_id: str = Form(...)):
-
-    with open(f"data/videos/{video.filename}", "wb") as buffer:
-        contents = await video.read()
-        # buffer.write(contents)
+    # streamed to disk in chunks, for large recordings prefer the resumable upload below
+    try:
+        saved = await uploads.save_upload(video)
+    except uploads.UploadError as error:
+        raise HTTPException(status_code=error.status_code, detail=str(error))
 
     return {"video_task_id": task_id, "video_recruitment_id": recruitment_id,
-            "video_filename": video.filename, "video_size": video.size}
+            "video_filename": saved['filename'], "video_size": saved['size'], "video_sha256": saved['sha256']}
+
+
+# resumable upload: start -> (PUT parts, raw body, at the current offset)* -> complete
+@app.post("/candidate/upload/start")
+async def start_upload(filename: str = Form(...), size: int = Form(...), task_id: str = Form(...),
+                       recruitment_id: str = Form(...)):
+    try:
+        session = uploads.start_upload(filename, size, {"video_task_id": task_id,
+                                                        "video_recruitment_id": recruitment_id})
+    except uploads.UploadError as error:
+        raise HTTPException(status_code=error.status_code, detail=str(error))
+    return {"upload_id": session.upload_id, "offset": 0, "chunk_size": uploads.UPLOAD_CHUNK_SIZE}
+
+
+@app.get("/candidate/upload/{upload_id}")
+async def get_upload(upload_id: str):
+    try:
+        session = uploads.get_upload(upload_id)
+    except uploads.UploadError as error:
+        raise HTTPException(status_code=error.status_code, detail=str(error))
+    return {"upload_id": upload_id, "offset": session.offset, "size": session.total_size}
+
+
+@app.put("/candidate/upload/{upload_id}")
+async def upload_part(upload_id: str, offset: int, request: Request):
+    try:
+        session = uploads.get_upload(upload_id)
+        new_offset = await session.write_part(request.stream(), offset)
+    except uploads.UploadError as error:
+        raise HTTPException(status_code=error.status_code, detail=str(error))
+    return {"upload_id": upload_id, "offset": new_offset, "size": session.total_size}
+
+
+@app.post("/candidate/upload/{upload_id}/complete")
+async def complete_upload(upload_id: str):
+    try:
+        saved = await uploads.get_upload(upload_id).complete()
+    except uploads.UploadError as error:
+        raise HTTPException(status_code=error.status_code, detail=str(error))
+    return {"video_task_id": saved['video_task_id'], "video_recruitment_id": saved['video_recruitment_id'],
+            "video_filename": saved['filename'], "video_size": saved['size'], "video_sha256": saved['sha256']}
+
+
+class ResponseSpec(BaseModel):
+    video_filename: str
+    task_text: str
+
+
+class SummarizeRequest(BaseModel):
+    responses: List[ResponseSpec] = []
+    overwrite: bool = False
+
+
+def job_response(job: jobs.Job, message: str) -> dict:
+    return {"response": message, "job_id": job.job_id, "status": job.status}
 
 
 # TODO: people will be selected from the list, by default all but a few may be chosen as well
 @app.post("/manager/start_summarizing")
-async def start_summarizing():
-    assessment.summarize_candidates([])
-    return {"response": "summarized filtering started"}
+async def start_summarizing(request: Optional[SummarizeRequest] = None):
+    # returns immediately, progress is available under /manager/jobs/{job_id}
+    request = request or SummarizeRequest()
+    try:
+        response_list = [
+            assessment.StandardTaskResponse(file_name=f"data/videos/{uploads.safe_filename(spec.video_filename)}",
+                                            task_text=spec.task_text)
+            for spec in request.responses
+        ]
+    except uploads.UploadError as error:
+        raise HTTPException(status_code=error.status_code, detail=str(error))
+
+    # the same set of responses submitted again while still running is deduplicated
+    batch_key = assessment.fingerprint(sorted((spec.video_filename, spec.task_text) for spec in request.responses),
+                                       request.overwrite)
+    job = jobs.job_manager.submit('summarizing', batch_key, assessment.summarize_candidates, response_list,
+                                  request.overwrite)
+    return job_response(job, "summarization started")
+
+
+@app.get("/manager/assessments/{video_filename}/stream")
+async def stream_assessment(video_filename: str, task_text: Optional[str] = None, overwrite: bool = False):
+    # server-sent events: tokens as they're generated and results, tagged by stage, then the end with the assessment
+    # clients share the assessment in flight (also one of a batch job), task_text starts one if there's none,
+    # without it, the stored assessment is sent at once
+    try:
+        video_path = f"data/videos/{uploads.safe_filename(video_filename)}"
+    except uploads.UploadError as error:
+        raise HTTPException(status_code=error.status_code, detail=str(error))
+
+    candidate_id = assessment.separate_id(video_path)
+    stream = assessment.stream_assessment(video_path, task_text, overwrite)
+    if stream is None:
+        stream = await run_in_threadpool(assessment.replay_assessment, candidate_id)
+        if stream is None:
+            raise HTTPException(status_code=404, detail=f"No assessment of candidate {candidate_id}")
+    return StreamingResponse(assessment.streams.server_sent_events(stream), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.post("/manager/start_filtering")
 async def start_filtering():
-    assessment.filter_summarized_candidates()
-    return {"response": "summarized filtering started"}
+    job = jobs.job_manager.submit('filtering', 'summarized', assessment.filter_summarized_candidates)
+    return job_response(job, "summarized filtering started")
+
+
+class RankRequest(BaseModel):
+    candidate_ids: Optional[List[str]] = None  # all summarized candidates by default
+    ranking_id: str = ranking.default_ranking_id
+
+
+@app.post("/manager/start_ranking")
+async def start_ranking(request: Optional[RankRequest] = None):
+    request = request or RankRequest()
+    job = jobs.job_manager.submit('ranking', request.ranking_id, ranking.rank_candidates, request.candidate_ids,
+                                  request.ranking_id)
+    return job_response(job, "ranking started")
+
+
+@app.get("/manager/ranking/{ranking_id}")
+async def get_ranking(ranking_id: str):
+    return [candidate.to_dict() for candidate in ranking.get_ranking(ranking_id)]
+
+
+@app.get("/manager/jobs")
+async def list_jobs():
+    return [job.to_dict() for job in jobs.job_manager.list()]
+
+
+@app.get("/manager/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return job.to_dict()
+
+
+@app.post("/manager/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    job = jobs.job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return job.to_dict()
+
+
+@app.get("/manager/scheduler")
+async def get_scheduler():
+    # per company: llm requests waiting and in flight, its weight and quota, and how long its requests waited so far
+    return assessment.fair_scheduler.tenant_stats()
@@ -0,0 +1,133 @@
+# This file is the streaming part of this project
+# Assessments publish their progress as events: the tokens of every llm call as they're generated, and the result
+# of every stage once it's done, tagged by the stage (claims, a criterion, combined, summary), then a final end event.
+# Any number of clients can follow the assessment of a candidate which is in flight, no matter who started it,
+# late subscribers get the events they missed first. The server relays the events as server-sent events.
+import asyncio
+import json
+import threading
+
+from metrics import metrics_registry
+
+TOKEN = 'token'
+RESULT = 'result'
+END = 'end'
+
+stream_subscribers = metrics_registry.gauge('speedvue_stream_subscribers',
+                                            "Clients following the assessment of a candidate")
+
+
+class AssessmentStream:
+    # events are (kind, data) tuples, they're published from any thread, and delivered to the event loop
+    # of every subscriber
+    candidate_id: str
+    finished: bool = False
+
+    def __init__(self, candidate_id: str):
+        self.candidate_id = candidate_id
+        self.finished = False
+        self.events = []  # every event so far, replayed to late subscribers
+        self._subscribers = []  # (event loop, asyncio.Queue)
+        self._lock = threading.Lock()
+
+    def publish(self, kind: str, stage: str = None, text: str = None, **data):
+        event = (kind, {'candidate_id': self.candidate_id, 'stage': stage, 'text': text, **data})
+        with self._lock:
+            if self.finished:
+                return
+            self.events.append(event)
+            self.finished = kind == END
+            subscribers = list(self._subscribers)
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, event)
+            except RuntimeError:  # the loop of a subscriber which is gone
+                pass
+
+    def finish(self, assessment: str = None, error: Exception = None):
+        if error is not None:
+            self.publish(END, status='failed', error=repr(error))
+        else:
+            self.publish(END, text=assessment, status='completed')
+
+    async def subscribe(self):
+        # async iterator of the events, from the first one to the end event
+        queue = asyncio.Queue()
+        subscriber = (asyncio.get_running_loop(), queue)
+        with self._lock:
+            history = list(self.events)
+            if not self.finished:
+                self._subscribers.append(subscriber)
+        stream_subscribers.inc()
+        try:
+            for event in history:
+                yield event
+            if history and history[-1][0] == END:
+                return
+            while True:
+                event = await queue.get()
+                yield event
+                if event[0] == END:
+                    return
+        finally:
+            stream_subscribers.dec()
+            with self._lock:
+                if subscriber in self._subscribers:
+                    self._subscribers.remove(subscriber)
+
+    async def result(self) -> str:
+        # the complete assessment, once the stream ends
+        async for kind, data in self.subscribe():
+            if kind == END:
+                if data['status'] != 'completed':
+                    raise RuntimeError(f"Assessment of {self.candidate_id} failed: {data['error']}")
+                return data['text']
+
+    def __repr__(self) -> str:
+        return (f"AssessmentStream(candidate_id={self.candidate_id!r}, events={len(self.events)!r}, "
+                f"finished={self.finished!r})")
+
+
+class StreamHub:
+    # the streams of the assessments in flight, one per candidate, whoever runs it (a batch job, a client)
+    def __init__(self):
+        self._streams = {}  # candidate id -> AssessmentStream
+        self._lock = threading.Lock()
+
+    def open(self, candidate_id: str) -> tuple:
+        # (stream, True) if the caller has to run the assessment, (stream in flight, False) if it's already running
+        with self._lock:
+            stream = self._streams.get(candidate_id)
+            if stream is not None:
+                return stream, False
+            stream = self._streams[candidate_id] = AssessmentStream(candidate_id)
+            return stream, True
+
+    def get(self, candidate_id: str) -> AssessmentStream:
+        with self._lock:
+            return self._streams.get(candidate_id)
+
+    def close(self, stream: AssessmentStream, assessment: str = None, error: Exception = None):
+        stream.finish(assessment, error)
+        with self._lock:
+            if self._streams.get(stream.candidate_id) is stream:
+                del self._streams[stream.candidate_id]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._streams)
+
+
+def format_event(kind: str, data: dict) -> str:
+    # one server-sent event
+    return f"event: {kind}\ndata: {json.dumps(data)}\n\n"
+
+
+async def server_sent_events(stream: AssessmentStream):
+    async for kind, data in stream.subscribe():
+        yield format_event(kind, data)
+
+
+stream_hub = StreamHub()
+metrics_registry.gauge('speedvue_streams_in_flight', "Assessments with a stream, in flight").set_function(
+    lambda: len(stream_hub))
@@ -0,0 +1,67 @@
+# Tests of the assessment pipeline, with the stand-ins of benchmarks/fakes.py instead of Ollama and whisper.
+# The repo modules resolve data/ relative to the working directory when they're imported,
+# so they're only imported inside of a fresh workspace, with the llm response cache off, every call reaches the model.
+import os
+import sys
+
+import pytest
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+task = "Tell us about a project you are proud of."
+
+
+@pytest.fixture(scope='module')
+def recorder(tmp_path_factory):
+    workspace = tmp_path_factory.mktemp('workspace')
+    os.makedirs(workspace / 'data' / 'videos')
+    os.makedirs(workspace / 'data' / 'text')
+    for name in ('candidate0', 'candidate1'):
+        with open(workspace / 'data' / 'videos' / f"{name}.mp4", 'wb') as file:
+            file.write(f"synthetic video {name}".encode() * 64)
+    previous_directory = os.getcwd()
+    os.chdir(workspace)
+    os.environ['SPEEDVUE_LLM_CACHE_ENABLED'] = '0'
+    from benchmarks.fakes import install_fakes
+    yield install_fakes(llm_latency=0.0, transcription_latency=0.0)
+    from transcript_index import transcript_index
+    transcript_index.save()  # into the workspace, it's saved on exit otherwise
+    os.chdir(previous_directory)
+
+
+def llm_calls(recorder) -> dict:
+    # stage -> calls, the transcription is cached by content, overwrite doesn't redo it
+    return {stage: len(durations) for stage, durations in recorder.durations.items() if stage != 'transcription'}
+
+
+def test_overwrite_calls_the_model_again(recorder):
+    from assessment import StandardTaskResponse, generate_response_summarization
+
+    recorder.reset()
+    generate_response_summarization(StandardTaskResponse('data/videos/candidate0.mp4', task))
+    assessed_calls = llm_calls(recorder)
+    assert assessed_calls
+
+    recorder.reset()
+    generate_response_summarization(StandardTaskResponse('data/videos/candidate0.mp4', task))
+    assert not llm_calls(recorder)  # stored, nothing is stale
+
+    recorder.reset()
+    generate_response_summarization(StandardTaskResponse('data/videos/candidate0.mp4', task), overwrite=True)
+    assert llm_calls(recorder) == assessed_calls
+
+
+def test_overwrite_calls_the_model_again_in_a_batch(recorder):
+    from assessment import StandardTaskResponse
+    from batch import assess_batch
+
+    recorder.reset()
+    results = assess_batch([StandardTaskResponse('data/videos/candidate1.mp4', task)], limits={})
+    assessed_calls = llm_calls(recorder)
+    assert results[0].succeeded and assessed_calls
+
+    recorder.reset()
+    results = assess_batch([StandardTaskResponse('data/videos/candidate1.mp4', task)], overwrite=True, limits={})
+    assert results[0].succeeded
+    assert llm_calls(recorder) == assessed_calls
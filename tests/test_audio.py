@@ -0,0 +1,42 @@
+# Tests of the cache of the pre-processed audio, see audio.py, no ffmpeg is needed, the audio is synthetic
+import os
+import sys
+
+import numpy as np
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+import audio  # noqa: E402
+
+
+def save_video(path, content: bytes) -> str:
+    with open(path, 'wb') as file:
+        file.write(content)
+    return str(path)
+
+
+def speech(seconds: float) -> np.ndarray:
+    samples = np.random.default_rng(0).normal(0, 0.3, int(seconds * audio.SAMPLE_RATE))
+    return samples.astype(np.float32)
+
+
+def test_report_is_reused_for_the_same_video_and_parameters(tmp_path):
+    video_path = save_video(tmp_path / 'candidate.mp4', b'video' * 64)
+    audio.save_preprocessed(video_path, speech(2.0), str(tmp_path / 'audio'))
+    report = audio.read_preprocess_report(video_path, str(tmp_path / 'audio'))
+    assert report is not None and abs(report.original_duration - 2.0) < 0.01
+
+
+def test_report_is_stale_after_the_parameters_change(tmp_path, monkeypatch):
+    video_path = save_video(tmp_path / 'candidate.mp4', b'video' * 64)
+    audio.save_preprocessed(video_path, speech(2.0), str(tmp_path / 'audio'))
+    monkeypatch.setattr(audio, 'speech_margin_db', audio.speech_margin_db + 3.0)
+    assert audio.read_preprocess_report(video_path, str(tmp_path / 'audio')) is None
+
+
+def test_report_is_stale_after_the_video_changes(tmp_path):
+    video_path = save_video(tmp_path / 'candidate.mp4', b'video' * 64)
+    audio.save_preprocessed(video_path, speech(2.0), str(tmp_path / 'audio'))
+    save_video(video_path, b'other video' * 64)
+    assert audio.read_preprocess_report(video_path, str(tmp_path / 'audio')) is None
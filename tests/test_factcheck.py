@@ -0,0 +1,47 @@
+# Tests of the factcheck store, see factcheck.py, with the stand-in embeddings of benchmarks/fakes.py
+import os
+import sys
+
+import pytest
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+
+@pytest.fixture
+def factcheck():
+    from benchmarks.fakes import install_fakes
+    install_fakes(llm_latency=0.0)
+    import factcheck
+    return factcheck
+
+
+def hits(factcheck) -> list:
+    return [factcheck.SearchHit('python.md', 'Python', "Python is a programming language created by Guido."),
+            factcheck.SearchHit('rust.md', 'Rust', "Rust is a systems language focused on memory safety.")]
+
+
+def test_store_is_saved_on_the_interval_and_reloaded(factcheck, tmp_path, monkeypatch):
+    directory = str(tmp_path / 'factcheck')
+    store = factcheck.FactcheckStore(directory)
+    store.add(hits(factcheck))
+    assert store.retrieve("Who created Python", k=1)[0].metadata['source'] == 'python.md'
+    assert not os.path.exists(store.metadata_path)  # fewer sources than store_save_interval
+
+    monkeypatch.setattr(factcheck, 'store_save_interval', 1)
+    store.add([factcheck.SearchHit('go.md', 'Go', "Go is a language with goroutines.")])
+    assert os.path.exists(store.metadata_path) and os.path.exists(f"{directory}/index.faiss")
+    assert not [name for name in os.listdir(directory) if '.tmp' in name]
+
+    reloaded = factcheck.FactcheckStore(directory)
+    assert reloaded.retrieve("memory safety of Rust", k=1)[0].metadata['source'] == 'rust.md'
+
+
+def test_known_sources_are_not_embedded_again(factcheck, tmp_path):
+    store = factcheck.FactcheckStore(str(tmp_path / 'factcheck'))
+    store.add(hits(factcheck))
+    size = store._store.index.ntotal
+    store.add(hits(factcheck))
+    assert store._store.index.ntotal == size
+    store.save()
+    assert factcheck.FactcheckStore(store.directory).retrieve("Python", k=5)
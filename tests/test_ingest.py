@@ -0,0 +1,36 @@
+# Tests of the stitching of the transcripts of overlapping audio windows, see ingest.py
+import os
+import sys
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+from ingest import stitch_min_words, stitch_words, stitch_transcripts  # noqa: E402
+
+
+def test_exact_overlap_is_kept_once():
+    assert stitch_transcripts(["we moved the service to kubernetes last", "to kubernetes last year and it paid off"]) \
+        == "we moved the service to kubernetes last year and it paid off"
+
+
+def test_overlap_ignores_case_and_punctuation_and_keeps_the_left_spelling():
+    assert stitch_words("it was the Quick brown fox.".split(), "the quick brown fox jumps".split()) \
+        == "it was the Quick brown fox. jumps".split()
+
+
+def test_windows_without_overlap_are_both_kept():
+    assert stitch_transcripts(["first part of the answer", "something else entirely"]) \
+        == "first part of the answer something else entirely"
+
+
+def test_match_shorter_than_min_words_is_not_merged():
+    # "and rust" agrees on 2 words only, a repeated word is better than a lost one
+    assert stitch_min_words == 3
+    left = "we use python and rust".split()
+    right = "and rust for the services".split()
+    assert stitch_words(left, right) == left + right
+
+
+def test_silent_windows_are_skipped():
+    assert stitch_transcripts(["", "hello there my friend", "", "there my friend how are you"]) \
+        == "hello there my friend how are you"
@@ -0,0 +1,101 @@
+# Tests of the ranking, see ranking.py, in an in-memory database, with a judge which prefers the higher quality
+import os
+import re
+import sys
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+import database  # noqa: E402
+import ranking  # noqa: E402
+from ranking import FIRST, SECOND, Comparator, comparison_key, insertion_position, parse_preference  # noqa: E402
+
+
+class Judge:
+    # prefers the candidate whose summary states the higher quality, and the first one on a tie,
+    # so the two orderings of a tie contradict each other, as a biased model would
+    def __init__(self):
+        self.calls = 0
+
+    async def ainvoke(self, prompt_value) -> str:
+        self.calls += 1
+        text = prompt_value.to_string()
+        first = int(re.search(r"First candidate summary: ```quality (\d+)```", text).group(1))
+        second = int(re.search(r"Second candidate summary: ```quality (\d+)```", text).group(1))
+        return 'second' if second > first else 'first'
+
+
+@pytest.fixture
+def judge(monkeypatch):
+    engine = database.create_database_engine('sqlite://')
+    monkeypatch.setattr(database, 'engine_singleton', engine)
+    monkeypatch.setattr(database, 'session_factory', sessionmaker(engine, expire_on_commit=False))
+    judge = Judge()
+    monkeypatch.setattr(ranking, 'get_basic_llm', lambda: judge)
+    return judge
+
+
+def assess(qualities: dict):
+    # candidate id -> quality, the fingerprint changes with the quality, like a re-assessment
+    database.save_assessments({candidate_id: {'task': "Tell us about a project.", 'assessment': f"quality {quality}",
+                                              'fingerprint': f"{candidate_id}-{quality}"}
+                               for candidate_id, quality in qualities.items()})
+
+
+def test_parse_preference_is_strict():
+    assert parse_preference("First.") == FIRST
+    assert parse_preference("SECOND") == SECOND
+    assert parse_preference("first, not the second") is None
+    assert parse_preference("the first one") is None
+
+
+def test_verdicts_are_stored_for_one_ordering_and_flipped(judge):
+    assess({'a': 3, 'b': 1})
+    comparator = Comparator(database.load_assessments(['a', 'b']))
+    assert comparator.compare('b', 'a').score == -2  # 'b-1' < 'a-3', asked the other way around
+    assert comparator.compare('a', 'b').score == 2
+    assert judge.calls == 2 and comparator.cache_hits == 1
+
+    stored = database.get_comparison(comparison_key('a-3', 'b-1'))
+    assert (stored.first_id, stored.second_id, stored.score) == ('a', 'b', 2)
+    assert database.get_comparison(comparison_key('b-1', 'a-3')) is None
+
+
+def test_ties_are_placed_after(judge):
+    assess({'a': 2, 'b': 2})
+    comparator = Comparator(database.load_assessments(['a', 'b']))
+    assert insertion_position(['a'], 'b', comparator) == (1, 0.5)
+
+
+def test_candidates_are_ranked_best_first(judge):
+    assess({'a': 3, 'b': 1, 'c': 2, 'd': 2})
+    ranked = ranking.rank_candidates(['a', 'b', 'c', 'd'], 'test')
+    assert [entry.candidate_id for entry in ranked] == ['a', 'c', 'd', 'b']
+    assert [entry.position for entry in ranked] == [0, 1, 2, 3]
+    assert [entry.candidate_id for entry in ranking.get_ranking('test')] == ['a', 'c', 'd', 'b']
+
+
+def test_stored_verdicts_are_reused_across_rankings(judge):
+    assess({'a': 3, 'b': 1, 'c': 2})
+    ranking.rank_candidates(['a', 'b', 'c'], 'first')
+    calls = judge.calls
+    assert calls
+
+    # the same candidates in another ranking are compared from the stored verdicts
+    assert [entry.candidate_id for entry in ranking.rank_candidates(['a', 'b', 'c'], 'second')] == ['a', 'c', 'b']
+    assert judge.calls == calls
+
+    # a new candidate only costs its own comparisons: two of them, with c then with a, both orderings each
+    assess({'d': 4})
+    ranked = ranking.rank_candidates(['a', 'b', 'c', 'd'], 'first')
+    assert [entry.candidate_id for entry in ranked] == ['d', 'a', 'c', 'b']
+    assert judge.calls == calls + 4
+
+    # a re-assessed candidate leaves the ranking, and is compared again
+    assess({'b': 5})
+    ranked = ranking.rank_candidates(['a', 'b', 'c', 'd'], 'first')
+    assert [entry.candidate_id for entry in ranked] == ['b', 'd', 'a', 'c']
+    assert judge.calls == calls + 8
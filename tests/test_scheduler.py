@@ -0,0 +1,127 @@
+# Tests of the fair scheduling of the llm calls, see scheduler.py, the requests only hold their slot for a moment
+import asyncio
+import os
+import sys
+import threading
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+from scheduler import FairScheduler, Tenant, INTERACTIVE, BULK  # noqa: E402
+
+model = 'model'
+hold_seconds = 0.01
+
+
+async def request(scheduler: FairScheduler, tenant: Tenant, granted: list, priority: str = BULK):
+    ticket = await scheduler.acquire(model, tenant, priority)
+    granted.append((tenant.company_id, tenant.batch_id))
+    await asyncio.sleep(hold_seconds)
+    scheduler.release(ticket)
+
+
+async def contend(scheduler: FairScheduler, tenants: list, requests: int) -> list:
+    # every tenant queues all of its requests at once, returns the tenants in the order they were granted a slot
+    granted = []
+    await asyncio.gather(*[request(scheduler, tenant, granted) for _ in range(requests) for tenant in tenants])
+    return granted
+
+
+def test_companies_share_by_weight():
+    scheduler = FairScheduler(limits={model: 1}, weights={'heavy': 2.0}, quotas={})
+    granted = asyncio.run(contend(scheduler, [Tenant('heavy', 'x'), Tenant('light', 'y')], 12))
+    first = [company_id for company_id, _ in granted[:12]]
+    # 2:1 of the llm time, give or take a request of the timing
+    assert 7 <= first.count('heavy') <= 9
+
+
+def test_batches_of_a_company_share_equally():
+    scheduler = FairScheduler(limits={model: 1}, weights={}, quotas={})
+    granted = []
+
+    async def run():
+        # one batch queues far more than the other, it still only gets half of the slots while both wait
+        await asyncio.gather(*[request(scheduler, Tenant('company', 'big'), granted) for _ in range(16)],
+                             *[request(scheduler, Tenant('company', 'small'), granted) for _ in range(4)])
+
+    asyncio.run(run())
+    first = [batch_id for _, batch_id in granted[:8]]
+    assert 3 <= first.count('big') <= 5
+
+
+def test_quota_caps_the_requests_of_a_company_in_flight():
+    scheduler = FairScheduler(limits={model: 3}, weights={}, quotas={'capped': 1})
+    in_flight = {'capped': 0, 'free': 0}
+    peak = {'capped': 0, 'free': 0}
+
+    async def tracked(tenant: Tenant):
+        ticket = await scheduler.acquire(model, tenant)
+        in_flight[tenant.company_id] += 1
+        peak[tenant.company_id] = max(peak[tenant.company_id], in_flight[tenant.company_id])
+        await asyncio.sleep(hold_seconds)
+        in_flight[tenant.company_id] -= 1
+        scheduler.release(ticket)
+
+    async def run():
+        await asyncio.gather(*[tracked(Tenant(company_id, 'batch')) for _ in range(6)
+                               for company_id in ('capped', 'free')])
+
+    asyncio.run(run())
+    # the capped company's slots aren't left idle, the other company takes them
+    assert peak == {'capped': 1, 'free': 2}
+
+
+def test_interactive_requests_go_first():
+    scheduler = FairScheduler(limits={model: 1}, weights={}, quotas={})
+
+    async def run() -> list:
+        granted = []
+        holder = await scheduler.acquire(model, Tenant('bulk', 'batch'))
+        waiting = [asyncio.create_task(request(scheduler, Tenant('bulk', 'batch'), granted)) for _ in range(3)]
+        await asyncio.sleep(0)
+        waiting.append(asyncio.create_task(request(scheduler, Tenant('client', 'stream'), granted, INTERACTIVE)))
+        await asyncio.sleep(0)
+        scheduler.release(holder)
+        await asyncio.gather(*waiting)
+        return [company_id for company_id, _ in granted]
+
+    assert asyncio.run(run()) == ['client', 'bulk', 'bulk', 'bulk']
+
+
+def test_slot_released_on_another_loop_wakes_the_waiting_one():
+    scheduler = FairScheduler(limits={model: 1}, weights={}, quotas={})
+    holder = asyncio.run(scheduler.acquire(model, Tenant('company', 'first')))
+    queued = threading.Event()
+    granted = []
+
+    async def wait_for_slot():
+        acquiring = asyncio.ensure_future(scheduler.acquire(model, Tenant('company', 'second')))
+        await asyncio.sleep(0)
+        queued.set()
+        granted.append(await asyncio.wait_for(acquiring, 5))
+
+    waiter = threading.Thread(target=asyncio.run, args=(wait_for_slot(),))
+    waiter.start()
+    assert queued.wait(5)
+    scheduler.release(holder)  # from this thread, the waiting ticket's loop runs in the other one
+    waiter.join(5)
+    assert len(granted) == 1 and granted[0].batch_key == ('company', 'second')
+    scheduler.release(granted[0])
+    assert not scheduler._running[model] and not scheduler._company_load
+
+
+def test_cancelled_request_gives_up_its_place():
+    scheduler = FairScheduler(limits={model: 1}, weights={}, quotas={})
+
+    async def run():
+        holder = await scheduler.acquire(model, Tenant('company', 'batch'))
+        cancelled = asyncio.create_task(scheduler.acquire(model, Tenant('company', 'batch')))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        scheduler.release(holder)
+        ticket = await asyncio.wait_for(scheduler.acquire(model, Tenant('company', 'batch')), 5)
+        scheduler.release(ticket)
+
+    asyncio.run(run())
+    assert not scheduler._queues[model] and not scheduler._running[model]
@@ -0,0 +1,116 @@
+# Tests of the token budgeting, see tokens.py, a token is a word of the text here
+import asyncio
+import os
+import sys
+
+import pytest
+from langchain_core.prompts import ChatPromptTemplate
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+import tokens  # noqa: E402
+from tokens import count_tokens, count_prompt_tokens, prompt_budget, split_to_fit, group_to_fit  # noqa: E402
+from tokens import map_reduce, amap_reduce, fit_fields, TokenCounter  # noqa: E402
+
+prompt = ChatPromptTemplate.from_messages([("system", "Judge the candidate."),
+                                           ("user", "Task: {task} Response: {input}")])
+
+
+class WordEncoder:
+    def encode(self, text: str, disallowed_special=()) -> list:
+        return text.split()
+
+    def decode(self, words: list) -> str:
+        return ' '.join(words)
+
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    monkeypatch.setattr(tokens, 'get_token_encoder', WordEncoder)
+
+
+def words(count: int, prefix: str = 'word') -> str:
+    return ' '.join(f"{prefix}{index}" for index in range(count))
+
+
+class Chain:
+    # answers every prompt with answer_words words, and checks that the prompt fits the budget
+    def __init__(self, token_limit: int, answer_words: int):
+        self.token_limit = token_limit
+        self.answer_words = answer_words
+        self.batches = []
+
+    def answer(self, prompt_values: list) -> list:
+        for prompt_value in prompt_values:
+            assert count_tokens(prompt_value.to_string()) <= prompt_budget(self.token_limit)
+        self.batches.append(len(prompt_values))
+        return [words(self.answer_words, 'judgement') for _ in prompt_values]
+
+    def batch(self, prompt_values: list) -> list:
+        return self.answer(prompt_values)
+
+    async def abatch(self, prompt_values: list) -> list:
+        return self.answer(prompt_values)
+
+
+def test_prompt_budget_keeps_the_margin_and_the_response_reserve():
+    assert prompt_budget(1000) == 900 - tokens.response_token_reserve
+
+
+def test_prompt_which_fits_is_not_split():
+    params = {'task': 'Tell us.', 'input': words(100)}
+    assert split_to_fit(prompt, params, 1024) == [params['input']]
+
+
+def test_split_parts_fit_the_budget_and_cover_the_input():
+    params = {'task': 'Tell us.', 'input': words(3000)}
+    chunks = split_to_fit(prompt, params, 1024)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert count_prompt_tokens(prompt, {**params, 'input': chunk}) <= prompt_budget(1024)
+    assert set(' '.join(chunks).split()) == set(params['input'].split())
+
+
+def test_groups_fit_the_budget_and_at_least_halve_the_parts():
+    parts = [words(size) for size in (10, 300, 40, 40, 2000, 5, 120, 90, 60)]
+    budget = 400
+    groups = group_to_fit(parts, budget)
+    assert all(count_tokens(group) <= budget for group in groups)
+    assert len(groups) <= (len(parts) + 1) // 2
+
+    # the separators between many small parts count too
+    groups = group_to_fit([words(10)] * 40, 100)
+    assert all(count_tokens(group) <= 100 for group in groups)
+
+
+@pytest.mark.parametrize('answer_words', [50, 400, 5000])
+def test_map_reduce_ends_with_a_single_judgement(answer_words):
+    params = {'task': 'Tell us.', 'input': words(6000)}
+    chain = Chain(1200, answer_words)
+    counter = TokenCounter()
+    result = map_reduce(prompt, chain, params, 1200, 'focus', counter)
+    assert result == words(answer_words, 'judgement')
+    assert chain.batches[0] > 1 and chain.batches[-1] == 1
+    # every level of the reduction at least halves the judgements
+    assert all(later <= (earlier + 1) // 2 for earlier, later in zip(chain.batches, chain.batches[1:]))
+    assert counter.stages['focus']['calls'] == chain.batches[0]
+    assert counter.stages['focus_reduce']['calls'] == sum(chain.batches[1:])
+
+
+def test_amap_reduce_ends_with_a_single_judgement():
+    params = {'task': 'Tell us.', 'input': words(6000)}
+    chain = Chain(1200, 400)
+    assert asyncio.run(amap_reduce(prompt, chain, params, 1200, 'focus')) == words(400, 'judgement')
+    assert chain.batches[-1] == 1
+
+
+def test_fit_fields_shrinks_the_fields_until_the_prompt_fits():
+    summary_prompt = ChatPromptTemplate.from_messages([("user", "Focus: {focus} Knowledge: {knowledge}")])
+    short = {'focus': words(10), 'knowledge': words(10)}
+    assert fit_fields(summary_prompt, short, 1024, ['focus', 'knowledge']) is short
+
+    long = {'focus': words(2000), 'knowledge': words(300)}
+    fitted = fit_fields(summary_prompt, long, 1024, ['focus', 'knowledge'])
+    assert count_prompt_tokens(summary_prompt, fitted) <= prompt_budget(1024)
+    assert fitted['focus'].startswith('word0 word1') and fitted['knowledge'].startswith('word0 word1')
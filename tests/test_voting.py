@@ -0,0 +1,99 @@
+# Tests of the viability vote, see voting.py, the chain is a stand-in which returns scripted answers
+import asyncio
+import os
+import sys
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+from voting import GOOD, BAD, parse_vote, is_decided, next_wave_size, cast_votes  # noqa: E402
+
+
+class ScriptedChain:
+    # answers in the given order, the size of every batch is kept
+    def __init__(self, answers: list):
+        self.answers = list(answers)
+        self.batches = []
+
+    async def abatch(self, inputs: list, config: dict = None) -> list:
+        self.batches.append(len(inputs))
+        return [self.answers.pop(0) for _ in inputs]
+
+
+def vote(answers: list, vote_count: int = 4, **options):
+    chain = ScriptedChain(answers)
+    result = asyncio.run(cast_votes(chain, {}, vote_count, **options))
+    return result, chain.batches
+
+
+def test_parse_vote_is_strict():
+    assert parse_vote("Good.") == GOOD
+    assert parse_vote("bad") == BAD
+    assert parse_vote("BAD, not good at all") is None
+    assert parse_vote("I think good") is None
+    assert parse_vote("") is None
+
+
+def test_is_decided():
+    assert is_decided(3, 2)  # 3 - 2 > 0
+    assert not is_decided(2, 2)  # 2 - 2 is a tie, not viable, 2 + 2 is viable
+    assert is_decided(-2, 2)  # at most a tie
+    assert is_decided(0, 0)
+
+
+def test_next_wave_size_is_the_least_which_settles_the_leader():
+    for score in range(-5, 6):
+        for remaining in range(1, 9):
+            size = next_wave_size(score, remaining)
+            assert 1 <= size <= remaining
+            if is_decided(score, remaining):
+                continue
+            settles_good = is_decided(score + size, remaining - size)
+            settles_bad = is_decided(score - size, remaining - size)
+            if score > 0:
+                assert settles_good
+                assert size == 1 or not is_decided(score + size - 1, remaining - size + 1)
+            elif score < 0:
+                assert settles_bad
+                assert size == 1 or not is_decided(score - size + 1, remaining - size + 1)
+            else:
+                assert settles_good or settles_bad
+
+
+def test_next_wave_size_rounds_up_for_the_bad_outcome():
+    assert next_wave_size(0, 3) == 2  # 1 bad vote leaves 0 - 1 + 2 > 0
+    assert next_wave_size(-1, 3) == 1  # -1 - 1 + 2 is a tie
+    assert next_wave_size(0, 4) == 2
+    assert next_wave_size(0, 10, max_wave_size=3) == 3
+
+
+def test_unanimous_votes_stop_as_soon_as_the_outcome_is_settled():
+    result, batches = vote(['good'] * 3)
+    assert batches == [2, 1] and result.calls == 3
+    assert result.votes == [GOOD] * 3 and result.viable
+
+    result, batches = vote(['bad'] * 2)
+    assert batches == [2] and result.calls == 2
+    assert result.votes == [BAD] * 2 and not result.viable
+
+
+def test_confidence_stops_after_min_votes_agree():
+    result, batches = vote(['good'] * 2, confidence=1.0, min_votes=2)
+    assert batches == [2] and result.calls == 2 and result.viable and result.confidence == 1.0
+
+    # split votes are not confident, voting goes on until the majority is settled
+    result, batches = vote(['good', 'bad', 'good', 'good'], confidence=1.0, min_votes=2)
+    assert batches == [2, 1, 1] and result.score == 2 and result.viable
+
+
+def test_only_unparsed_answers_are_asked_again():
+    result, batches = vote(['good', 'maybe', 'bad', 'bad'])
+    assert batches == [2, 1, 1] and result.calls == 4
+    assert result.votes == [GOOD, BAD, BAD] and not result.viable
+
+
+def test_answers_unparsed_after_the_retries_are_no_votes():
+    result, batches = vote(['hmm'] * 4, vote_count=2, max_retries=1)
+    # a single bad vote would settle it, the unparsed one leaves the vote open for the second
+    assert batches == [1, 1, 1, 1] and result.calls == 4
+    assert result.votes == [None, None] and not result.viable and result.confidence == 0.0
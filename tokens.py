@@ -0,0 +1,165 @@
+# This file is the token budgeting part of this project
+# Every prompt is measured before it's sent. A transcript which doesn't fit the context of the model is split,
+# each part is assessed on its own (map), and the partial results are combined (reduce), instead of letting Ollama
+# silently cut the prompt. Token counts of every stage are recorded, so that num_ctx can be sized from real data.
+from langchain_core.prompts import ChatPromptTemplate
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from models import get_token_encoder
+from metrics import llm_calls, llm_tokens
+
+# room left in the context for the generated answer, the rest is the budget of the prompt
+response_token_reserve = 512
+# cl100k_base is not the tokenizer of the ollama models, the counts are estimates, so some margin is kept
+token_safety_margin = 0.9
+min_chunk_tokens = 256
+
+PART_SEPARATOR = "\n\n---\n\n"
+
+reduce_prompt = ChatPromptTemplate.from_messages([
+    ("system", "You are a hiring assistant. The response of this candidate was too long to be judged at once,"
+               "so it was split into parts, and each part was judged separately on {criterion}."
+               "Your job is to combine these partial judgements into a single judgement of {criterion}."
+               "Keep every important observation, drop repetitions, and include your reasoning."),
+    ("user", "The candidate was tasked with: \"{task}\""
+             "Partial judgements, separated by ---: ```{input}```")
+])
+
+
+def count_tokens(text: str) -> int:
+    return len(get_token_encoder().encode(text, disallowed_special=()))
+
+
+def count_prompt_tokens(prompt: ChatPromptTemplate, params: dict) -> int:
+    return count_tokens(prompt.format(**params))
+
+
+def prompt_budget(token_limit: int) -> int:
+    return int(token_limit * token_safety_margin) - response_token_reserve
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    encoder = get_token_encoder()
+    tokens = encoder.encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else encoder.decode(tokens[:max_tokens])
+
+
+def split_to_fit(prompt: ChatPromptTemplate, params: dict, token_limit: int, field: str = 'input') -> list:
+    # returns the values of params[field] to send, a single one if the whole prompt already fits
+    if count_prompt_tokens(prompt, params) <= prompt_budget(token_limit):
+        return [params[field]]
+
+    overhead = count_prompt_tokens(prompt, {**params, field: ''})
+    chunk_size = max(min_chunk_tokens, prompt_budget(token_limit) - overhead)
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_size // 10,
+                                              length_function=count_tokens)
+    return splitter.split_text(params[field])
+
+
+def group_to_fit(parts: list, budget: int) -> list:
+    # packs the parts into as few groups as possible, each group joined into a single string under the budget,
+    # separators included, parts are capped at half of the budget, so that every round of reduction at least halves
+    # the group count
+    separator_tokens = count_tokens(PART_SEPARATOR)
+    groups = []
+    current = []
+    current_tokens = 0
+    for part in parts:
+        part = truncate_tokens(part, (budget - separator_tokens) // 2)
+        part_tokens = count_tokens(part)
+        if current and current_tokens + separator_tokens + part_tokens > budget:
+            groups.append(PART_SEPARATOR.join(current))
+            current, current_tokens = [], 0
+        current_tokens += part_tokens + (separator_tokens if current else 0)
+        current.append(part)
+    if current:
+        groups.append(PART_SEPARATOR.join(current))
+    return groups
+
+
+class TokenCounter:
+    # stage -> {'prompt_tokens', 'completion_tokens', 'calls', 'chunks', 'max_prompt_tokens'}
+    def __init__(self):
+        self.stages = {}
+
+    def record(self, stage: str, prompt_text: str, completion_text: str, chunks: int = 1):
+        counts = self.stages.setdefault(stage, {'prompt_tokens': 0, 'completion_tokens': 0, 'calls': 0,
+                                                'chunks': 0, 'max_prompt_tokens': 0})
+        prompt_tokens = count_tokens(prompt_text)
+        completion_tokens = count_tokens(completion_text)
+        counts['prompt_tokens'] += prompt_tokens
+        counts['completion_tokens'] += completion_tokens
+        counts['calls'] += 1
+        counts['chunks'] = max(counts['chunks'], chunks)
+        # the largest single prompt is what num_ctx has to fit
+        counts['max_prompt_tokens'] = max(counts['max_prompt_tokens'], prompt_tokens)
+        # the counts of this candidate are stored with its assessment, the totals of all candidates are metrics
+        llm_calls.inc(stage=stage)
+        llm_tokens.inc(prompt_tokens, stage=stage, kind='prompt')
+        llm_tokens.inc(completion_tokens, stage=stage, kind='completion')
+
+    def to_dict(self) -> dict:
+        return {stage: dict(counts) for stage, counts in self.stages.items()}
+
+
+def _reduce_params(params: dict, criterion: str, joined_parts: str) -> dict:
+    return {'task': params['task'], 'criterion': criterion, 'input': joined_parts}
+
+
+def map_reduce(prompt: ChatPromptTemplate, llm_chain, params: dict, token_limit: int, criterion: str,
+               counter: TokenCounter = None) -> str:
+    # llm_chain: llm | output_parser, the prompt is applied here, so that it can be measured
+    chunks = split_to_fit(prompt, params, token_limit)
+    prompt_values = [prompt.format_prompt(**{**params, 'input': chunk}) for chunk in chunks]
+    partials = llm_chain.batch(prompt_values)
+    if counter is not None:
+        for prompt_value, partial in zip(prompt_values, partials):
+            counter.record(criterion, prompt_value.to_string(), partial, len(chunks))
+    if len(partials) == 1:
+        return partials[0]
+
+    reduce_overhead = count_prompt_tokens(reduce_prompt, _reduce_params(params, criterion, ''))
+    while True:
+        groups = group_to_fit(partials, prompt_budget(token_limit) - reduce_overhead)
+        prompt_values = [reduce_prompt.format_prompt(**_reduce_params(params, criterion, group)) for group in groups]
+        partials = llm_chain.batch(prompt_values)
+        if counter is not None:
+            for prompt_value, partial in zip(prompt_values, partials):
+                counter.record(f"{criterion}_reduce", prompt_value.to_string(), partial, len(groups))
+        if len(partials) == 1:
+            return partials[0]
+
+
+async def amap_reduce(prompt: ChatPromptTemplate, llm_chain, params: dict, token_limit: int, criterion: str,
+                      counter: TokenCounter = None) -> str:
+    # async counterpart of map_reduce, the chunks of one level are assessed concurrently
+    chunks = split_to_fit(prompt, params, token_limit)
+    prompt_values = [prompt.format_prompt(**{**params, 'input': chunk}) for chunk in chunks]
+    partials = await llm_chain.abatch(prompt_values)
+    if counter is not None:
+        for prompt_value, partial in zip(prompt_values, partials):
+            counter.record(criterion, prompt_value.to_string(), partial, len(chunks))
+    if len(partials) == 1:
+        return partials[0]
+
+    reduce_overhead = count_prompt_tokens(reduce_prompt, _reduce_params(params, criterion, ''))
+    while True:
+        groups = group_to_fit(partials, prompt_budget(token_limit) - reduce_overhead)
+        prompt_values = [reduce_prompt.format_prompt(**_reduce_params(params, criterion, group)) for group in groups]
+        partials = await llm_chain.abatch(prompt_values)
+        if counter is not None:
+            for prompt_value, partial in zip(prompt_values, partials):
+                counter.record(f"{criterion}_reduce", prompt_value.to_string(), partial, len(groups))
+        if len(partials) == 1:
+            return partials[0]
+
+
+def fit_fields(prompt: ChatPromptTemplate, params: dict, token_limit: int, fields: list) -> dict:
+    # shrinks the given fields evenly until the prompt fits, used where splitting makes no sense (master summary)
+    budget = prompt_budget(token_limit)
+    if count_prompt_tokens(prompt, params) <= budget:
+        return params
+
+    overhead = count_prompt_tokens(prompt, {**params, **{field: '' for field in fields}})
+    per_field = max(1, (budget - overhead) // len(fields))
+    return {**params, **{field: truncate_tokens(params[field], per_field) for field in fields}}
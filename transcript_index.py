@@ -0,0 +1,240 @@
+# This file is the transcript index of this project
+# Every transcript is embedded with a small sentence-embedding model and added to a FAISS HNSW index on disk,
+# so that similar past candidates and near-duplicate (templated, copied) answers are found in well under a millisecond,
+# even with tens of thousands of transcripts. Exact duplicates are recognized by the hash of the normalized text alone.
+import atexit
+import json
+import os
+import threading
+
+import numpy as np
+
+from os.path import exists
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from metrics import get_logger
+
+from models import get_embeddings, embedding_model_name, embedding_token_limit
+from cache import fingerprint
+from tokens import count_tokens
+
+logger = get_logger('transcript_index')
+
+index_dir = 'data/index'
+# HNSW: neighbors per node, and the breadth of the search while building and querying, higher is slower but exacter
+hnsw_neighbors = 32
+hnsw_ef_construction = 80
+hnsw_ef_search = 64
+near_duplicate_similarity = 0.95  # cosine similarity
+near_duplicate_neighbors = 10
+save_interval = 32  # the index is written to disk every this many added transcripts, and on exit
+
+
+def normalize_transcript(text: str) -> str:
+    return ' '.join(text.lower().split())
+
+
+def transcript_text_hash(text: str) -> str:
+    return fingerprint('transcript-normalized', normalize_transcript(text))
+
+
+def embedding_chunks(text: str) -> list:
+    # the embedding model only reads its first embedding_token_limit tokens, longer transcripts are embedded
+    # in chunks, and the chunks are averaged (token counts are estimates, so some margin is kept)
+    splitter = RecursiveCharacterTextSplitter(chunk_size=int(embedding_token_limit * 0.8), chunk_overlap=0,
+                                              length_function=count_tokens)
+    return splitter.split_text(text) or [text]
+
+
+def embed_texts(texts: list) -> np.ndarray:
+    # all chunks of all texts are sent in a single embedding request, returns unit length rows
+    chunks = [embedding_chunks(text) for text in texts]
+    vectors = np.array(get_embeddings().embed_documents([chunk for text_chunks in chunks for chunk in text_chunks]),
+                       dtype='float32')
+    embedded = []
+    start = 0
+    for text_chunks in chunks:
+        embedded.append(vectors[start:start + len(text_chunks)].mean(axis=0))
+        start += len(text_chunks)
+    embedded = np.stack(embedded)
+    return embedded / np.maximum(np.linalg.norm(embedded, axis=1, keepdims=True), 1e-12)
+
+
+class TranscriptIndex:
+    # HNSW can't remove vectors, a re-indexed candidate leaves its old vector behind as a stale entry
+    def __init__(self, name: str = 'transcripts', root: str = index_dir):
+        self.index_path = f"{root}/{name}.faiss"
+        self.metadata_path = f"{root}/{name}.json"
+        self._index = None  # faiss index, created on the first add, or loaded from disk
+        self._ids = []  # faiss position -> candidate id, None for stale entries
+        self._positions = {}  # candidate id -> faiss position
+        self._hashes = {}  # candidate id -> transcript_text_hash
+        self._by_hash = {}  # transcript_text_hash -> set of candidate ids
+        self._stale = 0
+        self._unsaved = 0
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        atexit.register(self.save)
+        if not exists(self.metadata_path) or not exists(self.index_path):
+            return
+        with open(self.metadata_path, 'r') as file:
+            metadata = json.loads(file.read())
+        if metadata.get('model') != embedding_model_name:
+            # vectors of different models can't be compared, the index is rebuilt as transcripts get added again
+            logger.warning("Transcript index was built with a different model, rebuilding: %s", metadata.get('model'))
+            return
+
+        import faiss
+        self._index = faiss.read_index(self.index_path)
+        self._index.hnsw.efSearch = hnsw_ef_search
+        self._ids = metadata['ids']
+        self._hashes = metadata['hashes']
+        for position, candidate_id in enumerate(self._ids):
+            if candidate_id is None:
+                self._stale += 1
+            else:
+                self._positions[candidate_id] = position
+        for candidate_id, text_hash in self._hashes.items():
+            self._by_hash.setdefault(text_hash, set()).add(candidate_id)
+
+    def _create_index(self, dimensions: int):
+        import faiss
+        # vectors are unit length, so the inner product is the cosine similarity
+        self._index = faiss.IndexHNSWFlat(dimensions, hnsw_neighbors, faiss.METRIC_INNER_PRODUCT)
+        self._index.hnsw.efConstruction = hnsw_ef_construction
+        self._index.hnsw.efSearch = hnsw_ef_search
+
+    def save(self):
+        import faiss
+        with self._lock:
+            if self._index is None or not self._unsaved:
+                return
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            faiss.write_index(self._index, f"{self.index_path}.tmp")
+            with open(f"{self.metadata_path}.tmp", 'w') as file:
+                file.write(json.dumps({'model': embedding_model_name, 'ids': self._ids, 'hashes': self._hashes}))
+            # the metadata is replaced last, an interrupted save leaves the old pair, or a newer index
+            # with positions the old metadata doesn't know, which are then never returned
+            os.replace(f"{self.index_path}.tmp", self.index_path)
+            os.replace(f"{self.metadata_path}.tmp", self.metadata_path)
+            self._unsaved = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._load()
+            return len(self._positions)
+
+    def __contains__(self, candidate_id: str) -> bool:
+        with self._lock:
+            self._load()
+            return candidate_id in self._positions
+
+    def find_exact(self, text: str, exclude: str = None) -> list:
+        # candidates with the very same transcript, up to case and whitespace
+        with self._lock:
+            self._load()
+            return sorted(self._by_hash.get(transcript_text_hash(text), set()) - {exclude})
+
+    def add_many(self, transcripts: dict) -> dict:
+        # transcripts: candidate id -> text, unchanged and empty transcripts are skipped
+        # returns candidate id -> near duplicates of it among the already indexed transcripts, see search
+        with self._lock:
+            self._load()
+            pending = {candidate_id: text for candidate_id, text in transcripts.items()
+                       if text.strip() and self._hashes.get(candidate_id) != transcript_text_hash(text)}
+        if not pending:
+            return {}
+
+        # embedding is the slow part, it runs outside the lock
+        vectors = embed_texts(list(pending.values()))
+
+        near_duplicates = {}
+        with self._lock:
+            if self._index is None:
+                self._create_index(vectors.shape[1])
+            for candidate_id, vector in zip(pending, vectors):
+                near_duplicates[candidate_id] = self._search(vector, near_duplicate_neighbors, candidate_id,
+                                                             near_duplicate_similarity)
+
+            for candidate_id, text in pending.items():
+                if candidate_id in self._positions:
+                    self._ids[self._positions[candidate_id]] = None
+                    self._by_hash[self._hashes[candidate_id]].discard(candidate_id)
+                    self._stale += 1
+                self._positions[candidate_id] = len(self._ids)
+                self._ids.append(candidate_id)
+                self._hashes[candidate_id] = transcript_text_hash(text)
+                self._by_hash.setdefault(self._hashes[candidate_id], set()).add(candidate_id)
+            self._index.add(vectors)
+
+            self._unsaved += len(pending)
+            if self._unsaved >= save_interval:
+                self.save()
+        return near_duplicates
+
+    def add(self, candidate_id: str, text: str) -> list:
+        return self.add_many({candidate_id: text}).get(candidate_id, [])
+
+    def _search(self, vector: np.ndarray, k: int, exclude: str = None, min_similarity: float = None) -> list:
+        if self._index is None or not self._index.ntotal:
+            return []
+        # stale and excluded entries take up places in the results, so more are asked for
+        count = min(self._index.ntotal, k + self._stale + 1)
+        similarities, positions = self._index.search(vector.reshape(1, -1), count)
+        results = []
+        for similarity, position in zip(similarities[0], positions[0]):
+            if position < 0 or position >= len(self._ids):
+                continue
+            candidate_id = self._ids[position]
+            if candidate_id is None or candidate_id == exclude:
+                continue
+            if min_similarity is not None and similarity < min_similarity:
+                break
+            results.append((candidate_id, float(similarity)))
+            if len(results) == k:
+                break
+        return results
+
+    def search(self, text: str, k: int = 5, exclude: str = None) -> list:
+        # [(candidate id, cosine similarity)] of the k most similar transcripts, most similar first
+        vector = embed_texts([text])[0]
+        with self._lock:
+            self._load()
+            return self._search(vector, k, exclude)
+
+    def vector(self, candidate_id: str) -> np.ndarray:
+        # the unit length embedding of an indexed transcript, or None
+        with self._lock:
+            self._load()
+            if candidate_id not in self._positions:
+                return None
+            return self._index.reconstruct(self._positions[candidate_id])
+
+    def similar(self, candidate_id: str, k: int = 5, min_similarity: float = None) -> list:
+        # same as search, for an already indexed candidate, no embedding needed
+        with self._lock:
+            self._load()
+            if candidate_id not in self._positions:
+                return []
+            vector = self._index.reconstruct(self._positions[candidate_id])
+            return self._search(vector, k, candidate_id, min_similarity)
+
+    def near_duplicates(self, candidate_ids: list = None, min_similarity: float = near_duplicate_similarity) -> list:
+        # [(candidate id, candidate id, similarity)] of all near-duplicate pairs among the given candidates
+        with self._lock:
+            self._load()
+            candidate_ids = set(self._positions if candidate_ids is None else candidate_ids)
+            pairs = {}
+            for candidate_id in candidate_ids:
+                for other_id, similarity in self.similar(candidate_id, near_duplicate_neighbors, min_similarity):
+                    if other_id in candidate_ids:
+                        pairs[tuple(sorted((candidate_id, other_id)))] = similarity
+            return sorted((first, second, similarity) for (first, second), similarity in pairs.items())
+
+
+transcript_index = TranscriptIndex()
@@ -0,0 +1,183 @@
+# This file is the transcription part of this project
+# Whisper runs in a pool of worker processes, each of them holds its own loaded model.
+# On GPU-less nodes, throughput scales with the number of cores, one transcription per worker at a time.
+# On GPU nodes, the worker count should be lowered (SPEEDVUE_TRANSCRIPTION_WORKERS=1), as all workers share one GPU.
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from audio import preprocess_audio, preprocessing_fingerprint, detect_speech
+from cache import transcript_cache, hash_file, fingerprint
+from models import transcription_model_name
+from metrics import get_logger, metrics_registry, stage_seconds, stage_failures
+from database import advance_candidate, candidate_id_of, TRANSCRIBED
+
+transcription_workers = int(os.environ.get('SPEEDVUE_TRANSCRIPTION_WORKERS', '0')) or os.cpu_count() or 1
+transcription_threads = int(os.environ.get('SPEEDVUE_TRANSCRIPTION_THREADS', '1'))  # torch threads per worker
+
+logger = get_logger('transcription')
+ingested_uploads = metrics_registry.counter('speedvue_ingest_uploads_total',
+                                            "Streamed uploads by how they were transcribed (streamed, fallback)",
+                                            ('mode',))
+
+# worker process state, only ever set inside of the pool workers
+_worker_model = None
+_worker_device = None
+
+
+def _init_worker(threads: int):
+    global _worker_model, _worker_device
+    import torch
+    from models import load_transcription_model, get_device
+
+    # without this, every worker would try to use all cores and the pool would be slower than a single process
+    torch.set_num_threads(threads)
+    _worker_device = get_device()
+    _worker_model = load_transcription_model()
+
+
+def get_transcript_key(video_path: str) -> str:
+    return fingerprint('transcript', hash_file(video_path), transcription_model_name, preprocessing_fingerprint())
+
+
+def _transcribe(video_path: str) -> str:
+    # whisper gets the pre-processed audio, not the raw video, see audio.py
+    preprocessed = preprocess_audio(video_path)
+    if preprocessed.kept_duration == 0:
+        return ""
+    return _worker_model.transcribe(preprocessed.load(), fp16=_worker_device == 'cuda')["text"]
+
+
+def _transcribe_samples(samples) -> str:
+    # a window of audio demuxed from an upload which is still streaming, see ingest.py, pre-processed the same way
+    speech = samples[detect_speech(samples)]
+    if len(speech) == 0:
+        return ""
+    return _worker_model.transcribe(speech, fp16=_worker_device == 'cuda')["text"]
+
+
+class TranscriptionService:
+    # The pool is started on the first submitted video, not on import.
+    # Submitting the same video twice while it's still being transcribed returns the same future.
+    def __init__(self, workers: int = transcription_workers, threads: int = transcription_threads):
+        self.workers = workers
+        self.threads = threads
+        self._executor = None
+        self._in_flight = {}  # transcript key -> Future
+        self._lock = threading.RLock()  # reentrant, done callbacks of already finished futures run immediately
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn, as forking a process which already runs threads (uvicorn, torch) is unsafe
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=_init_worker, initargs=(self.threads,))
+            logger.info("Started transcription workers: %s", self.workers)
+        return self._executor
+
+    def submit(self, video_path: str) -> Future:
+        # transcripts are cached by content, a video which was already transcribed resolves immediately
+        transcript_key = get_transcript_key(video_path)
+        cached = transcript_cache.get(transcript_key)
+        if cached is not None:
+            future = Future()
+            future.set_result(cached['text'])
+            return future
+
+        with self._lock:
+            future = self._in_flight.get(transcript_key)
+            if future is None:
+                future = self._get_executor().submit(_transcribe, video_path)
+                self._in_flight[transcript_key] = future
+                submitted_at = time.perf_counter()
+                future.add_done_callback(lambda done: self._finish(transcript_key, done, submitted_at, video_path))
+            return future
+
+    def submit_samples(self, samples) -> Future:
+        # samples: mono float32 audio at audio.SAMPLE_RATE, not cached, the stitched transcript is, see submit_ingested
+        return self._get_executor().submit(_transcribe_samples, samples)
+
+    def submit_ingested(self, video_path: str, ingest) -> Future:
+        # the transcript of an upload which was transcribed while it was streaming, see ingest.StreamingIngest,
+        # if the streaming failed, the video is transcribed as a whole instead, the future is the same either way
+        transcript_key = get_transcript_key(video_path)
+        with self._lock:
+            future = self._in_flight.get(transcript_key)
+            if future is not None or transcript_key in transcript_cache:
+                ingest.abort("already transcribed")
+                return future if future is not None else self.submit(video_path)
+            future = Future()
+            self._in_flight[transcript_key] = future
+            submitted_at = time.perf_counter()
+            future.add_done_callback(lambda done: self._finish(transcript_key, done, submitted_at, video_path))
+
+        def complete():
+            try:
+                future.set_result(ingest.transcript(video_path))
+                ingested_uploads.inc(mode='streamed')
+                return
+            except Exception as error:
+                logger.warning("Streaming transcription of %s failed, transcribing the whole video: %r", video_path,
+                               error)
+            ingested_uploads.inc(mode='fallback')
+            whole = self._get_executor().submit(_transcribe, video_path)
+            whole.add_done_callback(lambda done: future.set_exception(done.exception()) if done.exception()
+                                    else future.set_result(done.result()))
+
+        threading.Thread(target=complete, name='ingest-complete', daemon=True).start()
+        return future
+
+    def _finish(self, transcript_key: str, future: Future, submitted_at: float, video_path: str):
+        # the workers are separate processes, so the stage is timed here, the wait for a free worker included
+        stage_seconds.observe(time.perf_counter() - submitted_at, stage='transcription')
+        if not future.cancelled() and future.exception() is None:
+            transcript_cache.put(transcript_key, {'text': future.result()})
+            try:
+                advance_candidate(candidate_id_of(video_path), TRANSCRIBED, video_path)
+            except Exception as error:  # the transcript is cached, the manifest catches up once it's assessed
+                logger.warning("Candidate state not updated: %s %r", video_path, error)
+        else:
+            stage_failures.inc(stage='transcription')
+        with self._lock:
+            self._in_flight.pop(transcript_key, None)
+
+    def submit_many(self, video_paths: list, result_queue: queue.Queue = None) -> queue.Queue:
+        # (video_path, transcript, error) tuples are put into the queue in order of completion
+        if result_queue is None:
+            result_queue = queue.Queue()
+
+        def enqueue(video_path: str, future: Future):
+            error = future.exception()
+            result_queue.put((video_path, None if error else future.result(), error))
+
+        for video_path in video_paths:
+            self.submit(video_path).add_done_callback(lambda future, path=video_path: enqueue(path, future))
+        return result_queue
+
+    def transcribe(self, video_path: str) -> str:
+        return self.submit(video_path).result()
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+
+transcription_service_singleton = None
+_singleton_lock = threading.Lock()
+
+
+def get_transcription_service() -> TranscriptionService:
+    global transcription_service_singleton
+    with _singleton_lock:
+        if transcription_service_singleton is None:
+            transcription_service_singleton = TranscriptionService()
+        return transcription_service_singleton
+
+
+metrics_registry.gauge('speedvue_transcriptions_pending', "Videos queued or being transcribed").set_function(
+    lambda: len(transcription_service_singleton._in_flight) if transcription_service_singleton is not None else 0)
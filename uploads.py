@@ -0,0 +1,256 @@
+# This file is the upload part of this project
+# Videos are streamed to disk in fixed-size chunks and hashed on the fly, they're never held in memory as a whole.
+# Large recordings can be uploaded in parts (resumable uploads), each part is appended at the offset the client sends,
+# and the client can ask for the current offset to resume after a dropped connection.
+# As the bytes arrive, the audio is demuxed and transcribed in windows already, see ingest.py.
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from starlette.concurrency import run_in_threadpool
+
+from os.path import exists, getmtime
+
+from cache import register_file_hash, HASH_CHUNK_SIZE
+from database import hashid, advance_candidate, candidate_id_of, UPLOADED
+from ingest import start_ingest
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+max_upload_bytes = int(os.environ.get('SPEEDVUE_MAX_UPLOAD_BYTES', str(2 * 1024 * 1024 * 1024)))
+
+videos_dir = 'data/videos'
+uploads_dir = 'data/uploads'  # partial resumable uploads, and their metadata
+# resumable uploads without a new part for this long are abandoned, their files are removed
+upload_expiry_seconds = float(os.environ.get('SPEEDVUE_UPLOAD_EXPIRY_SECONDS', str(24 * 60 * 60)))
+expiry_interval = 60.0  # seconds between two sweeps of the uploads of all workers
+
+
+class UploadError(Exception):
+    # status_code is the http status the api should respond with
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def safe_filename(filename: str) -> str:
+    # never trust the client with paths
+    filename = os.path.basename(filename or '')
+    if filename in ('', '.', '..'):
+        raise UploadError("Invalid filename")
+    return filename
+
+
+async def write_stream(chunks, path: str, digest, offset: int = 0, limit: int = max_upload_bytes) -> int:
+    # chunks: async iterator of bytes, written starting at offset, file io runs in the threadpool
+    written = 0
+    file = await run_in_threadpool(open, path, 'r+b' if exists(path) else 'wb')
+    try:
+        await run_in_threadpool(file.seek, offset)
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            written += len(chunk)
+            if offset + written > limit:
+                raise UploadError(f"Upload exceeds the limit of {limit} bytes", status_code=413)
+            digest.update(chunk)
+            await run_in_threadpool(file.write, chunk)
+        await run_in_threadpool(file.truncate)
+    finally:
+        await run_in_threadpool(file.close)
+    return written
+
+
+async def iterate_upload_file(upload_file):
+    # fastapi UploadFile -> async iterator of fixed-size chunks
+    while True:
+        chunk = await upload_file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def register_video(video_path: str, video_hash: str, ingest=None):
+    # hand a finished upload over to the pipeline: the hash is already known, and transcription can start right away,
+    # or is already done for the most part, if the upload was transcribed while streaming (ingest)
+    from transcription import get_transcription_service
+
+    register_file_hash(video_path, video_hash)
+    advance_candidate(candidate_id_of(video_path), UPLOADED, video_path)
+    if ingest is not None:
+        get_transcription_service().submit_ingested(video_path, ingest)
+    else:
+        get_transcription_service().submit(video_path)
+
+
+async def save_upload(upload_file) -> dict:
+    # single request upload, streamed to a temporary file and moved into place once complete
+    filename = safe_filename(upload_file.filename)
+    os.makedirs(uploads_dir, exist_ok=True)
+    os.makedirs(videos_dir, exist_ok=True)
+
+    upload_id = hashid()
+    partial_path = f"{uploads_dir}/{upload_id}.part"
+    digest = hashlib.sha256()
+    chunks = iterate_upload_file(upload_file)
+    ingest = await run_in_threadpool(start_ingest, f"{uploads_dir}/{upload_id}.pcm")
+    try:
+        size = await write_stream(ingest.tee(chunks) if ingest is not None else chunks, partial_path, digest)
+    except BaseException:
+        if exists(partial_path):
+            os.remove(partial_path)
+        if ingest is not None:
+            ingest.abort()
+        raise
+
+    video_path = f"{videos_dir}/{filename}"
+    await run_in_threadpool(shutil.move, partial_path, video_path)
+    await run_in_threadpool(register_video, video_path, digest.hexdigest(), ingest)
+    return {'filename': filename, 'size': size, 'sha256': digest.hexdigest()}
+
+
+class UploadSession:
+    # a resumable upload, the metadata is stored next to the partial file, so uploads survive server restarts
+    upload_id: str
+    filename: str
+    total_size: int
+    metadata: dict
+
+    def __init__(self, upload_id: str, filename: str, total_size: int, metadata: dict = None):
+        self.upload_id = upload_id
+        self.filename = filename
+        self.total_size = total_size
+        self.metadata = metadata or {}
+        self.lock = asyncio.Lock()  # one part at a time
+        self._digest = None  # running hash, valid up to the current offset
+        self._ingest = None  # streaming transcription, only while all bytes so far were fed to it in order
+
+    @property
+    def partial_path(self) -> str:
+        return f"{uploads_dir}/{self.upload_id}.part"
+
+    @property
+    def pcm_path(self) -> str:
+        return f"{uploads_dir}/{self.upload_id}.pcm"
+
+    @property
+    def metadata_path(self) -> str:
+        return f"{uploads_dir}/{self.upload_id}.json"
+
+    @property
+    def offset(self) -> int:
+        return os.path.getsize(self.partial_path) if exists(self.partial_path) else 0
+
+    def save(self):
+        with open(self.metadata_path, 'w') as file:
+            file.write(json.dumps({'filename': self.filename, 'total_size': self.total_size,
+                                   'metadata': self.metadata}))
+
+    def digest(self):
+        # after a restart the running hash is lost, it is then rebuilt from the part already on disk
+        if self._digest is None:
+            self._digest = hashlib.sha256()
+            if exists(self.partial_path):
+                with open(self.partial_path, 'rb') as file:
+                    for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+                        self._digest.update(chunk)
+        return self._digest
+
+    async def write_part(self, chunks, offset: int) -> int:
+        async with self.lock:
+            if offset != self.offset:
+                raise UploadError(f"Expected offset {self.offset}, got {offset}", status_code=409)
+            digest = await run_in_threadpool(self.digest)
+            chunks = await self.ingest_part(chunks, offset)
+            # the hash is updated as the part is written, if the part fails halfway, it has to be rebuilt
+            self._digest = None
+            await write_stream(chunks, self.partial_path, digest, offset, min(self.total_size, max_upload_bytes))
+            self._digest = digest
+            return self.offset
+
+    async def ingest_part(self, chunks, offset: int):
+        # the streaming starts with the first part, and stops for good at any gap, e.g. a part retried after
+        # it failed halfway, or a session resumed after a restart, the upload is transcribed once complete then
+        if self._ingest is not None and (self._ingest.failed is not None or self._ingest.fed_bytes != offset):
+            self._ingest.abort("upload resumed at another offset")
+            self._ingest = None
+        if offset == 0 and self._ingest is None:
+            self._ingest = await run_in_threadpool(start_ingest, self.pcm_path)
+        return self._ingest.tee(chunks) if self._ingest is not None else chunks
+
+    async def complete(self) -> dict:
+        async with self.lock:
+            if self.offset != self.total_size:
+                raise UploadError(f"Upload incomplete, {self.offset} of {self.total_size} bytes received",
+                                  status_code=409)
+            digest = await run_in_threadpool(self.digest)
+            video_path = f"{videos_dir}/{self.filename}"
+            os.makedirs(videos_dir, exist_ok=True)
+            await run_in_threadpool(shutil.move, self.partial_path, video_path)
+            os.remove(self.metadata_path)
+            _sessions.pop(self.upload_id, None)
+            await run_in_threadpool(register_video, video_path, digest.hexdigest(), self._ingest)
+            self._ingest = None
+            return {'filename': self.filename, 'size': self.total_size, 'sha256': digest.hexdigest(), **self.metadata}
+
+    def expire(self):
+        if self._ingest is not None:
+            self._ingest.abort("upload expired")
+            self._ingest = None
+        for path in (self.partial_path, self.metadata_path, self.pcm_path):
+            if exists(path):
+                os.remove(path)
+
+
+_sessions = {}  # upload_id -> UploadSession, sessions of this process
+_last_expiry = 0.0
+
+
+def expire_uploads():
+    # removes the resumable uploads which got no part for upload_expiry_seconds, of every worker and from before
+    # a restart, the partial file is written with every part, its age is the time since the last one
+    global _last_expiry
+    if time.time() - _last_expiry < expiry_interval or not exists(uploads_dir):
+        return
+    _last_expiry = time.time()
+    for name in os.listdir(uploads_dir):
+        upload_id, extension = os.path.splitext(name)
+        if extension != '.json':
+            continue
+        session = _sessions.get(upload_id) or UploadSession(upload_id, '', 0)
+        try:
+            last_part = getmtime(session.partial_path if exists(session.partial_path) else session.metadata_path)
+            if time.time() - last_part > upload_expiry_seconds and not session.lock.locked():
+                session.expire()
+                _sessions.pop(upload_id, None)
+        except OSError:  # completed or expired by another worker in the meantime
+            pass
+
+
+def start_upload(filename: str, total_size: int, metadata: dict = None) -> UploadSession:
+    if total_size > max_upload_bytes:
+        raise UploadError(f"Upload exceeds the limit of {max_upload_bytes} bytes", status_code=413)
+    os.makedirs(uploads_dir, exist_ok=True)
+    expire_uploads()
+    session = UploadSession(hashid(), safe_filename(filename), total_size, metadata)
+    open(session.partial_path, 'wb').close()
+    session.save()
+    _sessions[session.upload_id] = session
+    return session
+
+
+def get_upload(upload_id: str) -> UploadSession:
+    expire_uploads()
+    session = _sessions.get(upload_id)
+    if session is None:
+        # started by another worker, or before a restart
+        metadata_path = f"{uploads_dir}/{safe_filename(upload_id)}.json"
+        if not exists(metadata_path):
+            raise UploadError(f"Unknown upload: {upload_id}", status_code=404)
+        with open(metadata_path, 'r') as file:
+            stored = json.loads(file.read())
+        session = UploadSession(upload_id, stored['filename'], stored['total_size'], stored['metadata'])
+        _sessions[upload_id] = session
+    return session
@@ -0,0 +1,104 @@
+# This file is the voting part of this project
+# A fixed number of good/bad votes is cast in concurrent waves, each wave is just large enough to settle the vote
+# if it turns out unanimous, and voting stops as soon as the remaining votes can no longer change the outcome.
+import re
+
+GOOD = 1
+BAD = -1
+
+
+class VoteResult:
+    votes: list  # GOOD, BAD, or None for answers which could not be parsed even after retries
+    calls: int  # llm calls made, retries included
+
+    def __init__(self, votes: list, calls: int):
+        self.votes = votes
+        self.calls = calls
+
+    @property
+    def score(self) -> int:
+        return sum(vote for vote in self.votes if vote is not None)
+
+    @property
+    def viable(self) -> bool:
+        # a tie is not enough
+        return self.score > 0
+
+    @property
+    def confidence(self) -> float:
+        # share of the parsed votes which agree with the outcome
+        parsed = [vote for vote in self.votes if vote is not None]
+        if not parsed:
+            return 0.0
+        return len([vote for vote in parsed if (vote == GOOD) == self.viable]) / len(parsed)
+
+    def __repr__(self) -> str:
+        return (f"VoteResult(score={self.score!r}, viable={self.viable!r}, votes={self.votes!r}, "
+                f"calls={self.calls!r})")
+
+
+def parse_vote(vote_response: str):
+    # strict: the answer has to start with 'good' or 'bad', and must not mention the other one anywhere
+    words = re.findall(r"[a-z]+", vote_response.lower())
+    if not words or words[0] not in ('good', 'bad'):
+        return None
+    if words[0] == 'good':
+        return None if 'bad' in words else GOOD
+    return None if 'good' in words else BAD
+
+
+def is_decided(score: int, remaining: int) -> bool:
+    # the outcome (score > 0) can't change anymore, no matter how the remaining votes go
+    return score > remaining or score + remaining <= 0
+
+
+def next_wave_size(score: int, remaining: int, max_wave_size: int = None) -> int:
+    # smallest number of votes which settles the outcome, if they all agree with the current leader
+    votes_to_settle_good = (remaining - score) // 2 + 1  # score + k > remaining - k
+    votes_to_settle_bad = -((score + remaining) // -2)  # score - k + remaining - k <= 0
+    if score > 0:
+        size = votes_to_settle_good
+    elif score < 0:
+        size = votes_to_settle_bad
+    else:
+        size = min(votes_to_settle_good, votes_to_settle_bad)
+
+    size = max(1, min(size, remaining))
+    return min(size, max_wave_size) if max_wave_size else size
+
+
+async def cast_votes(chain, params: dict, vote_count: int, max_wave_size: int = None, confidence: float = None,
+                     min_votes: int = 1, max_retries: int = 2) -> VoteResult:
+    # chain: runnable returning the raw answer, each wave is sent as one concurrent batch, on the running event loop
+    # confidence: optionally stop early once at least min_votes were cast and this share of them agrees
+    votes = []
+    calls = 0
+
+    while len(votes) < vote_count:
+        score = sum(vote for vote in votes if vote is not None)
+        remaining = vote_count - len(votes)
+        if is_decided(score, remaining):
+            break
+
+        parsed = [vote for vote in votes if vote is not None]
+        if confidence is not None and len(parsed) >= min_votes:
+            leading = max(parsed.count(GOOD), parsed.count(BAD))
+            if leading / len(parsed) >= confidence:
+                break
+
+        wave_size = next_wave_size(score, remaining, max_wave_size)
+        wave = [None] * wave_size
+        pending = list(range(wave_size))
+        for _ in range(max_retries + 1):
+            if not pending:
+                break
+            responses = await chain.abatch([params] * len(pending), config={'max_concurrency': len(pending)})
+            calls += len(pending)
+            for index, response in zip(pending, responses):
+                wave[index] = parse_vote(response)
+            # only answers which could not be parsed are asked again
+            pending = [index for index in pending if wave[index] is None]
+
+        votes.extend(wave)
+
+    return VoteResult(votes, calls)